@@ -0,0 +1,569 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import math
+import time
+import uuid
+import socket
+import platform
+import subprocess
+import contextlib
+import multiprocessing
+import numpy as np
+
+try:
+    import threadpoolctl
+except ImportError:
+    threadpoolctl = None
+
+# how many times each benchmark is run before it is timed, so that
+# caches, lazy imports and the like are warm
+warmup_runs = 1
+
+# Tukey fences, samples further than this many IQRs from the quartiles
+# are taken as outliers
+outlier_fence = 1.5
+
+# how many resamples are used for the bootstrap confidence intervals
+bootstrap_samples = 2000
+
+# every run of the benchmarks is appended to this file, one JSON per
+# line, so that runs on different machines or environments can be
+# compared (see compare_runs)
+results_db = os.path.join(os.path.expanduser('~'), 'ccv', 'benchmarks.jsonl')
+
+# a change in a task is flagged when the Mann-Whitney test between
+# the samples of the two runs gives a p-value below this
+significance = 0.05
+
+# the environment variables that set how many threads the BLAS
+# and OpenMP libraries use, they are only read when the library is
+# loaded, threadpoolctl can change the number of threads after that
+thread_vars = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+               'BLIS_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']
+
+# the thread limits set with threadpoolctl in this process, kept
+# around so that they stay in place
+_thread_limits = None
+
+def blas_info():
+    '''
+    Which BLAS numpy uses and how many threads it runs with. The
+    threads are only known if threadpoolctl is installed, without
+    it the BLAS is taken from the numpy build config, and the
+    thread environment variables are given in both cases.
+
+    Returns
+    -------
+    info (dict): with keys numpy (its version), blas, blas_version,
+    threads (None if unknown), source (threadpoolctl or numpy)
+    and env (the thread variables that are set)
+    '''
+    info = {'numpy': np.__version__,
+            'blas': None,
+            'blas_version': None,
+            'threads': None,
+            'source': None,
+            'env': {var: os.environ[var] for var in thread_vars if var in os.environ}}
+    if threadpoolctl is not None:
+        blas_pools = [pool for pool in threadpoolctl.threadpool_info()
+                      if pool['user_api'] == 'blas']
+        if len(blas_pools) > 0:
+            info['blas'] = blas_pools[0]['internal_api']
+            info['blas_version'] = blas_pools[0]['version']
+            info['threads'] = blas_pools[0]['num_threads']
+            info['source'] = 'threadpoolctl'
+            return info
+    try:
+        # numpy >= 1.25
+        config = np.show_config(mode='dicts')
+        blas = config['Build Dependencies']['blas']
+        info['blas'] = blas.get('name')
+        info['blas_version'] = blas.get('version')
+    except (TypeError, KeyError):
+        blas = getattr(np.__config__, 'blas_opt_info', {})
+        libraries = blas.get('libraries', [])
+        info['blas'] = libraries[0] if len(libraries) > 0 else None
+    info['source'] = 'numpy'
+    return info
+
+@contextlib.contextmanager
+def thread_env(threads):
+    '''
+    Set the thread environment variables to the given number of
+    threads while in the with block, processes started in it
+    will load their BLAS with that many threads.
+
+    Parameters
+    ----------
+    threads (int): the number of threads
+    '''
+    saved = {var: os.environ.get(var) for var in thread_vars}
+    os.environ.update({var: str(threads) for var in thread_vars})
+    try:
+        yield
+    finally:
+        for var, value in saved.items():
+            if value is None:
+                del os.environ[var]
+            else:
+                os.environ[var] = value
+
+def limit_threads(threads):
+    '''
+    Limit the threads of the BLAS and OpenMP libraries of this
+    process. Useful as the initializer of the workers of a pool.
+    The libraries that are already loaded can only be limited
+    with threadpoolctl, without it only the environment variables
+    are set, which only works for processes that have not loaded
+    them yet (e.g. spawned ones, see thread_env).
+
+    Parameters
+    ----------
+    threads (int): the number of threads
+
+    Returns
+    -------
+    how (str): threadpoolctl or env
+    '''
+    global _thread_limits
+    os.environ.update({var: str(threads) for var in thread_vars})
+    if threadpoolctl is None:
+        return 'env'
+    _thread_limits = threadpoolctl.threadpool_limits(limits=threads)
+    return 'threadpoolctl'
+
+def measure(fun, repeats, warmup=warmup_runs, timer=time.perf_counter):
+    '''
+    Time a function many times, after running it a few times
+    without timing it.
+
+    Parameters
+    ----------
+    fun (function): called without arguments
+    repeats (int): how many timed runs
+    warmup (int): how many untimed runs come first
+    timer (function): the clock, wall-clock time by default
+
+    Returns
+    -------
+    samples (np.array): the time of each timed run in s
+    '''
+    for _ in range(warmup):
+        fun()
+    samples = []
+    for _ in range(repeats):
+        start_time = timer()
+        fun()
+        samples.append(timer() - start_time)
+    return np.array(samples)
+
+def outliers(samples, fence=outlier_fence):
+    '''
+    Find the samples that are outside of the Tukey fences.
+
+    Parameters
+    ----------
+    samples (np.array): the timings
+    fence (float): how many IQRs beyond the quartiles a sample
+    has to be to be an outlier
+
+    Returns
+    -------
+    mask (np.array): True for the outliers
+    '''
+    q1, q3 = np.percentile(samples, [25, 75])
+    iqr = q3 - q1
+    return (samples < q1 - fence * iqr) | (samples > q3 + fence * iqr)
+
+def median_ci(samples, confidence=0.95, resamples=bootstrap_samples, seed=0):
+    '''
+    A bootstrap confidence interval for the median.
+
+    Parameters
+    ----------
+    samples (np.array): the timings
+    confidence (float): the confidence level
+    resamples (int): how many bootstrap resamples
+    seed (int): seed of the resampling, so that the interval of
+    the same samples is always the same
+
+    Returns
+    -------
+    (low, high) (float, float)
+    '''
+    if len(samples) < 2:
+        return float(samples[0]), float(samples[0])
+    rng = np.random.default_rng(seed)
+    picks = rng.integers(0, len(samples), size=(resamples, len(samples)))
+    medians = np.median(samples[picks], axis=1)
+    alpha = (1 - confidence) / 2
+    low, high = np.percentile(medians, [100 * alpha, 100 * (1 - alpha)])
+    return float(low), float(high)
+
+def summarize(samples, confidence=0.95):
+    '''
+    The statistics of a set of timings. The median is what the
+    scores are based on, since it is not thrown off by the odd
+    slow run.
+
+    Parameters
+    ----------
+    samples (np.array): the timings
+    confidence (float): the confidence level of the interval for
+    the median
+
+    Returns
+    -------
+    stats (dict): with keys median, mean, std, min, max, q1, q3,
+    iqr, ci_low, ci_high, num_outliers, outliers (the outlying
+    samples), n and samples (all of them, as a list)
+    '''
+    samples = np.asarray(samples, dtype=float)
+    q1, median, q3 = np.percentile(samples, [25, 50, 75])
+    ci_low, ci_high = median_ci(samples, confidence)
+    mask = outliers(samples)
+    return {'median': float(median),
+            'mean': float(samples.mean()),
+            'std': float(samples.std(ddof=1)) if len(samples) > 1 else 0.,
+            'min': float(samples.min()),
+            'max': float(samples.max()),
+            'q1': float(q1),
+            'q3': float(q3),
+            'iqr': float(q3 - q1),
+            'ci_low': ci_low,
+            'ci_high': ci_high,
+            'confidence': confidence,
+            'num_outliers': int(mask.sum()),
+            'outliers': samples[mask].tolist(),
+            'n': len(samples),
+            'samples': samples.tolist()}
+
+def run_benchmark(fun, repeats, warmup=warmup_runs):
+    '''
+    Time a function and summarize the timings, see measure and
+    summarize.
+
+    Parameters
+    ----------
+    fun (function): called without arguments
+    repeats (int): how many timed runs
+    warmup (int): how many untimed runs come first
+
+    Returns
+    -------
+    stats (dict): as returned by summarize
+    '''
+    return summarize(measure(fun, repeats, warmup=warmup))
+
+def header():
+    '''
+    The header of the table printed by the benchmarks.
+    '''
+    return "{:<10}\t{:>8}\t{:>8}\t{:>17}\t{:>5}\t{:>3}".format(
+        "task", "median/s", "IQR/s", "95% CI/s", "score", "out")
+
+def row(bench, stats, score):
+    '''
+    A line of the table printed by the benchmarks.
+    '''
+    ci = '%.4f-%.4f' % (stats['ci_low'], stats['ci_high'])
+    return "{:<10}\t{:>8.4f}\t{:>8.4f}\t{:>17}\t{:>5}\t{:>3}".format(
+        bench, stats['median'], stats['iqr'], ci, score, stats['num_outliers'])
+
+def save_results(fname, results, **meta):
+    '''
+    Save the results of a benchmark run, with all the samples, to
+    a JSON file.
+
+    Parameters
+    ----------
+    fname (str): path of the JSON file
+    results (dict): for each benchmark, as returned by summarize
+    meta: anything else to be saved along, e.g. the version of
+    the benchmark or the number of cores
+
+    Returns
+    -------
+    fname (str)
+    '''
+    with open(fname, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent=1)
+    return fname
+
+def cpu_model():
+    '''
+    The name of the CPU of this machine, from /proc/cpuinfo in
+    Linux and from sysctl in macOS.
+    '''
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                if line.startswith('model name'):
+                    return line.split(':', 1)[1].strip()
+    except OSError:
+        pass
+    try:
+        return subprocess.check_output(['sysctl', '-n', 'machdep.cpu.brand_string'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return platform.processor()
+
+def host_info():
+    '''
+    What a benchmark run depends on besides the code, the machine
+    and the numeric libraries.
+
+    Returns
+    -------
+    info (dict): with keys hostname, cpu, num_cores, mem_gib,
+    platform, python and blas (see blas_info, also has the numpy
+    version)
+    '''
+    mem_bytes = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    return {'hostname': socket.gethostname(),
+            'cpu': cpu_model(),
+            'num_cores': multiprocessing.cpu_count(),
+            'mem_gib': int(mem_bytes/(1024.**3)),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'blas': blas_info()}
+
+def record_run(results, benchmark, db=results_db, **meta):
+    '''
+    Append a benchmark run, with the host it ran on, to the
+    results database.
+
+    Parameters
+    ----------
+    results (dict): for each task, as returned by summarize
+    benchmark (str): which benchmark, e.g. tester or multitester
+    db (str): path of the JSON lines file
+    meta: anything else to be saved along, e.g. the version of
+    the benchmark or the scores
+
+    Returns
+    -------
+    run_id (str): the id of the run, its date, time and host and
+    a few random hex digits, so that runs started in the same
+    second on the same host (e.g. several benchmarks) differ
+    '''
+    host = host_info()
+    run_id = '%s-%s-%s' % (time.strftime('%Y%m%d-%H%M%S'), host['hostname'],
+                           uuid.uuid4().hex[:6])
+    run = {'id': run_id,
+           'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+           'benchmark': benchmark,
+           'host': host,
+           'meta': meta,
+           'results': results}
+    os.makedirs(os.path.dirname(os.path.abspath(db)), exist_ok=True)
+    with open(db, 'a') as f:
+        f.write(json.dumps(run) + '\n')
+    return run_id
+
+def load_runs(db=results_db, benchmark=None):
+    '''
+    The runs in the results database, oldest first.
+
+    Parameters
+    ----------
+    db (str): path of the JSON lines file
+    benchmark (str): if given only the runs of this benchmark
+
+    Returns
+    -------
+    runs (list): of dicts as saved by record_run
+    '''
+    if not os.path.exists(db):
+        return []
+    with open(db) as f:
+        runs = [json.loads(line) for line in f if line.strip()]
+    if benchmark is not None:
+        runs = [run for run in runs if run['benchmark'] == benchmark]
+    return runs
+
+def find_run(runs, ref):
+    '''
+    Pick a run by its id, by its position (-1 is the last one) or
+    by hostname (the last run on that host).
+
+    Parameters
+    ----------
+    runs (list): as returned by load_runs
+    ref (str or int): id, position or hostname
+
+    Returns
+    -------
+    run (dict)
+    '''
+    try:
+        return runs[int(ref)]
+    except ValueError:
+        pass
+    except IndexError:
+        raise ValueError("There is no run %s, there are %d runs." % (ref, len(runs)))
+    for run in runs:
+        if run['id'] == ref:
+            return run
+    for run in runs[::-1]:
+        if run['host']['hostname'] == ref:
+            return run
+    raise ValueError("There is no run with id or hostname %s." % ref)
+
+def mann_whitney(samples_a, samples_b):
+    '''
+    Two-sided Mann-Whitney U test of whether the samples of one
+    run tend to be larger than those of the other, with the
+    normal approximation (corrected for ties and continuity).
+    With three samples on each side it can't go below p=0.1, so
+    compare_runs also checks if the confidence intervals overlap.
+
+    Parameters
+    ----------
+    samples_a (np.array): the timings of one run
+    samples_b (np.array): the timings of the other
+
+    Returns
+    -------
+    (u, p) (float, float): the U statistic of samples_a and the
+    p-value
+    '''
+    samples_a = np.asarray(samples_a, dtype=float)
+    samples_b = np.asarray(samples_b, dtype=float)
+    n_a, n_b = len(samples_a), len(samples_b)
+    n = n_a + n_b
+    both = np.concatenate([samples_a, samples_b])
+    _, inverse, counts = np.unique(both, return_inverse=True, return_counts=True)
+    # the rank of tied samples is the average of the ranks they span
+    ranks = (np.cumsum(counts) - (counts - 1) / 2)[inverse]
+    u = ranks[:n_a].sum() - n_a * (n_a + 1) / 2
+    ties = (counts**3 - counts).sum() / (n * (n - 1)) if n > 1 else 0.
+    sigma = math.sqrt(n_a * n_b / 12 * ((n + 1) - ties))
+    if sigma == 0:
+        return float(u), 1.
+    z = max(abs(u - n_a * n_b / 2) - 0.5, 0.) / sigma
+    return float(u), min(1., math.erfc(z / math.sqrt(2)))
+
+def compare(new_results, old_results, alpha=significance):
+    '''
+    Compare the tasks of two runs.
+
+    Parameters
+    ----------
+    new_results (dict): for each task, as returned by summarize
+    old_results (dict): same for the run to compare against
+    alpha (float): the significance level
+
+    Returns
+    -------
+    rows (list): a dict for each task in both runs, with keys
+    task, old and new (the medians), delta (the relative change of
+    the median, positive is slower), p (see mann_whitney), overlap
+    (whether the confidence intervals of the medians overlap) and
+    flag, which is ** if the test is significant, * if only the
+    intervals don't overlap, and empty otherwise
+    '''
+    rows = []
+    for task, new in new_results.items():
+        if task not in old_results:
+            continue
+        old = old_results[task]
+        _, p = mann_whitney(new['samples'], old['samples'])
+        overlap = new['ci_low'] <= old['ci_high'] and old['ci_low'] <= new['ci_high']
+        flag = '**' if p < alpha else ('*' if not overlap else '')
+        rows.append({'task': task,
+                     'old': old['median'],
+                     'new': new['median'],
+                     'delta': new['median'] / old['median'] - 1,
+                     'p': p,
+                     'overlap': overlap,
+                     'flag': flag})
+    return rows
+
+def describe(run):
+    '''
+    A line with the id of a run and the host it ran on.
+    '''
+    host = run['host']
+    return "%s | %s | %s | %d cores | %d GB | numpy %s | %s %s" % (
+        run['id'], run['benchmark'], host['cpu'], host['num_cores'], host['mem_gib'],
+        host['blas']['numpy'], host['blas']['blas'], host['blas']['blas_version'])
+
+def compare_runs(new_ref=-1, old_ref=-2, benchmark=None, db=results_db, alpha=significance):
+    '''
+    Print how each task changed between two runs in the results
+    database, by default the last two. The old run is picked among
+    the runs of the same benchmark as the new one.
+
+    Parameters
+    ----------
+    new_ref (str or int): the new run, see find_run
+    old_ref (str or int): the run to compare against, see find_run
+    benchmark (str): if given only the runs of this benchmark
+    db (str): path of the JSON lines file
+    alpha (float): the significance level
+
+    Returns
+    -------
+    rows (list): as returned by compare
+    '''
+    new_run = find_run(load_runs(db, benchmark), new_ref)
+    old_run = find_run(load_runs(db, new_run['benchmark']), old_ref)
+    rows = compare(new_run['results'], old_run['results'], alpha=alpha)
+    tw = 72
+    print('new: ' + describe(new_run))
+    print('old: ' + describe(old_run))
+    print('-'*tw)
+    print("{:<10}\t{:>8}\t{:>8}\t{:>7}\t{:>6}\t{:>4}".format(
+        "task", "old/s", "new/s", "delta", "p", "flag"))
+    print('-'*tw)
+    for r in rows:
+        print("{:<10}\t{:>8.4f}\t{:>8.4f}\t{:>+6.1f}%\t{:>6.3f}\t{:>4}".format(
+            r['task'], r['old'], r['new'], 100 * r['delta'], r['p'], r['flag']))
+    print('-'*tw)
+    print("** p < %s in a Mann-Whitney test, * the %d%% CIs of the medians don't overlap"
+          % (alpha, round(100 * new_run['results'][rows[0]['task']]['confidence']))
+          if len(rows) > 0 else "No tasks in common.")
+    return rows
+
+def list_runs(benchmark=None, db=results_db):
+    '''
+    Print the runs in the results database.
+    '''
+    runs = load_runs(db, benchmark)
+    for position, run in enumerate(runs):
+        print("%3d  %s" % (position - len(runs), describe(run)))
+    return runs
+
+def main(args, benchmark=None):
+    '''
+    The commands to look at the results database, used by the
+    benchmarks as
+
+    list
+    compare [new] [old]
+
+    where new and old are as in find_run, by default the last two
+    runs.
+    '''
+    if args[0] == 'list':
+        list_runs(benchmark)
+    elif args[0] == 'compare':
+        num_runs = len(load_runs(benchmark=benchmark))
+        if num_runs < 2:
+            print("Need at least two runs to compare, there %s %d in %s." % (
+                'is' if num_runs == 1 else 'are', num_runs, results_db))
+            return
+        try:
+            compare_runs(*args[1:3], benchmark=benchmark)
+        except ValueError as e:
+            print(e)
+    else:
+        raise ValueError("Unknown command %s, use list or compare." % args[0])
+
+if __name__ == '__main__':
+    # python benchtools.py list|compare [new] [old]
+    main(sys.argv[1:] if len(sys.argv) > 1 else ['list'])
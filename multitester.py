@@ -1,49 +1,111 @@
+import sys
 import numpy as np
-import time
 from itertools import product
 import sympy as sp
 from concurrent.futures import ProcessPoolExecutor
 import multiprocessing
 import os
+import contextlib
+from benchtools import run_benchmark, header, row, save_results
+from benchtools import blas_info, thread_env, limit_threads, threadpoolctl
+from benchtools import record_run, results_db
+import benchtools
 
 info='''┌────────────────────────────────────────────────────────────────────────┐
 │~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~│
 │~~~~                                                                ~~~~│
-│~~~~     This is a benchmark useful to compare the multi-core       ~~~~│
+│~~~~      This is a benchmark useful to compare the multi-core      ~~~~│
 │~~~~    performance of different machines and configs. It runs a    ~~~~│
-│~~~~ sequence of common tasks using numpy and sympy. The total time ~~~~│
-│~~~~ these take is compared against a standard time of 0.292 s. The ~~~~│
-│~~~~         higher the score, the faster the machine/task.         ~~~~│
+│~~~~   sequence of common tasks using numpy and sympy. The times    ~~~~│
+│~~~~     are saved so that runs on different machines or after      ~~~~│
+│~~~~  changes to the environment can be compared with each other.   ~~~~│
 │~~~~                                                                ~~~~│
 │~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~│
 └────────────────────────────────────────────────────────────────────────┘'''
-version="0.2"
+version="0.3"
 title="### PWave Benchmark v %s ###" % version
 
+# each task is timed this many times, after a warmup run
 avg_repeats = 3
+warmup = 1
 
-# these standard times were obtained in a CCV
-# machine with 48 cores and 128 GB of RAM
-standard_times ={'fft': 0.32651286000000024, 
-                 'eig': 0.12225043699999993, 
-                 'rando': 0.7260819329999997, 
-                 'multi': 0.44948653200000166, 
-                 'matinv': 0.11934472299999754, 
-                 'sorter': 0.1372562859999995, 
-                 'itersum': 0.11692912399999855, 
-                 'funceval': 0.11214731899999819, 
-                 'symbexpand': 0.11132485099999911, 
-                 'total': 2.2213340649999944}
+# the standard times that the scores are relative to, a dict with
+# the time of each task and the total. The old ones (from a CCV
+# machine with 48 cores) were measured with the cpu time of the
+# parent process, which leaves out the work of the pool, so they
+# can't be compared with the wall-clock times measured now. Until
+# they are measured again no score is given, runs can be compared
+# with python multitester.py compare
+standard_times = None
 
 mem_bytes = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')  # e.g. 4015976448
 mem_gib = int(mem_bytes/(1024.**3))
 
-def poolrun(fun, reps):
-    with ProcessPoolExecutor() as executor:
-        # print(f'Using {executor._max_workers} processes.')
-        futures = [executor.submit(fun) for _ in range(reps)]
+def warm_pool(max_workers=None, threads=None):
+    '''
+    A pool of max_workers processes, with all of them already
+    started, so that it can be used for all the benchmarks and
+    their repeats without the startup being timed. If threads is
+    given the BLAS of each worker is limited to that many threads,
+    with threadpoolctl if it is installed, if not the workers are
+    spawned (instead of forked) with the thread environment
+    variables set, so that they load their BLAS already limited.
+    '''
+    options = {'max_workers': max_workers}
+    env = contextlib.nullcontext()
+    if threads is not None:
+        options.update(initializer=limit_threads, initargs=(threads,))
+        if threadpoolctl is None:
+            options['mp_context'] = multiprocessing.get_context('spawn')
+            env = thread_env(threads)
+    with env:
+        executor = ProcessPoolExecutor(**options)
+        # the workers are started by the first tasks, which has to
+        # happen while the environment is set
+        futures = [executor.submit(os.getpid) for _ in range(executor._max_workers)]
         for future in futures:
             _ = future.result()
+    return executor
+
+def runreps(fun, reps):
+    '''
+    Run fun reps times in a loop, what each worker does with its
+    share of the repetitions.
+    '''
+    for _ in range(reps):
+        fun()
+    return reps
+
+def noop():
+    return None
+
+def poolrun(fun, reps, executor):
+    '''
+    Run fun reps times in the workers of executor, each worker
+    gets a single batch with its share of the repetitions, so
+    that there is one round trip per worker and not one per
+    repetition.
+    '''
+    num_workers = executor._max_workers
+    shares = [reps // num_workers + (1 if worker < reps % num_workers else 0)
+              for worker in range(num_workers)]
+    futures = [executor.submit(runreps, fun, share) for share in shares if share > 0]
+    for future in futures:
+        _ = future.result()
+
+def overheads(repeats, warmup=warmup, max_workers=None):
+    '''
+    Measure what using a pool costs on its own, the startup of a
+    pool (see warm_pool) and the round trip of a batch of tasks
+    that do nothing (see poolrun), which is part of the time of
+    every benchmark.
+    '''
+    startup = run_benchmark(lambda: warm_pool(max_workers).shutdown(), repeats,
+                            warmup=warmup)
+    with warm_pool(max_workers) as executor:
+        ipc = run_benchmark(lambda: poolrun(noop, executor._max_workers, executor),
+                            repeats, warmup=warmup)
+    return {'startup': startup, 'ipc': ipc}
 
 def fft():
     '''
@@ -129,43 +191,253 @@ benchmarks = {'fft': (fft, 100),
               'funceval': (funceval,20),
               'symbexpand': (symbexpand,10)}
 
-def benchman(repeats):
+# what is expected to limit each task when it runs on many cores at
+# once, the ones that stream big arrays through memory stop scaling
+# once the memory bandwidth of the node is used up. This is only a
+# label, what the scaling sweep measures is whether they saturate
+kernel_kinds = {'fft': 'memory',
+                'eig': 'compute',
+                'rando': 'memory',
+                'multi': 'compute',
+                'matinv': 'compute',
+                'sorter': 'memory',
+                'itersum': 'compute',
+                'funceval': 'memory',
+                'symbexpand': 'compute'}
+
+# in the scaling sweep, a worker count is worth it while the parallel
+# efficiency stays above this
+min_efficiency = 0.7
+
+def worker_counts(max_workers=None):
+    '''
+    The worker counts of the scaling sweep, 1, 2, 4, ... and the
+    number of cores (or max_workers) at the end.
+    '''
+    max_workers = multiprocessing.cpu_count() if max_workers is None else max_workers
+    counts = []
+    count = 1
+    while count < max_workers:
+        counts.append(count)
+        count *= 2
+    counts.append(max_workers)
+    return counts
+
+def layouts(num_cores=None):
+    '''
+    The ways of splitting the cores between processes and BLAS
+    threads, as (processes, threads) pairs that use all of them.
+    '''
+    num_cores = multiprocessing.cpu_count() if num_cores is None else num_cores
+    return [(num_cores // threads, threads) for threads in range(1, num_cores + 1)
+            if num_cores % threads == 0]
+
+def layout_sweep(repeats, warmup=warmup, num_cores=None, json_fname=None):
+    '''
+    Run each task with every split of the cores between worker
+    processes and BLAS threads per worker (see layouts) and report
+    the best one for each task. The kernels that go through the
+    BLAS (eig, matinv) may prefer fewer processes with more
+    threads, the rest gain nothing from threads. The BLAS that
+    numpy uses is detected (see benchtools.blas_info) and saved
+    along with the timings if json_fname is given.
     '''
-    Standard score is 1000, which is performance of 2021 MacBook Pro 16".
+    tw = 64
+    splits = layouts(num_cores)
+    blas = blas_info()
+    print("BLAS: %s %s | numpy %s | threads %s (from %s)" % (
+        blas['blas'], blas['blas_version'], blas['numpy'], blas['threads'], blas['source']))
+    if threadpoolctl is None:
+        print("threadpoolctl is not installed, the workers are spawned to limit their threads.")
+    print("Layouts (processes x threads): %s" % ', '.join('%dx%d' % split for split in splits))
+    results = {}
+    best = {}
+    for bench, (benchfun, reps) in benchmarks.items():
+        print('-'*tw)
+        print("%s (%d tasks)" % (bench, reps))
+        print("{:>9}\t{:>8}\t{:>8}\t{:>10}".format("layout", "median/s", "IQR/s", "tasks/s"))
+        results[bench] = {}
+        for processes, threads in splits:
+            with warm_pool(processes, threads) as executor:
+                stats = run_benchmark(lambda: poolrun(benchfun, reps, executor),
+                                      repeats, warmup=warmup)
+            stats['processes'] = processes
+            stats['threads'] = threads
+            stats['throughput'] = reps / stats['median']
+            results[bench]['%dx%d' % (processes, threads)] = stats
+            print("{:>9}\t{:>8.4f}\t{:>8.4f}\t{:>10.1f}".format(
+                '%dx%d' % (processes, threads), stats['median'], stats['iqr'],
+                stats['throughput']))
+        best[bench] = min(results[bench], key=lambda split: results[bench][split]['median'])
+    print('-'*tw)
+    print("Best layouts: %s" % ', '.join('%s %s' % (bench, best[bench]) for bench in best))
+    print('-'*tw)
+    if json_fname is not None:
+        save_results(json_fname, results, benchmark='multitester-layouts', version=version,
+                     repeats=repeats, warmup=warmup, layouts=splits,
+                     num_cores=multiprocessing.cpu_count(), mem_gib=mem_gib,
+                     blas=blas, best=best)
+    return results, best
+
+def scaling(repeats, warmup=warmup, max_workers=None, json_fname=None):
     '''
-    tw = 30
+    Run each task with pools of 1, 2, 4, ... workers, up to the
+    number of cores, and report for each worker count the
+    throughput (tasks per second), the speedup over one worker
+    and the parallel efficiency (speedup per worker). The work
+    grows with the pool (weak scaling), each worker runs the
+    number of repetitions that the task has in benchmarks, so
+    that no worker is ever left idle. For each task the best
+    worker count is the one with the highest throughput, and the
+    knee is the largest count whose efficiency is still above
+    min_efficiency. A task saturates if the efficiency with all
+    the workers is below min_efficiency, which is what is
+    measured here, the memory-bound or compute-bound kind next
+    to it is only what is expected (see kernel_kinds), since the
+    first ones stop scaling when memory bandwidth runs out and
+    the second ones when cores do. This is what numCores of an
+    array job should be chosen by.
+    If json_fname is given all the timings are saved there.
+    '''
+    tw = 64
+    counts = worker_counts(max_workers)
+    print("Scaling with %s workers | %d GB of RAM." % (counts, mem_gib))
+    results = {}
+    summary = {}
+    for bench, (benchfun, reps_per_worker) in benchmarks.items():
+        print('-'*tw)
+        print("%s (expected %s-bound, %d tasks per worker)" % (bench, kernel_kinds[bench],
+                                                               reps_per_worker))
+        print("{:>7}\t{:>8}\t{:>10}\t{:>7}\t{:>10}".format(
+            "workers", "median/s", "tasks/s", "speedup", "efficiency"))
+        results[bench] = {}
+        for count in counts:
+            reps = reps_per_worker * count
+            with warm_pool(count) as executor:
+                stats = run_benchmark(lambda: poolrun(benchfun, reps, executor), repeats,
+                                      warmup=warmup)
+            stats['reps'] = reps
+            stats['throughput'] = reps / stats['median']
+            stats['speedup'] = stats['throughput'] / results[bench][1]['throughput'] if count > 1 else 1.
+            stats['efficiency'] = stats['speedup'] / count
+            results[bench][count] = stats
+            print("{:>7}\t{:>8.4f}\t{:>10.1f}\t{:>7.2f}\t{:>10.2f}".format(
+                count, stats['median'], stats['throughput'], stats['speedup'],
+                stats['efficiency']))
+        best = max(counts, key=lambda count: results[bench][count]['throughput'])
+        knee = max(count for count in counts
+                   if results[bench][count]['efficiency'] >= min_efficiency or count == 1)
+        saturates = results[bench][counts[-1]]['efficiency'] < min_efficiency
+        summary[bench] = {'kind': kernel_kinds[bench], 'best': best, 'knee': knee,
+                          'saturates': bool(saturates)}
+    print('-'*tw)
+    for saturates, label in [(False, 'scales'), (True, 'saturates')]:
+        benches = [bench for bench in benchmarks if summary[bench]['saturates'] == saturates]
+        if len(benches) == 0:
+            continue
+        print("%s: %s" % (label, ', '.join('%s (expected %s-bound, best %d, knee %d)'
+                                           % (bench, summary[bench]['kind'],
+                                              summary[bench]['best'], summary[bench]['knee'])
+                                           for bench in benches)))
+    print('-'*tw)
+    if json_fname is not None:
+        save_results(json_fname, results, benchmark='multitester-scaling', version=version,
+                     repeats=repeats, warmup=warmup, worker_counts=counts,
+                     num_cores=multiprocessing.cpu_count(), mem_gib=mem_gib,
+                     summary=summary, min_efficiency=min_efficiency, blas=blas_info())
+    return results, summary
+
+def benchman(repeats, warmup=warmup, json_fname=None, db=results_db):
+    '''
+    Standard score is 1000, the performance of the machine where
+    standard_times were measured, no score is given while these
+    are None. Each task is run warmup times and then timed repeats times
+    with a wall clock (the work happens in the pool, so the cpu
+    time of this process would miss it), its time is the median
+    of those and the table also shows their IQR, a 95% confidence
+    interval for the median and how many of them were outliers.
+    All the tasks run in the same pool, which is started (and
+    warmed) before the timing starts, and each worker runs its
+    share of the repetitions of a task in one batch. What the
+    pool costs on its own is shown after the tasks, startup is
+    the time to start a new pool and ipc the round trip of a
+    batch of empty tasks, which is part of the time of each
+    task, neither of them counts for the score.
+    If json_fname is given all the timings are saved there, and
+    unless db is None they are also appended to the results
+    database, with the host they ran on (see benchtools.record_run).
+    '''
+    tw = 88
     num_cores = multiprocessing.cpu_count()
     print("Using %d cores | %d GB of RAM." % (num_cores, mem_gib))
     print('-'*tw)
     print(title)
     print('-'*tw)
-    msg = "{:<10}\t{:<4}\t{:>5}".format("task", "t/s", "score")
-    print(msg)
+    print(header())
     print('-'*tw)
     timings = {}
     scores = {}
-    for bench, (benchfun, reps) in benchmarks.items():
-        times = []
-        for _ in range(repeats):
-            start_time = time.process_time()
-            poolrun(benchfun, reps)
-            elapsed_time = time.process_time() - start_time
-            times.append(elapsed_time)
-        elapsed_time = np.mean(elapsed_time)
-        score = int(round(1000 * standard_times[bench]/elapsed_time))
-        msg = "{:<10}\t{:<.4f}\t{:>5}".format(bench, elapsed_time, score)
-        print(msg)
-        timings[bench] = elapsed_time
-        scores[bench] = score
+    results = {}
+    with warm_pool() as executor:
+        for bench, (benchfun, reps) in benchmarks.items():
+            stats = run_benchmark(lambda: poolrun(benchfun, reps, executor), repeats,
+                                  warmup=warmup)
+            elapsed_time = stats['median']
+            if standard_times is None:
+                score = None
+            else:
+                score = int(round(1000 * standard_times[bench]/elapsed_time))
+            print(row(bench, stats, '-' if score is None else score))
+            timings[bench] = elapsed_time
+            if score is not None:
+                scores[bench] = score
+            results[bench] = stats
+    print('-'*tw)
+    pool_costs = overheads(repeats, warmup=warmup)
+    print(row('startup', pool_costs['startup'], '-'))
+    print(row('ipc', pool_costs['ipc'], '-'))
     timings['total'] = sum(timings.values())
-    timings['score'] = np.round(1000 * standard_times['total'] / timings['total'])
+    if standard_times is None:
+        timings['score'] = None
+    else:
+        timings['score'] = float(np.round(1000 * standard_times['total'] / timings['total']))
     print('-'*tw)
     print('TOTAL TIME = %.2f s' % timings['total'])
-    print('TOTAL SCORE = %d / 1000' % timings['score'])
+    if timings['score'] is None:
+        print('NO SCORE, the standard times have to be measured again')
+    else:
+        print('TOTAL SCORE = %d / 1000' % timings['score'])
     print('-'*tw)
+    if json_fname is not None:
+        save_results(json_fname, results, benchmark='multitester', version=version,
+                     repeats=repeats, warmup=warmup, num_cores=num_cores,
+                     mem_gib=mem_gib, scores=scores, total=timings['total'],
+                     score=timings['score'], blas=blas_info(), overheads=pool_costs)
+    if db is not None:
+        run_id = record_run(results, 'multitester', db=db, version=version,
+                            repeats=repeats, warmup=warmup, scores=scores,
+                            total=timings['total'], score=timings['score'],
+                            overheads=pool_costs)
+        print('Saved as run %s in %s.' % (run_id, db))
     return timings
 
 if __name__ == '__main__':
     print(info)
-    timings = benchman(avg_repeats)
+    # python multitester.py [scaling|layouts] [results.json], the
+    # timings are saved to the json file if given, and those of
+    # the benchmark always to the results database, python
+    # multitester.py list|compare [new] [old] looks at the runs in
+    # the database (see benchtools.main)
+    args = sys.argv[1:]
+    if len(args) > 0 and args[0] in ['list', 'compare']:
+        benchtools.main(args, benchmark='multitester')
+    elif len(args) > 0 and args[0] == 'scaling':
+        json_fname = args[1] if len(args) > 1 else None
+        results, summary = scaling(avg_repeats, json_fname=json_fname)
+    elif len(args) > 0 and args[0] == 'layouts':
+        json_fname = args[1] if len(args) > 1 else None
+        results, best = layout_sweep(avg_repeats, json_fname=json_fname)
+    else:
+        json_fname = args[0] if len(args) > 0 else None
+        timings = benchman(avg_repeats, json_fname=json_fname)
     # print(timings)
@@ -31,10 +31,11 @@ In addition to this, this repository also provides the following:
 * `ccv_stats.py`: useful to get a list of the users currently using OSCAR and how many cores they are using. It can also produce a graph of this information.
 * `multitester.py`: useful to compare the multi-core performance of different machines and configs. It runs a sequence of common tasks using numpy and sympy.
 * `tester.py`: useful to test the performance of a machine by running a sequence of common tasks using numpy and sympy.
+* `benchtools.py`: the timing and statistics shared by `tester.py` and `multitester.py` (warmup runs, wall-clock timing, medians with IQRs and confidence intervals, outliers, saving all the samples to JSON, detecting the BLAS numpy uses and limiting its threads, and a database of all the runs with the host they ran on, with `python benchtools.py list|compare [new] [old]` to see how each task changed between runs or machines).
 
 '''
 
-excluding = ['reboot.py']
+excluding = ['reboot.py', 'test_zizibee.py']
 
 def extract_function_data(node):
     """Extract the function name, parameters and docstring."""
@@ -47,7 +48,7 @@ def extract_function_data(node):
 def extract_from_source(source):
     """Extract function data from the source code."""
     tree = ast.parse(source)
-    functions = [node for node in ast.walk(tree) if isinstance(node, ast.FunctionDef)]
+    functions = [node for node in ast.walk(tree) if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef))]
     
     function_data = {extract_function_data(f)[0]: {"params": extract_function_data(f)[1], "docstring": extract_function_data(f)[2]} for f in functions}
 
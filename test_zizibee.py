@@ -0,0 +1,303 @@
+import os
+import time
+import socket
+import inspect
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import h5py
+import numpy as np
+import paramiko
+import pytest
+import zizibee
+
+SCALE = 5
+
+def comprehension_shadow(x):
+    scaled = [SCALE for SCALE in range(3)]
+    helper = lambda SCALE: SCALE
+    return SCALE * x + len(scaled) + helper(0)
+
+def test_free_names_follows_scopes():
+    names = zizibee.free_names(inspect.getsource(comprehension_shadow))
+    assert 'SCALE' in names
+    assert 'x' not in names
+    nested = '''def outer(a):
+    def inner(b):
+        c = 1
+        return a + b + c
+    return inner(a) + c'''
+    assert zizibee.free_names(nested) == {'c'}
+
+def test_get_needed_fun_ships_shadowed_global():
+    func_defs, const_defs, unresolved = zizibee.get_needed_fun(globals(), 'comprehension_shadow')
+    assert const_defs == ['SCALE = 5']
+    assert unresolved == {}
+
+def save_index_files(folder, params, outs):
+    fnames = []
+    for job_index, (the_params, out) in enumerate(zip(params, outs)):
+        fname = os.path.join(folder, '%d.h5' % job_index)
+        with h5py.File(fname, 'w') as f:
+            f.create_dataset('in', data=the_params)
+            f.create_dataset('out', data=out)
+        fnames.append(fname)
+    return fnames
+
+def test_h5results_continuous_parameters(tmp_path):
+    # with 3000 distinct values for each of 6 parameters the grid
+    # of all their combinations has more cells than fit in an int64
+    rng = np.random.default_rng(0)
+    params = rng.random((3000, 6))
+    outs = params.sum(axis=1, keepdims=True) * np.arange(3)
+    fnames = save_index_files(str(tmp_path), params, outs)
+    results = zizibee.load_h5_data(fnames)
+    assert len(results) == 3000
+    rows = results.locate(params[::-1])
+    assert np.all(rows >= 0)
+    assert np.allclose(np.array(results.input_params)[rows], params[::-1])
+    assert np.allclose(results.batch(params[:50]), outs[:50])
+    assert np.allclose(results(*params[7]), outs[7])
+    missing = params[:5] + 2
+    assert np.all(results.locate(missing) == -1)
+
+def test_h5results_grid(tmp_path):
+    params = np.array([[a, b] for a in [0.5, 1.5, 2.5] for b in [-1., 1.]])
+    outs = params.prod(axis=1, keepdims=True)
+    fnames = save_index_files(str(tmp_path), params[::-1], outs[::-1])
+    results = zizibee.load_h5_data(fnames, names=['a', 'b'])
+    axes, grid = results.grid()
+    assert np.allclose(axes['a'], [0.5, 1.5, 2.5])
+    assert np.allclose(grid[..., 0], np.outer(axes['a'], axes['b']))
+    assert results.locate([[0.5, -1.]])[0] >= 0
+    assert results.locate([[0.5, 0.]])[0] == -1
+
+class StubSFTPHandle(paramiko.SFTPHandle):
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+class StubSFTPServer(paramiko.SFTPServerInterface):
+    # the paths at the stand-in server are local paths
+    def list_folder(self, path):
+        try:
+            return [paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(path, fname)), fname)
+                    for fname in os.listdir(path)]
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(path, flags, 0o644)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+        handle = StubSFTPHandle(flags)
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def remove(self, path):
+        os.remove(path)
+        return paramiko.SFTP_OK
+
+class StubServer(paramiko.ServerInterface):
+    '''
+    Accepts any password, runs exec requests with the local shell
+    and refuses more than max_sessions channels at a time, like
+    the MaxSessions of sshd.
+    '''
+    def __init__(self, transport, max_sessions):
+        self.transport = transport
+        self.max_sessions = max_sessions
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind != 'session':
+            return paramiko.OPEN_FAILED_UNKNOWN_CHANNEL_TYPE
+        open_channels = [channel for channel in self.transport._channels.values()
+                         if not channel.closed]
+        if len(open_channels) >= self.max_sessions:
+            return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_exec_request(self, channel, command):
+        def run():
+            proc = subprocess.run(command.decode(), shell=True, capture_output=True)
+            channel.sendall(proc.stdout)
+            channel.sendall_stderr(proc.stderr)
+            channel.send_exit_status(proc.returncode)
+            channel.close()
+        threading.Thread(target=run, daemon=True).start()
+        return True
+
+@pytest.fixture
+def ssh_server():
+    '''
+    A stand-in SSH server on localhost, with exec and SFTP.
+    '''
+    host_key = paramiko.RSAKey.generate(1024)
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(8)
+    server = {'port': listener.getsockname()[1], 'transports': [], 'max_sessions': 10}
+    def serve():
+        while True:
+            try:
+                sock, _ = listener.accept()
+            except OSError:
+                return
+            transport = paramiko.Transport(sock)
+            transport.add_server_key(host_key)
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer, StubSFTPServer)
+            transport.start_server(server=StubServer(transport, server['max_sessions']))
+            server['transports'].append(transport)
+    threading.Thread(target=serve, daemon=True).start()
+    yield server
+    listener.close()
+    for transport in server['transports']:
+        transport.close()
+
+def stub_session(ssh_server, username, **session_kwargs):
+    return zizibee.get_session(username, '127.0.0.1', port=ssh_server['port'], password='x',
+                               look_for_keys=False, allow_agent=False, **session_kwargs)
+
+def test_session_manager(ssh_server, tmp_path):
+    session = stub_session(ssh_server, 'manager')
+    try:
+        result = zizibee.run_command('echo out; echo err >&2; exit 3',
+                                     username='manager', hostname='127.0.0.1')
+        assert result == zizibee.CommandResult('out\n', 'err\n', 3)
+        remote = tmp_path / 'remote'
+        remote.mkdir()
+        fnames = []
+        for name in ['a.py', 'b.py']:
+            fname = tmp_path / name
+            fname.write_text('print(%r)\n' % name)
+            fnames.append(str(fname))
+        def upload():
+            return zizibee.upload_bundle(fnames, str(remote), username='manager',
+                                         transferhost='127.0.0.1')
+        assert sorted(upload()['uploaded']) == fnames
+        assert sorted(upload()['skipped']) == fnames
+        (tmp_path / 'a.py').write_text('print("changed")\n')
+        summary = upload()
+        assert summary['uploaded'] == [fnames[0]]
+        assert (remote / 'a.py').read_text() == 'print("changed")\n'
+        for _ in range(20):
+            assert zizibee.run_command('true', username='manager',
+                                       hostname='127.0.0.1').exit_status == 0
+        assert session.num_connects == 1
+        # the connection dies, the next call reconnects
+        for transport in ssh_server['transports']:
+            transport.close()
+        while session.is_active():
+            time.sleep(0.01)
+        assert zizibee.run_command('echo back', username='manager',
+                                   hostname='127.0.0.1').stdout == 'back\n'
+        assert session.num_connects == 2
+    finally:
+        zizibee.close_session('manager', '127.0.0.1')
+
+def test_session_caps_channels(ssh_server, tmp_path):
+    # more threads than the server allows sessions, they wait for
+    # a channel instead of being refused
+    ssh_server['max_sessions'] = 2
+    session = stub_session(ssh_server, 'capped', max_channels=2)
+    fname = tmp_path / 'a.txt'
+    fname.write_text('a')
+    def work(i):
+        result = session.exec_command('sleep 0.1; echo %d' % i)
+        session.put(str(fname), str(tmp_path / ('%d.txt' % i)))
+        return result.stdout, len(session.listdir_attr(str(tmp_path)))
+    try:
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            outs = list(executor.map(work, range(16)))
+        assert [out for out, _ in outs] == ['%d\n' % i for i in range(16)]
+        assert session.num_connects == 1
+    finally:
+        zizibee.close_session('capped', '127.0.0.1')
+
+def sweep_params(job_index):
+    return np.array([job_index, job_index % 2], dtype=float)
+
+def sweep_fun(job_index):
+    # data_dir and scratch_dir are set by the generated script
+    if os.path.exists(os.path.join(globals()['data_dir'], 'fail')) and job_index % 3 == 0:
+        raise RuntimeError('flaky node')
+    params = sweep_params(job_index)
+    with h5py.File(os.path.join(globals()['scratch_dir'], '%d.h5' % job_index), 'w') as f:
+        f.create_dataset('in', data=params)
+        f.create_dataset('out', data=params ** 2)
+
+@pytest.fixture
+def home(tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    monkeypatch.chdir(tmp_path)
+    # the cache folders are bound as defaults when zizibee is imported
+    cache = tmp_path / 'ccv' / 'cache'
+    for fun, folder in [(zizibee.cache_script, 'scripts'),
+                        (zizibee.cached_result_path, 'results'),
+                        (zizibee.cache_results, 'results'),
+                        (zizibee.fetch_cached_results, 'results'),
+                        (zizibee.prune_result_cache, 'results')]:
+        monkeypatch.setattr(fun, '__defaults__', fun.__defaults__[:-1] + (str(cache / folder),))
+    return tmp_path
+
+def sweep_config(job_name):
+    return {'username': 'tester', 'numCores': 1, 'numJobs': 6, 'memInGB': 1,
+            'import_block': 'import os\nimport fire\nimport h5py\nimport numpy as np', 'extra_py': [],
+            'theglobals': globals(), 'fun_name': 'sweep_fun', 'params_fun': 'sweep_params',
+            'job_name': job_name, 'memoize': True, 'backend': 'local', 'chunk_size': 2}
+
+def test_local_memoize_and_resubmit(home):
+    quiet = lambda num_done, total: None
+    (home / 'ccv' / 'data' / 'memo').mkdir(parents=True)
+    (home / 'ccv' / 'data' / 'memo' / 'fail').touch()
+    job_config = zizibee.run_at_ccv(sweep_config('memo'))
+    assert job_config['backend'] == 'local' and job_config['cached_indices'] == []
+    mac_folder = job_config['scratch_dir_at_mac']
+    results = zizibee.get_ccv_values(mac_folder, job_config['scratch_dir_at_CCV'], 6,
+                                     job_config=job_config, timeout=60, progress=quiet)
+    assert results.missing_indices == [0, 3]
+    assert results.failed_indices == [0, 3]
+    # what did finish is in the cache
+    assert all(os.path.exists(zizibee.cached_result_path(job_config['fun_hash'],
+                                                         sweep_params(index)))
+               for index in [1, 2, 4, 5])
+    (home / 'ccv' / 'data' / 'memo' / 'fail').unlink()
+    retry_config = zizibee.resubmit_missing(job_config)
+    assert retry_config['index_list'] == [0, 3]
+    assert retry_config['num_tasks'] == 1
+    assert job_config['retries'][0]['indices'] == '0,3'
+    results = zizibee.get_ccv_values(mac_folder, retry_config['scratch_dir_at_CCV'], 6,
+                                     job_config=retry_config, timeout=60, progress=quiet)
+    assert results.missing_indices == []
+    assert np.allclose(results(3, 1), [9, 1])
+    assert zizibee.resubmit_missing(job_config) is None
+    # a new sweep of the same function is served from the cache
+    again = zizibee.run_at_ccv(sweep_config('again'))
+    assert again['job_id'] is None
+    assert again['cached_indices'] == list(range(6))
+    assert zizibee.completed_indices(
+        [os.path.join(again['scratch_dir_at_mac'], '%d.h5' % index) for index in range(6)]) \
+        == set(range(6))
+    assert zizibee.prune_result_cache(max_bytes=0)[0] == 6
+    assert zizibee.fetch_cached_results(again['fun_hash'], sweep_params, 6,
+                                        str(home / 'elsewhere')) == []
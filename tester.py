@@ -1,37 +1,50 @@
+import os
+import sys
+
+# the tasks are timed on a single core, so the BLAS is given this
+# many threads. The thread variables (see benchtools.thread_vars)
+# are only read when numpy loads the BLAS, so they are set first,
+# and load_threads is what the BLAS was loaded with (None if numpy
+# was already loaded)
+threads = 1
+load_threads = None if 'numpy' in sys.modules else threads
+os.environ.update({var: str(threads) for var in
+                   ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                    'BLIS_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']})
+
 import numpy as np
-import time
 from itertools import product
 import sympy as sp
+from benchtools import run_benchmark, header, row, save_results, blas_info, limit_threads
+from benchtools import record_run, results_db
+import benchtools
 
 info='''┌────────────────────────────────────────────────────────────────────────┐
 │~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~│
 │~~~~                                                                ~~~~│
 │~~~~     This is a benchmark useful to compare the single-core      ~~~~│
 │~~~~    performance of different machines and configs. It runs a    ~~~~│
-│~~~~ sequence of common tasks using numpy and sympy. The total time ~~~~│
-│~~~~ these take is compared against a standard time of 0.292 s. The ~~~~│
-│~~~~         higher the score, the faster the machine/task.         ~~~~│
+│~~~~   sequence of common tasks using numpy and sympy. The times    ~~~~│
+│~~~~     are saved so that runs on different machines or after      ~~~~│
+│~~~~  changes to the environment can be compared with each other.   ~~~~│
 │~~~~                                                                ~~~~│
 │~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~│
 └────────────────────────────────────────────────────────────────────────┘'''
-version="0.2"
+version="0.3"
 title="### WaveS benchmark v %s ###" % version
 
-# these are used for averaging out as many runs
+# each task is timed this many times, after a warmup run
 repeats=20
+warmup=1
 
-# these standard times are from an M1 Pro MacBook Pro with 16 GB of RAM
-
-standard_times = {'fft': 0.018051999999997292,
- 'eig': 0.027115000000002,
- 'rando': 0.02647800000000089,
- 'multi': 0.03607099999999974,
- 'matinv': 0.003328999999997251,
- 'sorter': 0.047008000000001715,
- 'itersum': 0.06371399999999738,
- 'funceval': 0.03203800000000001,
- 'symbexpand': 0.034727000000000174,
- 'total': 0.28853199999999646}
+# the standard times that the scores are relative to, a dict with
+# the time of each task and the total. The old ones (from an M1 Pro
+# MacBook Pro with 16 GB of RAM) were measured with process_time,
+# which also counts the cpu time of every BLAS thread, so they can't
+# be compared with the wall-clock medians measured now. Until they
+# are measured again no score is given, runs can be compared with
+# python tester.py compare
+standard_times = None
 
 def fft():
     for i in range(10):
@@ -85,42 +98,83 @@ benchmarks = {'fft': fft, 'eig': eig, 'rando': rando,
               'itersum': itersum, 'funceval': funceval,
               'symbexpand': symbexpand}
 
-def benchman(repeats):
+def benchman(repeats, warmup=warmup, json_fname=None, db=results_db, threads=threads):
     '''
-    Standard score is 1000, which is performance of 2021 MacBook Pro 16".
+    Standard score is 1000, the performance of the machine where
+    standard_times were measured, no score is given while these
+    are None. Each task is run warmup times and then timed repeats times
+    with a wall clock, its time is the median of those and the
+    table also shows their IQR, a 95% confidence interval for the
+    median and how many of them were outliers. The BLAS is
+    limited to threads threads (see benchtools.limit_threads),
+    and the number it runs with is saved along the timings, it
+    is None if it can't be known (without threadpoolctl, if numpy
+    was loaded before this module). If json_fname is
+    given all the timings are saved there, and unless db is None
+    they are also appended to the results database, with the host
+    they ran on (see benchtools.record_run).
     '''
-    tw = 30
+    tw = 88
+    limit_threads(threads)
+    blas = blas_info()
+    if blas['threads'] is None and load_threads is not None:
+        blas['threads'] = load_threads
+        blas['source'] = 'env'
+    print("BLAS: %s %s | numpy %s | threads %s (from %s)" % (
+        blas['blas'], blas['blas_version'], blas['numpy'], blas['threads'], blas['source']))
     print('-'*tw)
     print(title)
     print('-'*tw)
-    msg = "{:<10}\t{:<4}\t{:>5}".format("task", "t/s", "score")
-    print(msg)
+    print(header())
     print('-'*tw)
     timings = {}
     scores = {}
+    results = {}
     for bench, benchfun in benchmarks.items():
-        # print('%s ... ' % bench, end='')
-        times = []
-        for rep in range(repeats):
-            start_time = time.process_time()
-            benchfun()
-            elapsed_time = time.process_time() - start_time
-            times.append(elapsed_time)
-        elapsed_time = np.mean(elapsed_time)
-        score = int(round(1000 * standard_times[bench]/elapsed_time))
-        msg = '%.3f s | (%d/1000)' % (elapsed_time, score)
-        msg = "{:<10}\t{:<.4f}\t{:>5}".format(bench, elapsed_time, score)
-        print(msg)
+        stats = run_benchmark(benchfun, repeats, warmup=warmup)
+        elapsed_time = stats['median']
+        if standard_times is None:
+            score = None
+        else:
+            score = int(round(1000 * standard_times[bench]/elapsed_time))
+        print(row(bench, stats, '-' if score is None else score))
         timings[bench] = elapsed_time
-        scores[bench] = score
+        if score is not None:
+            scores[bench] = score
+        results[bench] = stats
     timings['total'] = sum(timings.values())
-    timings['score'] = np.round(1000 * standard_times['total'] / timings['total'])
+    if standard_times is None:
+        timings['score'] = None
+    else:
+        timings['score'] = float(np.round(1000 * standard_times['total'] / timings['total']))
     print('-'*tw)
     print('TOTAL TIME = %.2f s' % timings['total'])
-    print('TOTAL SCORE = %d / 1000' % timings['score'])
+    if timings['score'] is None:
+        print('NO SCORE, the standard times have to be measured again')
+    else:
+        print('TOTAL SCORE = %d / 1000' % timings['score'])
     print('-'*tw)
+    if json_fname is not None:
+        save_results(json_fname, results, benchmark='tester', version=version,
+                     repeats=repeats, warmup=warmup, scores=scores,
+                     total=timings['total'], score=timings['score'], threads=blas['threads'],
+                     blas=blas)
+    if db is not None:
+        run_id = record_run(results, 'tester', db=db, version=version, repeats=repeats,
+                            warmup=warmup, scores=scores, total=timings['total'],
+                            score=timings['score'], threads=blas['threads'])
+        print('Saved as run %s in %s.' % (run_id, db))
     return timings
 
 if __name__ == '__main__':
     print(info)
-    timings = benchman(repeats)
+    # python tester.py [results.json], the timings are saved to the
+    # json file if given, and always to the results database,
+    # python tester.py list|compare [new] [old] looks at the runs
+    # in the database (see benchtools.main)
+    args = sys.argv[1:]
+    if len(args) > 0 and args[0] in ['list', 'compare']:
+        benchtools.main(args, benchmark='tester')
+    else:
+        json_fname = args[0] if len(args) > 0 else None
+        timings = benchman(repeats, json_fname=json_fname)
@@ -1,11 +1,28 @@
 #!/usr/bin/env python3
 
+import ast
+import asyncio
+import builtins
+import contextlib
+import functools
 import inspect
+import itertools
 import os
+import math
+import textwrap
 import subprocess
+import symtable
 import json
 import re
 import sys
+import hashlib
+import shlex
+import shutil
+import select
+import threading
+import uuid
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import paramiko
 import h5py
 import numpy as np
@@ -13,6 +30,202 @@ import time
 
 HOSTNAME = 'sshcampus.ccv.brown.edu'
 
+# seconds between keepalive packets on pooled SSH connections
+KEEPALIVE = 30
+
+# at most this many channels are open at a time on a pooled SSH
+# connection, sshd refuses more than 10 sessions per connection by
+# default (MaxSessions)
+MAX_CHANNELS = 8
+
+# the result of running a command at the remote host
+CommandResult = namedtuple('CommandResult', ['stdout', 'stderr', 'exit_status'])
+
+# generated scripts are kept here, named by the sha256 of their text
+SCRIPT_CACHE = os.path.join(os.path.expanduser('~'), 'ccv', 'cache', 'scripts')
+
+# the walltime of each array task unless the job_config says otherwise
+WALLTIME = '1:00:00'
+
+# the python that runs the generated scripts at CCV, and the commands
+# that set up the login shell where jobs are submitted
+PYTHON = '~/anaconda/foundation/bin/python'
+SETUP = ['module load anaconda/3-5.2.0', 'conda activate foundation']
+
+# how many array tasks the local backend runs at a time
+LOCAL_WORKERS = os.cpu_count() or 1
+
+# with backend='auto' the sweeps that are expected to take at most
+# this many seconds on this machine are run locally
+LOCAL_SECONDS = 60
+
+# the first lines of generated scripts, the time that the imports
+# take is measured from here
+PRELUDE = '''import time as zzb_time
+zzb_t0 = zzb_time.perf_counter()'''
+
+# the entry point of generated scripts, each array task runs the
+# target function over its share of job indices
+RUNNER = '''
+import time as zzb_time
+
+def zzb_num_workers(workers):
+    if workers == 'auto':
+        import os
+        workers = os.environ.get('SLURM_CPUS_PER_TASK', os.cpu_count())
+    return max(1, int(workers))
+
+def zzb_run(job_index):
+    import os
+    import sys
+    import socket
+    import resource
+    import traceback
+    record = {'index': job_index,
+              'host': socket.gethostname(),
+              'pid': os.getpid(),
+              'job_id': os.environ.get('SLURM_JOB_ID'),
+              'array_job_id': os.environ.get('SLURM_ARRAY_JOB_ID'),
+              'array_task_id': os.environ.get('SLURM_ARRAY_TASK_ID'),
+              'start': zzb_time.time()}
+    wall, cpu = zzb_time.perf_counter(), zzb_time.process_time()
+    try:
+        globals()['%(fun_name)s'](job_index)
+    except Exception:
+        record['error'] = traceback.format_exc()
+    record['wall_seconds'] = zzb_time.perf_counter() - wall
+    record['cpu_seconds'] = zzb_time.process_time() - cpu
+    # ru_maxrss is in bytes on macOS and in KB elsewhere, it is the
+    # peak of the process so far
+    rss_unit = 1 if sys.platform == 'darwin' else 1024
+    record['peak_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * rss_unit
+    return record
+
+def zzb_main(task_id=None, chunk_size=1, num_jobs=None, strided=False,
+             start=None, stop=None, workers=1, index_file=None, stats=True):
+    import os
+    import sys
+    import json
+    zzb_t1 = zzb_time.perf_counter()
+    import_seconds = zzb_t1 - globals().get('zzb_t0', zzb_t1)
+    if start is not None:
+        job_indices = range(start, start + 1 if stop is None else stop)
+    else:
+        job_indices = task_indices(task_id, chunk_size, num_jobs, strided)
+    if index_file is not None:
+        with open(index_file, 'r') as f:
+            index_list = [int(line) for line in f if line.strip()]
+        job_indices = [index_list[i] for i in job_indices]
+    stats_file = None
+    if stats:
+        stats_dir = os.path.join(globals().get('scratch_dir', '.'), 'zzb_stats')
+        os.makedirs(stats_dir, exist_ok=True)
+        name = os.environ.get('SLURM_JOB_ID', 'local-' + str(os.getpid()))
+        stats_file = open(os.path.join(stats_dir, name + '.jsonl'), 'a')
+    workers = min(zzb_num_workers(workers), len(job_indices))
+    if workers > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(max_workers=workers)
+        futures = [executor.submit(zzb_run, job_index) for job_index in job_indices]
+        records = (future.result() for future in futures)
+    else:
+        executor = None
+        records = map(zzb_run, job_indices)
+    failed = []
+    try:
+        for record in records:
+            record['import_seconds'] = import_seconds
+            record['workers'] = workers
+            if stats_file is not None:
+                stats_file.write(json.dumps(record) + '\\n')
+                stats_file.flush()
+            if 'error' in record:
+                failed.append(record['index'])
+                sys.stderr.write('job index ' + str(record['index']) + ' failed:\\n'
+                                 + record['error'])
+                sys.stderr.flush()
+    finally:
+        if executor is not None:
+            for future in futures:
+                future.cancel()
+            executor.shutdown()
+        if stats_file is not None:
+            stats_file.close()
+    if len(failed) > 0:
+        raise RuntimeError(str(len(failed)) + ' of ' + str(len(job_indices))
+                           + ' job indices failed: ' + str(failed))
+
+def main():
+    fire.Fire(zzb_main)
+if __name__ == '__main__':
+    main()'''
+
+# the entry point of the scripts of the reduce stages of a pipeline,
+# each array task reduces its inputs into one file in out_dir
+STAGE_RUNNER = '''
+def zzb_stage(task_id=0, inputs_file=None, out_dir='.'):
+    import os
+    import json
+    with open(inputs_file, 'r') as f:
+        inputs = json.load(f)[str(task_id)]
+    os.makedirs(out_dir, exist_ok=True)
+    globals()['%(fun_name)s'](inputs, os.path.join(out_dir, str(task_id) + '%(ext)s'))
+
+def main():
+    fire.Fire(zzb_stage)
+if __name__ == '__main__':
+    main()'''
+
+# environment variables that set the number of threads used by
+# BLAS and friends, they are pinned in the sbatch script so that
+# worker processes don't oversubscribe the node
+BLAS_THREAD_VARS = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                    'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']
+
+# default memory budget for the arrays cached by H5Results
+CACHE_BYTES = 256 * 1024**2
+
+# how Slurm job states are grouped when tracking an array job,
+# anything that is not here is taken as a failure
+FINISHED_STATES = {'COMPLETED'}
+RUNNING_STATES = {'RUNNING', 'COMPLETING', 'CONFIGURING', 'STAGE_OUT', 'SUSPENDED'}
+PENDING_STATES = {'PENDING', 'REQUEUED', 'REQUEUE_HOLD', 'REQUEUE_FED', 'RESIZING'}
+
+# name of the file where iter_ccv_values keeps track of what has
+# already been ingested into a local folder
+MANIFEST = '.zzb_ingested.json'
+
+# value of the zzb_format attribute of consolidated HDF5 files
+CONSOLIDATED = 'consolidated'
+
+# the imports of the script that consolidates results at CCV
+CONSOLIDATE_IMPORTS = '''
+import os
+import fire
+import h5py
+import numpy as np
+'''
+
+# results of previous sweeps are kept here, by function and input
+RESULT_CACHE = os.path.join(os.path.expanduser('~'), 'ccv', 'cache', 'results')
+
+# per-index runtime and memory measured for each script, named
+# by the sha256 of the script text
+RESOURCE_PROFILES = os.path.join(os.path.expanduser('~'), 'ccv', 'cache', 'profiles')
+
+# how much room is left over the measured runtime and memory when
+# a job is sized from them
+SIZE_MARGIN = 1.5
+
+# how many blocking calls the async functions run at a time, the
+# channels that they open on the shared SSH connection are capped
+# by the session (see MAX_CHANNELS), so more calls only wait longer
+ASYNC_WORKERS = 4
+
+# errors that mean that an SSH connection or channel has died, as
+# opposed to e.g. a missing remote file
+CONNECTION_ERRORS = (paramiko.SSHException, EOFError, ConnectionError)
+
 def get_cell_content(notebook_path, cell_index):
     '''
     This function can be used to retrieve a specific cell
@@ -70,18 +283,517 @@ def get_all_fun(the_globals):
                 print(f"Can't get source code for built-in function {name}.")
     return func_defs
 
-def execute_at_ccv(ccv_cmd, username='jlizaraz'):
+def imported_names(import_block):
+    '''
+    Find the names that are made available by an import block,
+    both through import statements and through assignments and
+    definitions at its top level.
+
+    Parameters
+    ----------
+    import_block (str): the code of the import block
+
+    Returns
+    -------
+    names (set): the names defined by the import block, if there
+    is a star import then '*' is included.
+    '''
+    names = set()
+    for node in ast.walk(ast.parse(textwrap.dedent(import_block))):
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                if alias.asname is not None:
+                    names.add(alias.asname)
+                else:
+                    names.add(alias.name.split('.')[0])
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.add(node.name)
+        elif isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store):
+            names.add(node.id)
+    return names
+
+def free_names(source):
+    '''
+    Find the names that a piece of code uses but doesn't bind
+    itself, i.e. the globals and builtins that it needs. The
+    scopes are followed as Python does (with symtable), so that
+    e.g. the variable of a comprehension or a local of a nested
+    function doesn't hide a global of the same name used
+    elsewhere in the code.
+
+    Parameters
+    ----------
+    source (str): the source code of a function or class
+
+    Returns
+    -------
+    names (set): the free names in the code
+    '''
+    top = symtable.symtable(textwrap.dedent(source), '<source>', 'exec')
+    # what the module level of the source uses, e.g. decorators
+    # or default values, that it doesn't define itself
+    names = {symbol.get_name() for symbol in top.get_symbols()
+             if symbol.is_referenced() and not symbol.is_assigned()
+             and not symbol.is_imported()}
+    tables = top.get_children()
+    while tables:
+        table = tables.pop()
+        tables.extend(table.get_children())
+        names.update(symbol.get_name() for symbol in table.get_symbols()
+                      if symbol.is_referenced() and symbol.is_global())
+    return names
+
+def get_needed_fun(the_globals, fun_names, import_block='', provided=()):
+    '''
+    Find what needs to be shipped with the given functions for
+    them to run in a script. Starting from the given entry
+    points the sources of the functions are parsed and the
+    globals they use are followed, so that only the functions
+    (and classes) that can be reached are collected, together
+    with the constants that they need. This is the pruned
+    counterpart of get_all_fun.
+
+    Parameters
+    ----------
+    the_globals (dict): the dictionary with the global variables,
+    usually this is simply the output of globals().
+    fun_names (list or str): the name(s) of the entry point(s).
+    import_block (str): the import block of the script, names
+    defined there need not be resolved.
+    provided (iterable): other names that the script will define.
+
+    Returns
+    -------
+    (func_defs, const_defs, unresolved) (list, list, dict): with
+    the source of the needed functions and classes, the code
+    that defines the needed constants, and a dictionary with the
+    names that could not be resolved and why.
+    '''
+    if isinstance(fun_names, str):
+        fun_names = [fun_names]
+    avoid_funcs = ['open', 'get_all_fun', 'get_needed_fun']
+    known = imported_names(import_block) | set(provided) | set(dir(builtins))
+    star_import = '*' in known
+    sources, consts, unresolved = {}, {}, {}
+    queue = list(fun_names)
+    seen = set()
+    while queue:
+        name = queue.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+        if name not in the_globals:
+            if name not in known and not star_import:
+                unresolved[name] = 'not defined'
+            continue
+        obj = the_globals[name]
+        if inspect.isfunction(obj) or inspect.isclass(obj):
+            if name in known or name in avoid_funcs:
+                continue
+            try:
+                source = inspect.getsource(obj)
+            except (TypeError, OSError):
+                unresolved[name] = "can't get its source code"
+                continue
+            sources[name] = source
+            queue.extend(free_names(source))
+        elif name in known:
+            continue
+        elif inspect.ismodule(obj):
+            unresolved[name] = 'module not imported in the import block'
+        else:
+            try:
+                literal = repr(obj)
+                same = (ast.literal_eval(literal) == obj)
+            except (ValueError, SyntaxError, TypeError, MemoryError, RecursionError):
+                same = False
+            if same is True:
+                consts[name] = '%s = %s' % (name, literal)
+            else:
+                unresolved[name] = 'value of type %s cannot be written as a literal' % type(obj).__name__
+    # keep the order in which things were defined
+    order = list(the_globals.keys())
+    func_defs = [sources[k] for k in sorted(sources, key=order.index)]
+    const_defs = [consts[k] for k in sorted(consts, key=order.index)]
+    return func_defs, const_defs, unresolved
+
+class CCVSession():
+    '''
+    A persistent SSH connection to a host. A single paramiko
+    Transport is kept open (with keepalives) and exec and SFTP
+    channels are handed out from it, so that many operations
+    only pay for one SSH handshake. If the connection (or a
+    channel) dies it is re-established on the next request. At
+    most max_channels channels are open at a time, so that the
+    MaxSessions of the server is not hit however many threads
+    use the session, and SFTP clients are pooled between them.
+
+    Parameters
+    ----------
+    username (str): the username at the host
+    hostname (str): the host to connect to
+    port (int): the port where the SSH server listens
+    keepalive (int): seconds between keepalive packets
+    max_channels (int): how many channels (exec and SFTP) can be
+    open at a time, more wait for one to be closed
+    connect_kwargs: passed on to paramiko.SSHClient.connect, for
+    instance password or key_filename.
+    '''
+    def __init__(self, username, hostname=HOSTNAME, port=22,
+                 keepalive=KEEPALIVE, max_channels=MAX_CHANNELS, **connect_kwargs):
+        self.username = username
+        self.hostname = hostname
+        self.port = port
+        self.keepalive = keepalive
+        self.connect_kwargs = connect_kwargs
+        self.num_connects = 0
+        self._client = None
+        self._lock = threading.RLock()
+        self.max_channels = max_channels
+        self._num_channels = 0
+        self._slot_freed = threading.Condition(self._lock)
+        self._idle_sftp = []
+
+    def connect(self):
+        '''
+        (Re)establish the SSH connection to the host.
+        '''
+        with self._lock:
+            if self._client is not None:
+                self._client.close()
+            client = paramiko.SSHClient()
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            client.connect(self.hostname, port=self.port,
+                           username=self.username, **self.connect_kwargs)
+            client.get_transport().set_keepalive(self.keepalive)
+            self._client = client
+            self.num_connects += 1
+        return client.get_transport()
+
+    def is_active(self):
+        '''
+        Whether the underlying transport is alive.
+        '''
+        return (self._client is not None
+                and self._client.get_transport() is not None
+                and self._client.get_transport().is_active())
+
+    @property
+    def transport(self):
+        '''
+        The underlying paramiko Transport, connecting if necessary.
+        '''
+        with self._lock:
+            if not self.is_active():
+                return self.connect()
+            return self._client.get_transport()
+
+    def _retry(self, fun):
+        '''
+        Call fun(), and if the connection turns out to be dead then
+        reconnect and try once more. A channel that the server
+        refuses to open (e.g. because of its MaxSessions) says
+        nothing about the connection, so it is not retried. The
+        connection is only re-established if nobody else already
+        did, so that threads failing together reconnect once.
+        '''
+        try:
+            return fun()
+        except paramiko.ChannelException:
+            raise
+        except CONNECTION_ERRORS:
+            with self._lock:
+                if not self.is_active():
+                    self.connect()
+            return fun()
+
+    def _take_slot(self):
+        '''
+        Take one of the max_channels slots for a new channel,
+        closing idle SFTP clients to make room if need be, and
+        waiting for a slot to be given back if all are in use.
+        '''
+        with self._slot_freed:
+            while self._num_channels >= self.max_channels:
+                if self._idle_sftp:
+                    self._drop_sftp(self._idle_sftp.pop(0))
+                else:
+                    self._slot_freed.wait()
+            self._num_channels += 1
+
+    def _give_slot(self):
+        '''
+        Give back a slot taken with _take_slot.
+        '''
+        with self._slot_freed:
+            self._num_channels -= 1
+            self._slot_freed.notify()
+
+    def _drop_sftp(self, sftp):
+        '''
+        Close an SFTP client and give back its slot.
+        '''
+        try:
+            sftp.close()
+        except Exception:
+            pass
+        self._give_slot()
+
+    def open_channel(self):
+        '''
+        Open a new session channel on the transport. It takes one
+        of the max_channels slots, which has to be given back
+        with close_channel.
+
+        Returns
+        -------
+        channel (paramiko.Channel)
+        '''
+        self._take_slot()
+        try:
+            return self._retry(lambda: self.transport.open_session())
+        except BaseException:
+            self._give_slot()
+            raise
+
+    def close_channel(self, channel):
+        '''
+        Close a channel made by open_channel and give back its
+        slot.
+        '''
+        channel.close()
+        self._give_slot()
+
+    @contextlib.contextmanager
+    def sftp(self):
+        '''
+        Borrow an SFTP client running over the shared transport,
+        as in
+            with session.sftp() as sftp:
+                sftp.listdir(folder)
+        The clients are not thread-safe, so each one is used by a
+        single thread at a time, and they are kept in a pool and
+        reused afterwards. Each open client takes one of the
+        max_channels slots.
+
+        Returns
+        -------
+        sftp (paramiko.SFTPClient)
+        '''
+        sftp = None
+        while sftp is None:
+            with self._lock:
+                if not self._idle_sftp:
+                    break
+                sftp = self._idle_sftp.pop()
+                stale = (sftp.get_channel().closed or not self.is_active()
+                         or sftp.get_channel().get_transport() is not self._client.get_transport())
+            if stale:
+                self._drop_sftp(sftp)
+                sftp = None
+        if sftp is None:
+            self._take_slot()
+            try:
+                sftp = paramiko.SFTPClient.from_transport(self.transport)
+            except BaseException:
+                self._give_slot()
+                raise
+        try:
+            yield sftp
+        except BaseException:
+            self._drop_sftp(sftp)
+            raise
+        if sftp.get_channel().closed:
+            self._drop_sftp(sftp)
+        else:
+            with self._slot_freed:
+                # a thread waiting for a slot can close it
+                self._idle_sftp.append(sftp)
+                self._slot_freed.notify()
+
+    def put(self, filename, remote_path):
+        '''
+        Upload a local file through a pooled SFTP channel.
+
+        Parameters
+        ----------
+        filename (str): path of the local file
+        remote_path (str): destination path at the host
+        '''
+        def put():
+            with self.sftp() as sftp:
+                return sftp.put(filename, remote_path)
+        return self._retry(put)
+
+    def get(self, remote_path, filename):
+        '''
+        Download a file through a pooled SFTP channel.
+
+        Parameters
+        ----------
+        remote_path (str): path of the file at the host
+        filename (str): local destination path
+        '''
+        def get():
+            with self.sftp() as sftp:
+                return sftp.get(remote_path, filename)
+        return self._retry(get)
+
+    def listdir_attr(self, folder):
+        '''
+        List the contents of a folder at the host.
+
+        Parameters
+        ----------
+        folder (str): path to the folder
+
+        Returns
+        -------
+        attrs (list): of paramiko.SFTPAttributes, with the name of
+        each file in their filename attribute. If the folder does
+        not exist the list is empty.
+        '''
+        def listdir_attr():
+            with self.sftp() as sftp:
+                return sftp.listdir_attr(folder)
+        try:
+            return self._retry(listdir_attr)
+        except IOError:
+            return []
+
+    def exec_command(self, command, timeout=None):
+        '''
+        Run a command on its own exec channel. While waiting for
+        output the calling thread blocks in select (instead of
+        polling the channel), so waiting costs no CPU.
+
+        Parameters
+        ----------
+        command (str): the command to run at the host
+        timeout (float): seconds after which to give up, if None
+        wait for as long as it takes
+
+        Returns
+        -------
+        result (CommandResult): with the stdout, stderr and the
+        exit status of the command
+        '''
+        channel = self.open_channel()
+        stdout, stderr = [], []
+        deadline = None if timeout is None else time.time() + timeout
+        try:
+            channel.exec_command(command)
+            while True:
+                while channel.recv_ready():
+                    stdout.append(channel.recv(32768))
+                while channel.recv_stderr_ready():
+                    stderr.append(channel.recv_stderr(32768))
+                if (channel.exit_status_ready()
+                        and (channel.eof_received or channel.closed)
+                        and not channel.recv_ready()
+                        and not channel.recv_stderr_ready()):
+                    break
+                wait = 1.
+                if deadline is not None:
+                    wait = min(wait, deadline - time.time())
+                    if wait <= 0:
+                        raise TimeoutError('%s timed out after %s s.'
+                                           % (command, timeout))
+                select.select([channel], [], [], wait)
+            exit_status = channel.recv_exit_status()
+        finally:
+            self.close_channel(channel)
+        return CommandResult(b''.join(stdout).decode(),
+                             b''.join(stderr).decode(),
+                             exit_status)
+
+    def invoke_shell(self):
+        '''
+        Open an interactive shell channel on the transport, it has
+        to be closed with close_channel.
+
+        Returns
+        -------
+        shell (paramiko.Channel)
+        '''
+        channel = self.open_channel()
+        channel.get_pty()
+        channel.invoke_shell()
+        return channel
+
+    def close(self):
+        '''
+        Close the connection and all the channels opened through it.
+        '''
+        with self._lock:
+            if self._client is not None:
+                self._client.close()
+            self._client = None
+            idle, self._idle_sftp = self._idle_sftp, []
+        for sftp in idle:
+            self._drop_sftp(sftp)
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def get_session(username='jlizaraz', hostname=HOSTNAME, **session_kwargs):
+    '''
+    Return the pooled session for username@hostname, creating
+    it on first use. Keyword arguments (port, password, ...) are
+    only used when the session is created, so a session pointing
+    at a different port (e.g. a local stand-in SSH server)
+    can be registered once and then used by all other functions.
+
+    Parameters
+    ----------
+    username (str): username at the host
+    hostname (str): the host to connect to
+    session_kwargs: passed on to CCVSession
+
+    Returns
+    -------
+    session (CCVSession)
+    '''
+    key = (username, hostname)
+    with _sessions_lock:
+        if key not in _sessions:
+            _sessions[key] = CCVSession(username, hostname, **session_kwargs)
+        return _sessions[key]
+
+def close_session(username='jlizaraz', hostname=HOSTNAME):
+    '''
+    Close the pooled session for username@hostname, if any.
+
+    Parameters
+    ----------
+    username (str): username at the host
+    hostname (str): the host
+
+    Returns
+    -------
+    None
+    '''
+    with _sessions_lock:
+        session = _sessions.pop((username, hostname), None)
+    if session is not None:
+        session.close()
+    return None
+
+def execute_at_ccv(ccv_cmd, username='jlizaraz', hostname=HOSTNAME):
     '''
     Execute  a command at CCV and return its output. The command
     can  be  multiline  and  include  many  statements.  This is
-    accomplished by using the ssh command to execute the command
-    at CCV. This is done through a login mode (although it could
-    be  modified) so in its present form it should't be used for
+    accomplished by running the command on an exec channel of
+    the pooled SSH session to CCV, so that consecutive calls do
+    not need a new SSH handshake. This is done through a login
+    node so in its present form it should't be used for
     resource-intensive tasks.
 
     Parameters
     ----------
     ccv_cmd (str): a command (or many) to execute at CCV
+    username (str): username at CCV
+    hostname (str): the host where the command is executed
 
     Returns
     -------
@@ -105,24 +817,43 @@ def execute_at_ccv(ccv_cmd, username='jlizaraz'):
         Hello David.
         Tue Jul 25 17:25:08 EDT 2023
     '''
-    # cmd = "ssh jlizaraz@compute_node '%s'" % (HOSTNAME, ccv_cmd)
-    cmd = "ssh %s@%s '%s'" % (username, HOSTNAME, ccv_cmd)
-    process = subprocess.Popen(cmd, shell=True, 
-                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout, stderr = process.communicate()
+    result = run_command(ccv_cmd, username=username, hostname=hostname)
 
-    if process.returncode != 0:
+    if result.exit_status != 0:
         # An error occurred
-        raise Exception(stderr.decode())
+        raise Exception(result.stderr)
     else:
         # Return command output
-        stdo = stdout.decode()
-        return stdo
+        return result.stdout
+
+def run_command(command, username='jlizaraz', hostname=HOSTNAME, timeout=None):
+    '''
+    Run a command at CCV on its own exec channel of the pooled
+    SSH session. Unlike execute_at_ccv this does not raise if
+    the command fails, it returns everything that is known about
+    how it went instead.
+
+    Parameters
+    ----------
+    command (str): a command (or many) to execute at CCV
+    username (str): username at CCV
+    hostname (str): the host where the command is executed
+    timeout (float): seconds after which a TimeoutError is
+    raised, if None there is no limit
+
+    Returns
+    -------
+    result (CommandResult): a namedtuple with the stdout, stderr
+    and exit_status of the command
+    '''
+    session = get_session(username, hostname)
+    return session.exec_command(command, timeout=timeout)
 
 def upload_to_ccv(filename, folder, username='jlizaraz', transferhost = HOSTNAME, verbose=False):
     '''
     This  function can be used to upload local files to a folder
-    at CCV.
+    at CCV. The file is sent through the SFTP channel of the
+    pooled SSH session to the transfer host.
 
     Parameters
     ----------
@@ -140,302 +871,2387 @@ def upload_to_ccv(filename, folder, username='jlizaraz', transferhost = HOSTNAME
     
     '''
     root_name = os.path.split(filename)[-1]
-    command = """
-    echo put \"\\\"%s\\\"\" \\\"\"%s/%s\\\"\" | sftp %s@%s
-    """ % (filename, folder, root_name, username, transferhost)
-    if verbose:
-        print(command)
-    process = subprocess.Popen(command, 
-                               shell=True,
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE)
-
-    # Wait for the command to complete
-    stdout, stderr = process.communicate()
-
+    remote_path = '%s/%s' % (folder, root_name)
     if verbose:
-        # Print the output or the error message, if any
-        if process.returncode == 0:
-            print(f'Success:\n{stdout.decode()}')
-        else:
-            print(f'Error:\n{stderr.decode()}')
+        print('put %s %s' % (filename, remote_path))
+    session = get_session(username, transferhost)
+    try:
+        session.put(filename, remote_path)
+    except (IOError, paramiko.SSHException) as e:
+        if verbose:
+            print(f'Error:\n{e}')
+    else:
+        if verbose:
+            print(f'Success:\nUploaded {filename} to {remote_path}')
     return None
 
-def execute_shell_command(ssh_shell, command):
+def file_digest(filename):
     '''
-    Convenience function to execute shell commands at CCV.
+    The sha256 hex digest of the contents of a local file.
 
     Parameters
     ----------
-    ssh_shell (paramiko.Channel): a shell channel to CCV
-    command (str): the command as one would type it at the shell
+    filename (str): path to the file
 
     Returns
     -------
-    output (str): the output of the command, as one would see it
-    at the shell
+    digest (str): the hex digest
     '''
-    ssh_shell.send(command + '\n')
-    output = ''
-    while True:
-        while not ssh_shell.recv_ready():
-            pass
-        data = ssh_shell.recv(4096).decode()
-        output += data
-        if output.endswith('$ '):
-            break
-    return output
-
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
 
-def run_at_ccv(job_config, verbose=False, closeSSH=False):
+def remote_digests(folder, root_names, username='jlizaraz', hostname=HOSTNAME):
     '''
-    Send a grid job to CCV.
+    Get the sha256 digests of many files in a folder at CCV with
+    a single remote command.
 
     Parameters
     ----------
-    job_config   (dict):   with   at  least  the
-    following keys:
-        > username (str): the username at CCV.
-        >   numCores   (int):   how  many  cores
-        required for each job.
-        >  numJobs  (int):  how  many evaluation
-        points will be run.
-        >   memInGB   (int):   how  much  memory
-        required for each job.
-        >  import_block  (str): the import block
-        of the script to be run.
-        >  extra_py  (list):  list  of  paths to
-        extra python files to be uploaded.
-        > theglobals (dict): the dictionary with
-        the global variables.
-        >   fun_name  (str):  the  name  of  the
-        function to be run at CCV.
-        > job_name (str): the name of the job.
-    verbose  (bool):  if True some debug mesages
-    are printed
-    closeSSH   (bool):  if  True  then  the  SSH
-    connection and sheel are closed at the end
+    folder (str): the folder at CCV
+    root_names (list): names of the files in that folder
+    username (str): username at CCV
+    hostname (str): the host where the files are
 
     Returns
     -------
-    job_config   (dict)   with   the   following
-    additional keys
-        > data_dir_at_CCV (str): the path to the
-        data folder at CCV
-        >  scratch_dir_at_CCV (str): the path to
-        the scratch folder at CCV
-        > data_dir_at_mac (str): the path to the
-        data folder at the mac
-        >  scratch_dir_at_mac (str): the path to
-        the scratch folder at the mac
-        >  sbatch  (str): the text of the sbatch
-        script
-        >   ccv_sbatch_cmds   (list):  with  the
-        commands  that  were executed to run the
-        batch job
-        >  script_text  (str):  the  text of the
-        uploaded script
-        >   (theglobals   is  deleted  from  the
-        job_config dictionary)
-
+    digests (dict): keys are the root names and values are their
+    digests, files that don't exist at CCV are left out.
     '''
-    numCores = job_config['numCores']
-    theglobals = job_config['theglobals']
-    del job_config['theglobals']
-    numJobs  = job_config['numJobs']
-    memInGB  = job_config['memInGB']
-    username = job_config['username']
-    job_name = job_config['job_name']
-    importblock = job_config['import_block']
-    extra_py = job_config['extra_py']
-    special_func = job_config['fun_name']
-    funs = get_all_fun(theglobals)
-    fire_bit = '''
-def main():
-    fire.Fire(%s)
-if __name__ == '__main__':
-    main()''' % special_func
-
-    data_dir = '/users/%s/data/%s/%s' % (username, username, job_name)
-    scratch_dir = '/users/%s/scratch/%s' % (username, job_name)
-    job_config['data_dir_at_CCV'] = data_dir
-    job_config['scratch_dir_at_CCV'] = scratch_dir
-    home_dir = os.path.expanduser('~')
-    data_dir_at_mac = os.path.join(home_dir, 'ccv', 'data', job_name)
-    scratch_dir_at_mac = os.path.join(home_dir, 'ccv', 'scratch', job_name)
-    job_config['data_dir_at_mac'] = data_dir_at_mac
-    job_config['scratch_dir_at_mac'] = scratch_dir_at_mac
-
-    zzbar_dict = {'data_dir':data_dir, 'scratch_dir':scratch_dir}
-    zzbars = []
-    for k, v in zzbar_dict.items():
-        if isinstance(v, str):
-            zzbars.append('%s = \'%s\'' % (k,v))
-        else:
-            zzbars.append('%s = %s' % (k,v))
-    zzvars = '\n'.join(zzbars)
-    pieces = [importblock] + [zzvars] + funs + [fire_bit]
-    script_text = '\n\n'.join(pieces)
-    job_config['script_text'] = script_text
-
-    print("Establishing an SSH connection to CCV and launching a shell ...")
-    ccv_ssh = paramiko.SSHClient()
-    ccv_ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ccv_ssh.connect(HOSTNAME, username=username)
-    ssh_shell = ccv_ssh.invoke_shell()
-
-    # make sure that the relevant folders are created at CCV
-    for dirname in [data_dir, scratch_dir]:
-        execute_shell_command(ssh_shell, 'mkdir %s' % dirname)
-
-    # upload the code
-    print("Saving Python script to file ...")
-    with open(job_name + '.py', 'w') as f:
-        f.write(script_text)
-    # upload the script to CCV
-    print("Uploading script to CCV ...")
-    upload_to_ccv(job_name+'.py', data_dir, verbose=verbose)
-
-    if len(extra_py) > 0:
-        for extrap in extra_py:
-            if '.py' not in extrap:
-                extrap = extrap + '.py'
-            upload_to_ccv(extrap, data_dir)
-
-    print("Composing the sbatch script ...")
+    if len(root_names) == 0:
+        return {}
+    cmd = 'cd %s && sha256sum -- %s' % (shlex.quote(folder),
+                                       ' '.join(map(shlex.quote, root_names)))
+    # sha256sum fails if some of the files are missing, but still
+    # gives the digests of the ones that exist
+    result = run_command(cmd, username=username, hostname=hostname)
+    digests = {}
+    for line in result.stdout.splitlines():
+        parts = line.split(maxsplit=1)
+        if len(parts) == 2:
+            digests[parts[1].lstrip('*')] = parts[0]
+    return digests
 
-    sbatch = '''#!/bin/bash
-#SBATCH -n {numCores}
-#SBATCH --mem={memInGB}GB
-#SBATCH -t 1:00:00
-#SBATCH --array=0-{numJobs}
-
-#SBATCH -o {job_name}-%a.out
-#SBATCH -e {job_name}-%a.out
+def upload_bundle(filenames, folder, username='jlizaraz', transferhost=HOSTNAME,
+                  skip_unchanged=True, num_workers=4, verbose=False):
+    '''
+    Upload many local files to a folder at CCV over the pooled
+    SSH session. The files are sent concurrently, each worker
+    using its own SFTP channel over the same connection, and
+    SFTP writes are pipelined. Files whose size and sha256 match
+    the ones already at CCV are skipped.
 
-cd {data_dir}
-~/anaconda/foundation/bin/python {data_dir}/{job_name}.py $SLURM_ARRAY_TASK_ID
+    Parameters
+    ----------
+    filenames (list): paths of the files to be uploaded
+    folder (str): files will be uploaded to this folder
+    username (str): username at CCV
+    transferhost (str): the hostname of the transfer node at CCV
+    skip_unchanged (bool): if True files already present at CCV
+    with the same contents are not uploaded again
+    num_workers (int): how many files are sent simultaneously
+    verbose (bool): whether to print what is being done
 
-'''.format(numCores=numCores,
-    numJobs = numJobs - 1,
-    data_dir = data_dir,
-    memInGB = memInGB,
-    job_name = job_name
-    )
-    job_config['sbatch'] = sbatch
-    sbatch_fname = '%s-batch.sh' % job_name
-    print("Writing sbatch script ...")
-    open(sbatch_fname,'w').write(sbatch)
-    print("Sending sbatch script ...")
-    upload_to_ccv(sbatch_fname, data_dir)
-    ccv_sbatch_cmds = ['module load anaconda/3-5.2.0',
-    'conda activate foundation',
-    'cd',
-    'cd %s' % data_dir,
-    'sbatch ' + sbatch_fname]
-    job_config['ccv_sbatch_cmds'] = ccv_sbatch_cmds
-    outputs = [execute_shell_command(ssh_shell, cmd) for cmd in ccv_sbatch_cmds]
-    job_config['ccv_sbatch_cmd_outputs'] = outputs
+    Returns
+    -------
+    summary (dict): with keys uploaded and skipped, the lists of
+    files that were uploaded and that were left as they were
+    '''
+    filenames = list(dict.fromkeys(filenames))
+    root_names = [os.path.split(fname)[-1] for fname in filenames]
+    session = get_session(username, transferhost)
+    to_send = list(zip(filenames, root_names))
+    skipped = []
+    if skip_unchanged:
+        sizes = {attr.filename: attr.st_size
+                 for attr in session.listdir_attr(folder)}
+        same_size = [root_name for fname, root_name in to_send
+                     if sizes.get(root_name) == os.path.getsize(fname)]
+        digests = remote_digests(folder, same_size, username, transferhost)
+        to_send = []
+        for fname, root_name in zip(filenames, root_names):
+            if (root_name in digests) and (digests[root_name] == file_digest(fname)):
+                skipped.append(fname)
+            else:
+                to_send.append((fname, root_name))
+    def put(pair):
+        fname, root_name = pair
+        if verbose:
+            print('put %s %s/%s' % (fname, folder, root_name))
+        session.put(fname, '%s/%s' % (folder, root_name))
+        return fname
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+        uploaded = list(executor.map(put, to_send))
     if verbose:
-        print('\n'.join(outputs))
-    if closeSSH:
-        ssh_shell.close()
-        ccv_ssh.close()
-        ccv_ssh = None
-    return job_config
+        print('Uploaded %d files, %d unchanged.' % (len(uploaded), len(skipped)))
+    return {'uploaded': uploaded, 'skipped': skipped}
 
-def execute_command(cmd):
+def execute_shell_command(ssh_shell, command, timeout=None):
     '''
-    Execute a command in the local machine and return its output.
+    Convenience function to execute shell commands at CCV on an
+    interactive shell. The end of the output is detected with a
+    unique sentinel that is echoed together with the exit status
+    of the command, so this does not depend on how the prompt
+    looks. While waiting it blocks in select instead of polling.
 
     Parameters
     ----------
-    cmd (str): a command, just like one would type on a terminal.
+    ssh_shell (paramiko.Channel): a shell channel to CCV
+    command (str): the command as one would type it at the shell
+    timeout (float): seconds after which a TimeoutError is
+    raised, if None there is no limit
 
     Returns
     -------
-    stdout (str): the standard output of the command.
+    result (CommandResult): with the output of the command, as
+    one would see it at the shell, and its exit status. Since
+    the shell has a pty stderr is merged into stdout.
     '''
-    process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout, stderr = process.communicate()
+    token = uuid.uuid4().hex
+    sentinel = '__zzb_%s__' % token
+    # the sentinel is split in two so that the echo of the typed
+    # command itself does not match it
+    ssh_shell.send('%s\necho "__zzb_""%s__ $?"\n' % (command, token))
+    finder = re.compile(r'%s (\d+)\r?\n' % sentinel)
+    deadline = None if timeout is None else time.time() + timeout
+    output = ''
+    while True:
+        match = finder.search(output)
+        if match:
+            break
+        if ssh_shell.closed:
+            raise EOFError('Shell closed while running %s.' % command)
+        wait = 1.
+        if deadline is not None:
+            wait = min(wait, deadline - time.time())
+            if wait <= 0:
+                raise TimeoutError('%s timed out after %s s.' % (command, timeout))
+        select.select([ssh_shell], [], [], wait)
+        while ssh_shell.recv_ready():
+            output += ssh_shell.recv(4096).decode(errors='replace')
+    return CommandResult(output[:match.start()], '', int(match.group(1)))
 
-    if process.returncode != 0:
-        # An error occurred
-        raise Exception(stderr.decode())
-    else:
-        # Return command output
-        return stdout.decode()
 
-def myq():
+def cache_script(script_text, cache_dir=SCRIPT_CACHE):
     '''
-    Returns the output of running the myq command at CCV.
+    Store the text of a generated script in the local script
+    cache, where it is named by the sha256 of its contents (which
+    is the same digest that sha256sum would give for the script
+    uploaded to CCV). If it is already there it is not written
+    again.
 
     Parameters
     ----------
+    script_text (str): the text of the script
+    cache_dir (str): the folder of the cache
+
+    Returns
+    -------
+    (script_hash, cache_path) (str, str): the digest and the path
+    of the cached copy of the script
+    '''
+    script_hash = hashlib.sha256(script_text.encode()).hexdigest()
+    cache_path = os.path.join(cache_dir, script_hash + '.py')
+    if not os.path.exists(cache_path):
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(cache_path, 'w') as f:
+            f.write(script_text)
+    return script_hash, cache_path
+
+def task_indices(task_id, chunk_size=1, num_jobs=None, strided=False):
+    '''
+    The job indices that an array task is responsible for when
+    many indices are packed into each task. This function is
+    also shipped in the generated scripts, so that both sides
+    agree on how indices are assigned.
+
+    Parameters
+    ----------
+    task_id (int): the index of the array task
+    chunk_size (int): how many job indices each task runs
+    num_jobs (int): the total number of job indices, if None
+    then it is taken to be unbounded (not valid if strided)
+    strided (bool): if False each task runs a contiguous block
+    of indices, if True it runs every num_tasks-th index
+    starting at task_id
+
+    Returns
+    -------
+    job_indices (range): the job indices of this task
+    '''
+    task_id, chunk_size = int(task_id), int(chunk_size)
+    if strided:
+        num_tasks = -(-int(num_jobs) // chunk_size)
+        return range(task_id, int(num_jobs), num_tasks)
+    start = task_id * chunk_size
+    stop = start + chunk_size
+    if num_jobs is not None:
+        stop = min(stop, int(num_jobs))
+    return range(start, stop)
+
+def compose_runner(fun_name):
+    '''
+    Compose the entry point of a generated script. The script
+    can be called with the id of an array task (plus how indices
+    are packed into tasks) or with an explicit range of indices,
+    e.g.
+        python script.py 3 --chunk_size=10 --num_jobs=95
+        python script.py --start=30 --stop=40
+    With --workers=n (or --workers=auto, which uses all the cpus
+    given to the Slurm task) the indices are run by a pool of n
+    worker processes. Unless --stats=False is given a line with
+    the wall and cpu time, peak memory (of the process so far),
+    import time, host and Slurm ids of each index is appended to
+    zzb_stats/{SLURM_JOB_ID}.jsonl in scratch_dir (or in the
+    current folder if there is no scratch_dir). An index that
+    fails is recorded with its traceback (also written to stderr)
+    and the rest of the indices are still run, the task fails at
+    the end if any of them did. With --index_file=fname only the job indices listed in that
+    file (one per line) are run, and the task ids, ranges and
+    num_jobs refer to positions in that list.
+
+    Parameters
+    ----------
+    fun_name (str): the name of the function that is run for
+    each job index
+
+    Returns
+    -------
+    runner (str): the code of the entry point
+    '''
+    return '\n\n'.join([inspect.getsource(task_indices),
+                        RUNNER.strip() % {'fun_name': fun_name}])
+
+def plan_chunks(job_config, num_points=None):
+    '''
+    Determine how many job indices each array task should run.
+    This is given by chunk_size in the job_config or, if instead
+    target_walltime and task_seconds are given, by how many
+    tasks fit in the target walltime.
+
+    Parameters
+    ----------
+    job_config (dict): with at least numJobs, and optionally
+    chunk_size, or target_walltime and task_seconds (both in s).
+    If none of these are given each task runs one index, or
+    numCores indices if pool is set.
+
+    num_points (int): how many job indices are to be run, if
+    None then numJobs
+
+    Returns
+    -------
+    (chunk_size, num_tasks) (int, int): indices per array task
+    and how many array tasks are needed
+    '''
+    numJobs = job_config['numJobs'] if num_points is None else num_points
+    if 'chunk_size' in job_config:
+        chunk_size = job_config['chunk_size']
+    elif 'target_walltime' in job_config and 'task_seconds' in job_config:
+        chunk_size = int(job_config['target_walltime'] // job_config['task_seconds'])
+    elif job_config.get('pool', False):
+        chunk_size = job_config['numCores']
+    else:
+        chunk_size = 1
+    chunk_size = int(min(max(1, chunk_size), numJobs))
+    num_tasks = math.ceil(numJobs / chunk_size)
+    return chunk_size, num_tasks
+
+def runner_args(job_config, num_points, index_path=None, backend_name='slurm'):
+    '''
+    The arguments that the array tasks give to the entry point of
+    the script (see compose_runner).
+
+    Parameters
+    ----------
+    job_config (dict): with chunk_size, and optionally strided,
+    instrument, pool, numCores and blas_threads
+    num_points (int): how many job indices the job runs
+    index_path (str): path at CCV of the file with the job
+    indices, if the job doesn't run all of them
+    backend_name (str): with pool, the workers are only set for
+    slurm, the local backend already runs its tasks in parallel
+
+    Returns
+    -------
+    script_args (str)
+    '''
+    script_args = '--chunk_size=%d --num_jobs=%d' % (job_config['chunk_size'], num_points)
+    if index_path is not None:
+        script_args += ' --index_file=%s' % index_path
+    if job_config.get('strided', False):
+        script_args += ' --strided'
+    if not job_config.get('instrument', True):
+        script_args += ' --stats=False'
+    if job_config.get('pool', False) and backend_name == 'slurm':
+        script_args += ' --workers=%d' % (job_config['numCores']
+                                          // job_config.get('blas_threads', 1))
+    return script_args
+
+def write_index_file(fname, indices):
+    '''
+    Write the job indices that a job runs, one per line, for
+    the --index_file of the script.
+    '''
+    with open(fname, 'w') as f:
+        f.write('\n'.join(map(str, indices)))
+    return fname
+
+def compose_sbatch(job_config, array_spec, script_args='', python=PYTHON):
+    '''
+    Compose the sbatch script of an array job.
+
+    Parameters
+    ----------
+    job_config (dict): as returned by run_at_ccv, this needs the
+    keys numCores, memInGB, job_name, data_dir_at_CCV, and
+    optionally walltime, pool and blas_threads. If pool is set
+    then the numCores cores are requested for a single task
+    (where the script runs a pool of workers) and BLAS threads
+    are pinned to blas_threads (1 by default).
+    array_spec (str): the ids of the array tasks, e.g. 0-99
+    script_args (str): arguments passed to the script after the
+    id of the array task
+    python (str): the python that runs the script
+
+    Returns
+    -------
+    sbatch (str): the text of the sbatch script
+    '''
+    if job_config.get('pool', False):
+        cores = '#SBATCH -n 1\n#SBATCH -c %d' % job_config['numCores']
+        blas_threads = job_config.get('blas_threads', 1)
+        exports = ''.join('export %s=%d\n' % (var, blas_threads)
+                          for var in BLAS_THREAD_VARS)
+    else:
+        cores = '#SBATCH -n %d' % job_config['numCores']
+        exports = ''
+    sbatch = '''#!/bin/bash
+{cores}
+#SBATCH --mem={memInGB}GB
+#SBATCH -t {walltime}
+#SBATCH --array={array_spec}
+
+#SBATCH -o {job_name}-%a.out
+#SBATCH -e {job_name}-%a.out
+
+{exports}cd {data_dir}
+{python} {data_dir}/{job_name}.py $SLURM_ARRAY_TASK_ID {script_args}
+
+'''.format(cores = cores,
+    memInGB = job_config['memInGB'],
+    walltime = job_config.get('walltime', WALLTIME),
+    array_spec = array_spec,
+    exports = exports,
+    python = python,
+    data_dir = job_config['data_dir_at_CCV'],
+    job_name = job_config['job_name'],
+    script_args = script_args
+    )
+    return sbatch
+
+def is_index_file(fname):
+    '''
+    Whether a file is the output of a single job index, i.e. a
+    file named like 17.h5.
+    '''
+    root_name = os.path.split(fname)[-1]
+    return root_name.endswith('.h5') and root_name[:-3].isdigit()
+
+def iter_h5_entries(fname, read_out=True):
+    '''
+    Iterate over the results stored in an .h5 file, which can be
+    either the output of a single job index (named like 17.h5,
+    with in and out datasets) or a consolidated file as made by
+    consolidate_h5.
+
+    Parameters
+    ----------
+    fname (str): path to the h5 file
+    read_out (bool): if False the outputs are not read, instead
+    of them their (shape, dtype) is given
+
+    Returns
+    -------
+    entries (generator): of (index, params, out) tuples, with the
+    job index, the array of input parameters, and the output
+    '''
+    with h5py.File(fname, 'r') as f:
+        if f.attrs.get('zzb_format') == CONSOLIDATED:
+            indices = f['index'][()]
+            params = f['in'][()]
+            stacked = (f.attrs['layout'] == 'stacked')
+            if not stacked:
+                offsets = f['out_offsets'][()]
+                shapes = f['out_shapes'][()]
+            for row, index in enumerate(indices):
+                if stacked:
+                    shape = f['out'].shape[1:]
+                else:
+                    shape = tuple(int(d) for d in shapes[row] if d >= 0)
+                if not read_out:
+                    out = (shape, f['out'].dtype)
+                elif stacked:
+                    out = f['out'][row]
+                else:
+                    out = f['out'][offsets[row]:offsets[row+1]].reshape(shape)
+                yield int(index), params[row], out
+        else:
+            index = int(os.path.split(fname)[-1].split('.')[0])
+            if read_out:
+                out = np.array(f['out'])
+            else:
+                out = (f['out'].shape, f['out'].dtype)
+            yield index, np.array(f['in']), out
+
+def consolidate_h5(fnames, out_fname, compression='gzip', chunk_rows=256, remove=False):
+    '''
+    Merge the results of many job indices into a single HDF5 file
+    that has:
+        > index: the job indices, one per row
+        > in: the stacked input parameters
+        > out: the stacked outputs, if they all have the same
+        shape. Otherwise (layout attribute = ragged) out has the
+        flattened outputs one after the other, out_offsets where
+        each one starts and ends and out_shapes their shapes
+        (padded with -1).
+    The inputs can be per-index files or consolidated files, if
+    an index appears more than once the last one is kept. The
+    files are read one at a time, so the whole sweep never has
+    to fit in memory.
+
+    Parameters
+    ----------
+    fnames (list): paths to the h5 files to merge
+    out_fname (str): path of the consolidated file
+    compression (str): compression of the datasets, if None the
+    datasets are stored contiguously (and can be memory-mapped)
+    chunk_rows (int): rows per chunk of the compressed datasets
+    remove (bool): whether to delete the merged files afterwards
+
+    Returns
+    -------
+    out_fname (str): the path of the consolidated file
+    '''
+    # consolidated inputs first, then per-index files in order
+    fnames = sorted(fnames, key=lambda x: (is_index_file(x),
+                    int(os.path.split(x)[-1][:-3]) if is_index_file(x) else 0))
+    # first pass, only gather the shapes
+    rows, params, shapes, dtypes = {}, [], [], []
+    for fname in fnames:
+        for index, ins, (shape, dtype) in iter_h5_entries(fname, read_out=False):
+            if index in rows:
+                row = rows[index]
+                params[row], shapes[row] = ins, shape
+            else:
+                rows[index] = len(params)
+                params.append(ins)
+                shapes.append(shape)
+            dtypes.append(dtype)
+    num_rows = len(params)
+    if num_rows == 0:
+        raise ValueError('There are no results to consolidate.')
+    dtype = np.result_type(*set(dtypes))
+    stacked = (len(set(shapes)) == 1)
+    tmp_fname = out_fname + '.tmp'
+    with h5py.File(tmp_fname, 'w') as f:
+        f.attrs['zzb_format'] = CONSOLIDATED
+        f.attrs['layout'] = 'stacked' if stacked else 'ragged'
+        f.create_dataset('index', data=np.array(list(rows.keys()), dtype=np.int64))
+        f.create_dataset('in', data=np.array(params), compression=compression)
+        if stacked:
+            shape = (num_rows,) + shapes[0]
+            chunks = None
+            if compression is not None:
+                chunks = (min(chunk_rows, num_rows),) + shapes[0]
+            out = f.create_dataset('out', shape=shape, dtype=dtype,
+                                   chunks=chunks, compression=compression)
+        else:
+            sizes = [int(np.prod(shape)) for shape in shapes]
+            offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+            max_dim = max(len(shape) for shape in shapes)
+            padded = [list(shape) + [-1] * (max_dim - len(shape)) for shape in shapes]
+            f.create_dataset('out_offsets', data=offsets)
+            f.create_dataset('out_shapes', data=np.array(padded, dtype=np.int64).reshape(num_rows, max_dim))
+            chunks = None
+            if compression is not None:
+                chunks = (max(1, min(offsets[-1], chunk_rows * max(1, max(sizes)))),)
+            out = f.create_dataset('out', shape=(offsets[-1],), dtype=dtype,
+                                   chunks=chunks, compression=compression)
+        # second pass, copy the outputs over
+        for fname in fnames:
+            for index, ins, data in iter_h5_entries(fname):
+                row = rows[index]
+                if stacked:
+                    out[row] = data
+                else:
+                    out[offsets[row]:offsets[row+1]] = np.ravel(data)
+    os.replace(tmp_fname, out_fname)
+    if remove:
+        for fname in fnames:
+            if os.path.abspath(fname) != os.path.abspath(out_fname):
+                os.remove(fname)
+    return out_fname
+
+def consolidate_folder(folder, out_fname, compression='gzip', remove=False):
+    '''
+    Merge all the .h5 results in a folder with consolidate_h5.
+    This is what the consolidation job runs at CCV.
+
+    Parameters
+    ----------
+    folder (str): the folder with the .h5 files
+    out_fname (str): path of the consolidated file
+    compression (str): compression of the datasets
+    remove (bool): whether to delete the merged files afterwards
+
+    Returns
+    -------
+    out_fname (str): the path of the consolidated file
+    '''
+    fnames = [os.path.join(folder, fname) for fname in os.listdir(folder)
+              if fname.endswith('.h5')]
+    return consolidate_h5(fnames, out_fname, compression=compression, remove=remove)
+
+def compose_consolidation(job_config, python=PYTHON):
+    '''
+    Compose the script and the sbatch script of the job that
+    consolidates the results of an array job at CCV. The script
+    ships the source of consolidate_folder (and what it needs).
+    The datasets are compressed as given by consolidate_compression
+    in the job_config, by default they are not, so that they are
+    stored contiguously and H5Results can memory-map them.
+
+    Parameters
+    ----------
+    job_config (dict): as returned by run_at_ccv
+    python (str): the python that runs the script
+
+    Returns
+    -------
+    (script_text, sbatch) (str, str)
+    '''
+    funs, consts, _ = get_needed_fun(globals(), 'consolidate_folder',
+                                     import_block=CONSOLIDATE_IMPORTS)
+    fire_bit = '''def main():
+    fire.Fire(consolidate_folder)
+if __name__ == '__main__':
+    main()'''
+    script_text = '\n\n'.join([CONSOLIDATE_IMPORTS] + consts + funs + [fire_bit])
+    job_name = job_config['job_name']
+    data_dir = job_config['data_dir_at_CCV']
+    scratch_dir = job_config['scratch_dir_at_CCV']
+    sbatch = '''#!/bin/bash
+#SBATCH -n 1
+#SBATCH --mem={memInGB}GB
+#SBATCH -t {walltime}
+
+#SBATCH -o {job_name}-consolidate.out
+#SBATCH -e {job_name}-consolidate.out
+
+cd {data_dir}
+{python} {data_dir}/{job_name}-consolidate.py {scratch_dir} {scratch_dir}/{job_name}-all.h5 --compression={compression} --remove
+
+'''.format(memInGB = job_config['memInGB'],
+    walltime = job_config.get('walltime', WALLTIME),
+    job_name = job_name,
+    python = python,
+    compression = job_config.get('consolidate_compression'),
+    data_dir = data_dir,
+    scratch_dir = scratch_dir)
+    return script_text, sbatch
+
+def submit_sbatch(sbatch_fname, data_dir, username='jlizaraz', dependency=None,
+                  hostname=HOSTNAME, setup=SETUP):
+    '''
+    Submit an sbatch script that is already at CCV.
+
+    Parameters
+    ----------
+    sbatch_fname (str): name of the sbatch script in data_dir
+    data_dir (str): the folder at CCV where the job is run from
+    username (str): username at CCV
+    dependency (str): if given, passed on as --dependency, e.g.
+    afterany:12345
+    hostname (str): the host where sbatch is run
+    setup (list): commands run before sbatch, e.g. to load
+    modules
+
+    Returns
+    -------
+    (cmds, result, job_id) (list, CommandResult, str): the
+    commands that were executed, their outcome, and the id of
+    the submitted job (None if submission failed)
+    '''
+    sbatch_cmd = 'sbatch '
+    if dependency is not None:
+        sbatch_cmd += '--dependency=%s ' % dependency
+    cmds = list(setup) + ['cd',
+    'cd %s' % data_dir,
+    sbatch_cmd + sbatch_fname]
+    # the commands need a login shell for module and conda to
+    # be available, and they all share it
+    result = run_command("bash -l -c '%s'" % '\n'.join(cmds), username=username,
+                         hostname=hostname)
+    job_id = re.search(r'Submitted batch job (\d+)', result.stdout)
+    if job_id is not None:
+        job_id = job_id.group(1)
+    return cmds, result, job_id
+
+def params_key(params):
+    '''
+    The key under which the results for some input parameters
+    are kept in the result cache.
+
+    Parameters
+    ----------
+    params (tuple or np.array): the input parameters
+
+    Returns
+    -------
+    key (str): a hex digest
+    '''
+    params = tuple(np.asarray(params).ravel().tolist())
+    return hashlib.sha256(repr(params).encode()).hexdigest()
+
+def cached_result_path(fun_hash, params, cache_dir=RESULT_CACHE):
+    '''
+    Where the result of a function for some input parameters is
+    (or would be) in the result cache.
+
+    Parameters
+    ----------
+    fun_hash (str): digest of the function, see run_at_ccv
+    params (tuple or np.array): the input parameters
+    cache_dir (str): the folder of the cache
+
+    Returns
+    -------
+    path (str): path of the .h5 file of that result
+    '''
+    key = params_key(params)
+    return os.path.join(cache_dir, fun_hash, key[:2], key + '.h5')
+
+def cache_results(fun_hash, fnames, cache_dir=RESULT_CACHE):
+    '''
+    Add the results in some .h5 files (per-index or consolidated)
+    to the result cache, each one is kept as an .h5 file with in
+    and out datasets. Results already there are left alone.
+
+    Parameters
+    ----------
+    fun_hash (str): digest of the function that gave the results
+    fnames (list): paths of the .h5 files with the results
+    cache_dir (str): the folder of the cache
+
+    Returns
+    -------
+    num_added (int): how many results were added
+    '''
+    num_added = 0
+    for fname in fnames:
+        # look at the inputs first, to only read the outputs that
+        # are not in the cache yet
+        missing = set()
+        for index, params, _ in iter_h5_entries(fname, read_out=False):
+            if not os.path.exists(cached_result_path(fun_hash, params, cache_dir)):
+                missing.add(index)
+        if len(missing) == 0:
+            continue
+        for index, params, out in iter_h5_entries(fname):
+            path = cached_result_path(fun_hash, params, cache_dir)
+            if index not in missing or os.path.exists(path):
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with h5py.File(path + '.tmp', 'w') as f:
+                f.create_dataset('out', data=out, compression='gzip')
+                f.create_dataset('in', data=params)
+            os.replace(path + '.tmp', path)
+            num_added += 1
+    return num_added
+
+def fetch_cached_results(fun_hash, params_fun, numJobs, mac_folder, cache_dir=RESULT_CACHE):
+    '''
+    Look for the results of a sweep in the result cache, and copy
+    the ones that are there to mac_folder as per-index files, just
+    as if they had been computed at CCV and pulled from there.
+    They are also marked as ingested for iter_ccv_values.
+
+    Parameters
+    ----------
+    fun_hash (str): digest of the function, see run_at_ccv
+    params_fun (function): maps a job index to its parameters
+    numJobs (int): how many job indices there are
+    mac_folder (str): where the results are copied to
+    cache_dir (str): the folder of the cache
+
+    Returns
+    -------
+    cached (list): the job indices that were found in the cache
+    '''
+    cached = []
+    for index in range(numJobs):
+        path = cached_result_path(fun_hash, params_fun(index), cache_dir)
+        if os.path.exists(path):
+            os.makedirs(mac_folder, exist_ok=True)
+            shutil.copyfile(path, os.path.join(mac_folder, '%d.h5' % index))
+            # the modification time says when a result was last used
+            os.utime(path)
+            cached.append(index)
+    if len(cached) > 0:
+        manifest_fname = os.path.join(mac_folder, MANIFEST)
+        manifest = {'files': {}, 'indices': []}
+        if os.path.exists(manifest_fname):
+            with open(manifest_fname, 'r') as f:
+                manifest = json.load(f)
+        manifest['indices'] = sorted(set(manifest['indices']) | set(cached))
+        with open(manifest_fname, 'w') as f:
+            json.dump(manifest, f)
+    return cached
+
+def prune_result_cache(max_bytes=None, max_age_days=None, cache_dir=RESULT_CACHE):
+    '''
+    Evict results from the result cache. First those that have not
+    been used for more than max_age_days are removed, then the
+    least recently used ones until the cache takes at most
+    max_bytes.
+
+    Parameters
+    ----------
+    max_bytes (int): size budget of the cache, None for no limit
+    max_age_days (float): age limit of the results, None for no
+    limit
+    cache_dir (str): the folder of the cache
+
+    Returns
+    -------
+    (num_removed, bytes_freed) (int, int)
+    '''
+    entries = []
+    for root, _, files in os.walk(cache_dir):
+        for fname in files:
+            path = os.path.join(root, fname)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+    entries.sort()
+    total = sum(entry[1] for entry in entries)
+    now = time.time()
+    num_removed, bytes_freed = 0, 0
+    for mtime, size, path in entries:
+        too_old = (max_age_days is not None) and (now - mtime > max_age_days * 86400)
+        too_big = (max_bytes is not None) and (total - bytes_freed > max_bytes)
+        if not (too_old or too_big):
+            continue
+        os.remove(path)
+        num_removed += 1
+        bytes_freed += size
+    for root, dirs, files in os.walk(cache_dir, topdown=False):
+        if root != cache_dir and len(os.listdir(root)) == 0:
+            os.rmdir(root)
+    return num_removed, bytes_freed
+
+class SlurmBackend():
+    '''
+    Runs jobs as Slurm array jobs on a cluster reached over SSH,
+    CCV by default. Files are moved over the pooled SSH session
+    of username@hostname (see get_session), and jobs are sent
+    with sbatch and followed with sacct.
+
+    Parameters
+    ----------
+    username (str): the username at the cluster
+    hostname (str): the host to connect to
+    python (str): the python that runs the scripts
+    setup (list): commands run in the login shell before sbatch
+    data_root (str): the folder with the data folders of the
+    jobs, {username} is replaced by the username
+    scratch_root (str): the same for the scratch folders
+    '''
+    name = 'slurm'
+
+    def __init__(self, username='jlizaraz', hostname=HOSTNAME, python=PYTHON, setup=SETUP,
+                 data_root='/users/{username}/data/{username}',
+                 scratch_root='/users/{username}/scratch'):
+        self.username = username
+        self.hostname = hostname
+        self.python = python
+        self.setup = setup
+        self.data_root = data_root.format(username=username)
+        self.scratch_root = scratch_root.format(username=username)
+
+    def folders(self, job_name):
+        '''
+        The data and scratch folders of a job at the cluster.
+        '''
+        return ('%s/%s' % (self.data_root, job_name),
+                '%s/%s' % (self.scratch_root, job_name))
+
+    def run(self, command, timeout=None):
+        '''
+        Run a command at the cluster, see run_command.
+        '''
+        return run_command(command, username=self.username, hostname=self.hostname,
+                           timeout=timeout)
+
+    def makedirs(self, *folders):
+        '''
+        Create folders at the cluster, with their parents.
+        '''
+        return self.run('mkdir -p %s' % ' '.join(map(shlex.quote, folders)))
+
+    def listdir(self, folder):
+        '''
+        The names of the files in a folder at the cluster.
+        '''
+        session = get_session(self.username, self.hostname)
+        return [attr.filename for attr in session.listdir_attr(folder)]
+
+    def upload(self, filenames, folder, verbose=False):
+        '''
+        Send local files to a folder at the cluster, see
+        upload_bundle.
+        '''
+        return upload_bundle(filenames, folder, username=self.username,
+                             transferhost=self.hostname, verbose=verbose)
+
+    def fetch(self, remote_folder, local_folder):
+        '''
+        Sync a folder at the cluster to a local folder.
+        '''
+        return pull_from_ccv_to_mac(remote_folder, local_folder,
+                                    username=self.username, hostname=self.hostname)
+
+    def submit(self, sbatch_fname, folder, dependency=None):
+        '''
+        Submit an sbatch script that is already in folder, see
+        submit_sbatch.
+        '''
+        return submit_sbatch(sbatch_fname, folder, username=self.username,
+                             dependency=dependency, hostname=self.hostname,
+                             setup=self.setup)
+
+    def states(self, job_id):
+        '''
+        The state of every task of an array job, see job_states.
+        '''
+        return job_states(job_id, username=self.username, hostname=self.hostname)
+
+class LocalBackend():
+    '''
+    Runs jobs on this machine as if it were the cluster. The
+    sbatch scripts that are composed for Slurm are run with bash,
+    once for every task of the array (with SLURM_ARRAY_TASK_ID
+    and friends set), by a pool of worker processes shared by all
+    local jobs. Dependencies between jobs are honored. The data
+    and scratch folders are by default the same local folders
+    where results are pulled to, so that nothing needs to be
+    moved. Small sweeps finish without waiting in the queue, and
+    the whole pipeline can be tried offline.
+
+    Parameters
+    ----------
+    root (str): the folder with the data and scratch folders, by
+    default ~/ccv
+    max_workers (int): how many tasks run at a time, LOCAL_WORKERS
+    by default. The pool is created by the first local job, and
+    later jobs share it.
+    '''
+    name = 'local'
+
+    def __init__(self, root=None, max_workers=None):
+        self.root = os.path.join(os.path.expanduser('~'), 'ccv') if root is None else root
+        self.max_workers = LOCAL_WORKERS if max_workers is None else max_workers
+        self.python = sys.executable
+
+    def folders(self, job_name):
+        '''
+        The data and scratch folders of a job.
+        '''
+        return (os.path.join(self.root, 'data', job_name),
+                os.path.join(self.root, 'scratch', job_name))
+
+    def run(self, command, timeout=None):
+        '''
+        Run a shell command here.
+        '''
+        process = subprocess.run(command, shell=True, capture_output=True, text=True,
+                                 timeout=timeout)
+        return CommandResult(process.stdout, process.stderr, process.returncode)
+
+    def makedirs(self, *folders):
+        '''
+        Create folders, with their parents.
+        '''
+        for folder in folders:
+            os.makedirs(folder, exist_ok=True)
+        return CommandResult('', '', 0)
+
+    def listdir(self, folder):
+        '''
+        The names of the files in a folder.
+        '''
+        return os.listdir(folder) if os.path.isdir(folder) else []
+
+    def upload(self, filenames, folder, verbose=False):
+        '''
+        Copy files into a folder, leaving alone those that are
+        already there with the same contents.
+        '''
+        uploaded, skipped = [], []
+        for fname in dict.fromkeys(filenames):
+            target = os.path.join(folder, os.path.split(fname)[-1])
+            if (os.path.exists(target)
+                    and (os.path.samefile(fname, target)
+                         or file_digest(fname) == file_digest(target))):
+                skipped.append(fname)
+                continue
+            if verbose:
+                print('cp %s %s' % (fname, target))
+            shutil.copyfile(fname, target)
+            uploaded.append(fname)
+        return {'uploaded': uploaded, 'skipped': skipped}
+
+    def fetch(self, remote_folder, local_folder):
+        '''
+        Copy the files of a folder that are new or have changed to
+        another folder, nothing is done if they are the same.
+        '''
+        os.makedirs(local_folder, exist_ok=True)
+        if not os.path.isdir(remote_folder) or os.path.samefile(remote_folder, local_folder):
+            return ''
+        copied = []
+        for fname in os.listdir(remote_folder):
+            source = os.path.join(remote_folder, fname)
+            target = os.path.join(local_folder, fname)
+            if os.path.isfile(source) and (not os.path.exists(target)
+                                           or os.path.getmtime(target) < os.path.getmtime(source)):
+                shutil.copy2(source, target)
+                copied.append(fname)
+        return '\n'.join(copied)
+
+    def submit(self, sbatch_fname, folder, dependency=None):
+        '''
+        Start running an sbatch script that is in folder, in the
+        background. Its array spec and output file are read from
+        the #SBATCH lines, and the dependency can be of the kinds
+        afterany, afterok and aftercorr.
+
+        Returns
+        -------
+        (cmds, result, job_id) (list, CommandResult, str): as for
+        submit_sbatch, job ids look like local-3
+        '''
+        path = os.path.join(folder, sbatch_fname)
+        with open(path, 'r') as f:
+            sbatch = f.read()
+        array_spec = re.search(r'#SBATCH --array=(\S+)', sbatch)
+        task_ids = [None] if array_spec is None else expand_array_spec(array_spec.group(1))
+        output = re.search(r'#SBATCH -o (\S+)', sbatch)
+        output = 'slurm-%j.out' if output is None else output.group(1)
+        job_id = 'local-%d' % next(_local_ids)
+        with _local_lock:
+            _local_jobs[job_id] = {'states': {task_id: 'PENDING' for task_id in task_ids},
+                                   'queued': threading.Event(),
+                                   'done': threading.Event()}
+        thread = threading.Thread(target=self._run_job, daemon=True,
+                                  args=(job_id, path, folder, output, dependency))
+        thread.start()
+        result = CommandResult('Submitted batch job %s\n' % job_id, '', 0)
+        return ['bash %s' % sbatch_fname], result, job_id
+
+    def _run_job(self, job_id, path, folder, output, dependency):
+        '''
+        Wait for the dependencies of a job and run its tasks.
+        '''
+        job = _local_jobs[job_id]
+        kind, dep_ids = None, []
+        if dependency is not None:
+            kind, _, dep_ids = dependency.partition(':')
+            dep_ids = [dep_id for dep_id in dep_ids.split(':') if dep_id in _local_jobs]
+        if kind == 'aftercorr':
+            # the tasks of the pool are run in order, so once those
+            # of the dependencies are queued these can't block them
+            for dep_id in dep_ids:
+                _local_jobs[dep_id]['queued'].wait()
+        else:
+            for dep_id in dep_ids:
+                _local_jobs[dep_id]['done'].wait()
+            if kind == 'afterok' and any(state not in FINISHED_STATES
+                                         for dep_id in dep_ids
+                                         for state in _local_jobs[dep_id]['states'].values()):
+                for task_id in job['states']:
+                    job['states'][task_id] = 'CANCELLED'
+                job['queued'].set()
+                job['done'].set()
+                return
+        pool = _local_pool(self.max_workers)
+        futures = [pool.submit(self._run_task, job_id, path, folder, output, task_id,
+                               dep_ids if kind == 'aftercorr' else [])
+                   for task_id in job['states']]
+        job['queued'].set()
+        for future in futures:
+            future.exception()
+        job['done'].set()
+
+    def _run_task(self, job_id, path, folder, output, task_id, corr_ids):
+        '''
+        Run one task of a job with bash. With corr_ids the task
+        waits for the tasks with the same id in those jobs, and it
+        is cancelled if any of them did not complete.
+        '''
+        job = _local_jobs[job_id]
+        for dep_id in corr_ids:
+            dep = _local_jobs[dep_id]
+            while dep['states'].get(task_id) in PENDING_STATES | RUNNING_STATES:
+                dep['done'].wait(0.1)
+            if dep['states'].get(task_id, 'COMPLETED') not in FINISHED_STATES:
+                job['states'][task_id] = 'CANCELLED'
+                return
+        job['states'][task_id] = 'RUNNING'
+        env = dict(os.environ, SLURM_JOB_ID=job_id, SLURM_CPUS_PER_TASK='1')
+        out_fname = output.replace('%j', job_id)
+        if task_id is not None:
+            env.update(SLURM_JOB_ID='%s_%d' % (job_id, task_id),
+                       SLURM_ARRAY_JOB_ID=job_id, SLURM_ARRAY_TASK_ID=str(task_id))
+            out_fname = out_fname.replace('%a', str(task_id)).replace('%A', job_id)
+        try:
+            with open(os.path.join(folder, out_fname), 'w') as f:
+                exit_status = subprocess.call(['bash', path], cwd=folder, env=env,
+                                              stdout=f, stderr=subprocess.STDOUT)
+        except OSError:
+            exit_status = -1
+        job['states'][task_id] = 'COMPLETED' if exit_status == 0 else 'FAILED'
+
+    def states(self, job_id):
+        '''
+        The state of every task of a local array job, with Slurm
+        names (PENDING, RUNNING, COMPLETED, FAILED, CANCELLED).
+        '''
+        job = _local_jobs.get(job_id, {'states': {}})
+        return {task_id: state for task_id, state in dict(job['states']).items()
+                if task_id is not None}
+
+# the jobs of the local backend, by job id, with the state of each
+# of their tasks, and the pool of processes that runs them
+_local_jobs = {}
+_local_ids = itertools.count(1)
+_local_lock = threading.Lock()
+_local_executor = None
+
+def _local_pool(max_workers):
+    '''
+    The pool that runs the tasks of local jobs, it is created on
+    first use.
+    '''
+    global _local_executor
+    with _local_lock:
+        if _local_executor is None:
+            _local_executor = ThreadPoolExecutor(max_workers=max_workers,
+                                                 thread_name_prefix='zzb-local')
+        return _local_executor
+
+def get_backend(job_config, script_hash=None):
+    '''
+    The backend that runs a job, as given by the backend key of
+    its job_config:
+        slurm (default): a SlurmBackend for the username of the
+        job_config at hostname (HOSTNAME by default), with the
+        python, setup, data_root and scratch_root of the
+        job_config if given
+        local: a LocalBackend with the local_root and
+        local_workers of the job_config if given
+        auto: local if numJobs * task_seconds (the estimated
+        runtime of a job index, see size_resources) split over
+        LOCAL_WORKERS takes at most LOCAL_SECONDS, slurm if not
+        or if task_seconds is not known. If the job_config has
+        no task_seconds it is taken from the resource profile
+        of the script, if it was measured before.
+
+    Parameters
+    ----------
+    job_config (dict): as given to run_at_ccv
+    script_hash (str): sha256 of the script that would run at
+    the cluster, to find its resource profile
+
+    Returns
+    -------
+    backend (SlurmBackend or LocalBackend)
+    '''
+    name = job_config.get('backend', 'slurm')
+    if name == 'auto':
+        local_workers = job_config.get('local_workers', LOCAL_WORKERS)
+        task_seconds = job_config.get('task_seconds')
+        if task_seconds is None and script_hash is not None:
+            estimate = load_resource_profile(script_hash)
+            task_seconds = None if estimate is None else estimate['task_seconds']
+        if task_seconds is not None and (job_config['numJobs'] * task_seconds
+                                         / local_workers <= LOCAL_SECONDS):
+            name = 'local'
+        else:
+            name = 'slurm'
+    if name == 'local':
+        return LocalBackend(job_config.get('local_root'), job_config.get('local_workers'))
+    if name == 'slurm':
+        kwargs = {key: job_config[key] for key in ['python', 'setup', 'data_root', 'scratch_root']
+                  if key in job_config}
+        return SlurmBackend(job_config.get('username', 'jlizaraz'),
+                            job_config.get('hostname', HOSTNAME), **kwargs)
+    raise ValueError('Unknown backend %s.' % name)
+
+def run_at_ccv(job_config, verbose=False, closeSSH=False):
+    '''
+    Send a grid job to CCV.
+
+    Parameters
+    ----------
+    job_config   (dict):   with   at  least  the
+    following keys:
+        > username (str): the username at CCV.
+        >   numCores   (int):   how  many  cores
+        required for each job.
+        >  numJobs  (int):  how  many evaluation
+        points will be run.
+        >   memInGB   (int):   how  much  memory
+        required for each job.
+        >  import_block  (str): the import block
+        of the script to be run.
+        >  extra_py  (list):  list  of  paths to
+        extra python files to be uploaded.
+        > theglobals (dict): the dictionary with
+        the global variables.
+        >   fun_name  (str):  the  name  of  the
+        function to be run at CCV.
+        > job_name (str): the name of the job.
+        and optionally:
+        > prune (bool): if True (default) only
+        the functions and constants reachable
+        from fun_name are shipped, otherwise all
+        the functions in theglobals are.
+        > chunk_size (int): how many evaluation
+        points each array task runs, 1 if not
+        given.
+        > target_walltime, task_seconds (float):
+        if chunk_size is not given it is chosen
+        so that each array task takes about
+        target_walltime seconds when each point
+        takes task_seconds.
+        > strided (bool): if True each array task
+        runs a strided set of points, otherwise
+        a contiguous block.
+        > pool (bool): if True each array task
+        gets numCores cores and runs its points
+        with a pool of worker processes.
+        > blas_threads (int): with pool, how many
+        BLAS threads each worker uses (1 by
+        default), there are numCores/blas_threads
+        workers.
+        > consolidate (bool): if True, once the
+        array job is over a second job merges
+        all the results at CCV into a single
+        {job_name}-all.h5 file in the scratch
+        folder (see consolidate_h5), removing
+        the per-index files.
+        > consolidate_compression (str): the
+        compression of the consolidated file,
+        e.g. gzip. None by default, which lets
+        H5Results memory-map the outputs.
+        > memoize (bool): if True, results that
+        were already computed (by this same
+        function, with the same inputs) in an
+        earlier sweep are taken from the result
+        cache (RESULT_CACHE) and only the rest
+        is sent. The inputs of each job index
+        are those given by params_fun.
+        > params_fun (str): name of the function
+        that maps a job index to its inputs,
+        input_params by default.
+        > pilot (int): if given, this many job
+        indices (spread over the grid) are first
+        run as a pilot, and the walltime, memInGB
+        and chunk_size (unless given) of the job
+        are set from the runtime and memory that
+        they took (see size_resources). The
+        measurement is kept for later runs of the
+        same script, which then skip the pilot.
+        > pilot_timeout (float): the longest time
+        in seconds to wait for the pilot.
+        > size_margin (float): factor over the
+        measured runtime and memory, SIZE_MARGIN
+        by default.
+        > instrument (bool): if True (default)
+        the script records the wall and cpu time,
+        peak memory, import time, host and Slurm
+        ids of every job index in the zzb_stats
+        folder of the scratch folder at CCV, see
+        task_stats and task_report.
+        > backend (str): where the job is run,
+        slurm (default) for CCV (or another
+        Slurm cluster, see SlurmBackend and the
+        hostname, python, setup, data_root and
+        scratch_root keys), local to run it on
+        this machine (see LocalBackend and the
+        local_root and local_workers keys), or
+        auto to run it locally if it is small
+        enough (see get_backend). Locally, pilot
+        and pool are ignored and, unless a
+        chunk_size is given, each worker runs a
+        strided share of the indices.
+        > walltime (str): the time limit of each
+        array task, 1:00:00 if not given.
+        > strict (bool): if True and pruning
+        finds names that cannot be resolved a
+        NameError is raised, by default just a
+        warning is printed.
+    verbose  (bool):  if True some debug mesages
+    are printed
+    closeSSH   (bool):  if  True  then  the  SSH
+    session is closed at the end
+
+    Returns
+    -------
+    job_config   (dict)   with   the   following
+    additional keys
+        > backend (str): slurm or local, where the
+        job was sent
+        > data_dir_at_CCV (str): the path to the
+        data folder at CCV
+        >  scratch_dir_at_CCV (str): the path to
+        the scratch folder at CCV
+        > data_dir_at_mac (str): the path to the
+        data folder at the mac
+        >  scratch_dir_at_mac (str): the path to
+        the scratch folder at the mac
+        > chunk_size (int): points per task
+        > num_tasks (int): how many array tasks
+        were submitted
+        >  sbatch  (str): the text of the sbatch
+        script
+        >   ccv_sbatch_cmds   (list):  with  the
+        commands  that  were executed to run the
+        batch job
+        > ccv_sbatch_cmd_outputs (CommandResult):
+        stdout, stderr and exit status of them
+        > job_id (str): the Slurm id of the job,
+        None if nothing was left to send
+        > fun_hash (str): with memoize, digest of
+        the source of the function and of all
+        that it needs, this keys the cache
+        > cached_indices (list): with memoize,
+        the job indices taken from the cache
+        > index_list (list): with memoize or
+        pilot, the job indices that were sent, if
+        not all
+        > pilot_job_id (str): the id of the pilot
+        job, if there was one
+        > pilot_indices (list): the job indices
+        that the pilot computed
+        > resource_estimate (dict): with pilot,
+        the runtime and memory measured for each
+        job index (see estimate_resources)
+        > consolidate_job_id (str): the id of the
+        consolidation job, if there is one
+        >  script_text  (str):  the  text of the
+        uploaded script
+        > script_hash (str): sha256 of the script
+        text, a copy of the script is kept under
+        this name in SCRIPT_CACHE
+        > script_cache_path (str): the path of
+        that copy
+        > unresolved (dict): names used by the
+        shipped code that could not be resolved
+        > upload_summary (dict): which files had
+        to be uploaded and which were unchanged
+        >   (theglobals   is  deleted  from  the
+        job_config dictionary)
+
+    '''
+    theglobals = job_config['theglobals']
+    del job_config['theglobals']
+    numJobs  = job_config['numJobs']
+    job_name = job_config['job_name']
+    importblock = job_config['import_block']
+    extra_py = job_config['extra_py']
+    special_func = job_config['fun_name']
+    fire_bit = compose_runner(special_func)
+
+    if job_config.get('prune', True):
+        # only ship what the target function can reach
+        funs, consts, unresolved = get_needed_fun(theglobals, special_func,
+                                                  import_block=importblock,
+                                                  provided=['data_dir', 'scratch_dir'])
+        funs = consts + funs
+        job_config['unresolved'] = unresolved
+        if len(unresolved) > 0:
+            msg = '\n'.join('  %s: %s' % (k, v) for k, v in unresolved.items())
+            if job_config.get('strict', False):
+                raise NameError('Unresolved names in %s:\n%s' % (special_func, msg))
+            print('Warning, unresolved names in %s:\n%s' % (special_func, msg))
+    else:
+        funs = get_all_fun(theglobals)
+
+    def compose_script(data_dir, scratch_dir):
+        zzbar_dict = {'data_dir':data_dir, 'scratch_dir':scratch_dir}
+        zzbars = []
+        for k, v in zzbar_dict.items():
+            if isinstance(v, str):
+                zzbars.append('%s = \'%s\'' % (k,v))
+            else:
+                zzbars.append('%s = %s' % (k,v))
+        zzvars = '\n'.join(zzbars)
+        pieces = [PRELUDE, importblock] + [zzvars] + funs + [fire_bit]
+        return '\n\n'.join(pieces)
+
+    script_hash = None
+    if job_config.get('backend') == 'auto' and 'task_seconds' not in job_config:
+        # the resource profiles are measured at the cluster, so they
+        # are found by the hash of the script that would run there
+        slurm = get_backend(dict(job_config, backend='slurm'))
+        script_hash = hashlib.sha256(compose_script(*slurm.folders(job_name)).encode()).hexdigest()
+    backend = get_backend(job_config, script_hash=script_hash)
+    job_config['backend'] = backend.name
+    data_dir, scratch_dir = backend.folders(job_name)
+    job_config['data_dir_at_CCV'] = data_dir
+    job_config['scratch_dir_at_CCV'] = scratch_dir
+    home_dir = os.path.expanduser('~')
+    data_dir_at_mac = os.path.join(home_dir, 'ccv', 'data', job_name)
+    scratch_dir_at_mac = os.path.join(home_dir, 'ccv', 'scratch', job_name)
+    job_config['data_dir_at_mac'] = data_dir_at_mac
+    job_config['scratch_dir_at_mac'] = scratch_dir_at_mac
+
+    script_text = compose_script(data_dir, scratch_dir)
+    job_config['script_text'] = script_text
+    script_hash, cache_path = cache_script(script_text)
+    job_config['script_hash'] = script_hash
+    job_config['script_cache_path'] = cache_path
+
+    index_list = None
+    if job_config.get('memoize', False):
+        # the function is identified by its dependency-closed source
+        fun_hash = hashlib.sha256('\n\n'.join([importblock] + funs).encode()).hexdigest()
+        job_config['fun_hash'] = fun_hash
+        params_fun = theglobals[job_config.get('params_fun', 'input_params')]
+        cached = fetch_cached_results(fun_hash, params_fun, numJobs, scratch_dir_at_mac)
+        job_config['cached_indices'] = cached
+        print("Found %d of %d results in the cache ..." % (len(cached), numJobs))
+        if len(cached) == numJobs:
+            job_config['job_id'] = None
+            return job_config
+        if len(cached) > 0:
+            index_list = sorted(set(range(numJobs)) - set(cached))
+            job_config['index_list'] = index_list
+
+    if backend.name == 'local':
+        print("Running locally ...")
+        if 'chunk_size' not in job_config:
+            # one task per worker, with the indices strided so
+            # that slow corners of the grid are shared out
+            num_points = numJobs if index_list is None else len(index_list)
+            job_config['chunk_size'] = math.ceil(num_points / backend.max_workers)
+            job_config['strided'] = True
+    else:
+        print("Establishing an SSH connection to CCV ...")
+
+    # make sure that the relevant folders are created
+    backend.makedirs(data_dir, scratch_dir)
+
+    script_fname = job_name + '.py'
+    if os.path.exists(script_fname) and file_digest(script_fname) == script_hash:
+        print("Python script is unchanged ...")
+    else:
+        print("Saving Python script to file ...")
+        with open(script_fname, 'w') as f:
+            f.write(script_text)
+
+    # the script and the extra files, the sbatch script is added
+    # below. If the script is already at CCV (same digest) it is
+    # not uploaded again.
+    bundle = [script_fname]
+    for extrap in extra_py:
+        if '.py' not in extrap:
+            extrap = extrap + '.py'
+        bundle.append(extrap)
+
+    if job_config.get('pilot') and backend.name == 'slurm':
+        estimate = load_resource_profile(script_hash)
+        if estimate is not None:
+            print("Sizing the job from an earlier measurement of this script ...")
+        else:
+            points = list(range(numJobs)) if index_list is None else index_list
+            estimate, pilot_config = run_pilot(job_config, points, bundle,
+                                               timeout=job_config.get('pilot_timeout'),
+                                               verbose=verbose)
+            job_config['pilot_job_id'] = pilot_config['job_id']
+            if estimate is not None:
+                estimate['script_hash'] = script_hash
+                save_resource_profile(script_hash, estimate)
+                # what the pilot already computed is not sent again
+                piloted = pilot_config['tracking']['finished']
+                job_config['pilot_indices'] = piloted
+                index_list = sorted(set(points) - set(piloted))
+                job_config['index_list'] = index_list
+                if len(index_list) == 0:
+                    job_config['job_id'] = None
+                    if closeSSH:
+                        close_session(backend.username, backend.hostname)
+                    return job_config
+        if estimate is not None:
+            job_config['resource_estimate'] = estimate
+            size_resources(job_config, estimate, job_config.get('size_margin', SIZE_MARGIN))
+            print("Each job index takes about %.0f s, using chunk_size=%d, -t %s and %d GB ..."
+                  % (estimate['task_seconds'], job_config['chunk_size'],
+                     job_config['walltime'], job_config['memInGB']))
+
+    print("Composing the sbatch script ...")
+
+    num_points = numJobs if index_list is None else len(index_list)
+    chunk_size, num_tasks = plan_chunks(job_config, num_points)
+    job_config['chunk_size'] = chunk_size
+    job_config['num_tasks'] = num_tasks
+    index_path = None
+    if index_list is not None:
+        index_fname = write_index_file('%s-indices.txt' % job_name, index_list)
+        index_path = '%s/%s' % (data_dir, index_fname)
+    script_args = runner_args(job_config, num_points, index_path, backend.name)
+    sbatch = compose_sbatch(job_config, '0-%d' % (num_tasks - 1), script_args,
+                            python=backend.python)
+    job_config['sbatch'] = sbatch
+    sbatch_fname = '%s-batch.sh' % job_name
+    print("Writing sbatch script ...")
+    open(sbatch_fname,'w').write(sbatch)
+
+    # upload the script, the extra files and the sbatch script
+    # all at once
+    print("Uploading files to CCV ...")
+    bundle.append(sbatch_fname)
+    if index_list is not None:
+        bundle.append(index_fname)
+    if job_config.get('consolidate', False):
+        consolidate_text, consolidate_sbatch = compose_consolidation(job_config,
+                                                                     python=backend.python)
+        consolidate_sbatch_fname = '%s-consolidate.sh' % job_name
+        with open('%s-consolidate.py' % job_name, 'w') as f:
+            f.write(consolidate_text)
+        with open(consolidate_sbatch_fname, 'w') as f:
+            f.write(consolidate_sbatch)
+        bundle += ['%s-consolidate.py' % job_name, consolidate_sbatch_fname]
+    job_config['upload_summary'] = backend.upload(bundle, data_dir, verbose=verbose)
+    ccv_sbatch_cmds, result, job_id = backend.submit(sbatch_fname, data_dir)
+    job_config['ccv_sbatch_cmds'] = ccv_sbatch_cmds
+    job_config['ccv_sbatch_cmd_outputs'] = result
+    job_config['job_id'] = job_id
+    if verbose:
+        print(result.stdout)
+        print(result.stderr)
+    if result.exit_status != 0:
+        print("sbatch failed:\n%s" % result.stderr)
+    elif job_config.get('consolidate', False):
+        print("Sending the consolidation job ...")
+        _, result, consolidate_id = backend.submit(consolidate_sbatch_fname, data_dir,
+                                                   dependency='afterany:%s' % job_id)
+        job_config['consolidate_job_id'] = consolidate_id
+        if result.exit_status != 0:
+            print("sbatch failed:\n%s" % result.stderr)
+    if closeSSH and backend.name == 'slurm':
+        close_session(backend.username, backend.hostname)
+    return job_config
+
+def execute_command(cmd):
+    '''
+    Execute a command in the local machine and return its output.
+
+    Parameters
+    ----------
+    cmd (str): a command, just like one would type on a terminal.
+
+    Returns
+    -------
+    stdout (str): the standard output of the command.
+    '''
+    process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = process.communicate()
+
+    if process.returncode != 0:
+        # An error occurred
+        raise Exception(stderr.decode())
+    else:
+        # Return command output
+        return stdout.decode()
+
+def myq(username='jlizaraz'):
+    '''
+    Returns the output of running the myq command at CCV.
+
+    Parameters
+    ----------
+    username (str): username at CCV
+
+    Returns
+    -------
     None
+    '''
+    qu = execute_at_ccv('myq', username=username)
+    qu = re.sub(r'\n\s*\n', '\n', qu)
+    return qu
+
+def pull_from_ccv_to_mac(ccv_folder, mac_folder, username='jlizaraz', hostname=HOSTNAME):
+    '''
+    All the files from ccv_folder will be synced to mac_folder.
+    None  of  the changes at the mac_folder will be reflected at
+    the ccv_folder.
+
+    Parameters
+    ----------
+    ccv_folder (str): path to a folder at CCV
+    mac_foler  (str): path to a folder at the mac
+    username (str): username at CCV
+    hostname (str): the host where the folder is
+
+    Returns
+    -------
+    rsync_out (str): the stdout of the rsync command
+    '''
+    if not os.path.exists(mac_folder):
+        print("Mac folder does not exist, creating ...")
+        os.mkdir(mac_folder)
+    if mac_folder[-1] != '/':
+        mac_folder += '/'
+    if ccv_folder[-1] != '/':
+        ccv_folder += '/'
+    rsync_cmd = 'rsync -avz {username}@{hostname}:{ccv_folder} {mac_folder}'.format(username=username, hostname=hostname, ccv_folder=ccv_folder, mac_folder=mac_folder)
+    rsync_out = execute_command(rsync_cmd)
+    return rsync_out
+
+class H5Results():
+    '''
+    Lazy access to the results stored in a bunch of .h5 files
+    (per-index or consolidated ones). On creation only a light
+    index is built, mapping each tuple of input parameters to
+    where its output is stored, and outputs are read when they
+    are asked for. Recently used outputs are kept in an LRU cache
+    that holds at most cache_bytes. Outputs in consolidated files
+    that are stored contiguously (compression=None) are memory-
+    mapped instead of read.
+
+    Calling it with the input parameters gives the output, or
+    None if it wasn't evaluated there, just like the function
+    returned by load_h5_data used to. The input_params attribute
+    has all the parameters for which there are results.
+
+    The parameters are also kept as a columnar table (the table
+    attribute, a structured array with one field per parameter)
+    with a sorted index over it, which allows for vectorized
+    lookups (locate, batch), slicing by some of the parameters
+    (select) and arranging the outputs in a dense array when the
+    parameters form a Cartesian product (grid).
+
+    Parameters
+    ----------
+    fnames (list): list of paths to the h5 files
+    cache_bytes (int): memory budget of the LRU cache
+    names (list): names for the input parameters, by default
+    they are called p0, p1, ...
+    '''
+    def __init__(self, fnames, cache_bytes=CACHE_BYTES, names=None):
+        self.cache_bytes = cache_bytes
+        self.cached_bytes = 0
+        self._cache = OrderedDict()
+        self._locs = {}
+        self._files = {}
+        self._layouts = {}
+        for fname in fnames:
+            if is_index_file(fname):
+                with h5py.File(fname, 'r') as f:
+                    self._locs[tuple(np.array(f['in']))] = (fname, None)
+                continue
+            f = h5py.File(fname, 'r')
+            if f.attrs.get('zzb_format') != CONSOLIDATED:
+                f.close()
+                continue
+            self._files[fname] = f
+            self._layouts[fname] = self._layout(fname, f)
+            for row, the_params in enumerate(f['in'][()]):
+                self._locs[tuple(the_params)] = (fname, row)
+        self.input_params = list(self._locs.keys())
+        self._build_index(names)
+
+    def _build_index(self, names):
+        '''
+        Build the parameter table and the sorted index over it,
+        the rows of the table sorted lexicographically (by the
+        first parameter, then the second one, ...).
+        '''
+        self._loc_list = [self._locs[key] for key in self.input_params]
+        if len(self.input_params) == 0:
+            params = np.empty((0, 0 if names is None else len(names)))
+        else:
+            params = np.array(self.input_params)
+            params = params.reshape(len(params), -1)
+        num_params = params.shape[1]
+        if names is None:
+            names = ['p%d' % i for i in range(num_params)]
+        if len(names) != num_params:
+            raise ValueError('Got %d names for %d parameters.' % (len(names), num_params))
+        self.names = list(names)
+        self.table = np.empty(len(params), dtype=[(name, params.dtype) for name in self.names])
+        for i, name in enumerate(self.names):
+            self.table[name] = params[:, i]
+        self._params = params
+        self._order = np.lexsort(params.T[::-1]) if num_params else np.arange(len(params))
+        self._sorted_params = params[self._order]
+
+    @staticmethod
+    def _rows_less(rows_a, rows_b):
+        '''
+        Whether each row of rows_a comes before the same row of
+        rows_b in lexicographic order.
+        '''
+        differ = rows_a != rows_b
+        first = np.argmax(differ, axis=1)
+        pick = np.arange(len(rows_a))
+        return differ.any(axis=1) & (rows_a[pick, first] < rows_b[pick, first])
+
+    def locate(self, params_array):
+        '''
+        Find the rows of the parameter table for many tuples of
+        input parameters at once.
+
+        Parameters
+        ----------
+        params_array (array): with one tuple of parameters per row
+
+        Returns
+        -------
+        rows (np.array): the rows in the parameter table (and in
+        input_params), -1 where there are no results
+        '''
+        query = np.asarray(params_array)
+        query = query.reshape(len(query), -1)
+        num_rows = len(self._sorted_params)
+        if num_rows == 0:
+            return -np.ones(len(query), dtype=np.int64)
+        # a binary search of all the queries at once, in the end
+        # low is the first row that doesn't come before the query
+        low = np.zeros(len(query), dtype=np.int64)
+        high = np.full(len(query), num_rows, dtype=np.int64)
+        while np.any(low < high):
+            active = low < high
+            mid = np.minimum((low + high) // 2, num_rows - 1)
+            before = self._rows_less(self._sorted_params[mid], query)
+            low = np.where(active & before, mid + 1, low)
+            high = np.where(active & ~before, mid, high)
+        pos = np.minimum(low, num_rows - 1)
+        found = np.all(self._sorted_params[pos] == query, axis=1)
+        return np.where(found, self._order[pos], -1)
+
+    def _fetch(self, rows):
+        '''
+        The outputs for the given rows of the parameter table. The
+        ones in consolidated files with a stacked layout are read
+        together with a single (fancy-indexed) read per file.
+        '''
+        outs = [None] * len(rows)
+        grouped = {}
+        for i, row in enumerate(rows):
+            fname, file_row = self._loc_list[row]
+            if (file_row is not None) and self._layouts[fname]['stacked']:
+                grouped.setdefault(fname, []).append((file_row, i))
+            else:
+                outs[i] = self(*self.input_params[row])
+        for fname, pairs in grouped.items():
+            file_rows = np.unique([file_row for file_row, _ in pairs])
+            data = self._layouts[fname]['out'][file_rows]
+            for file_row, i in pairs:
+                outs[i] = data[np.searchsorted(file_rows, file_row)]
+        return outs
+
+    @staticmethod
+    def _layout(fname, f):
+        '''
+        How the outputs of a consolidated file are to be read.
+        '''
+        out = f['out']
+        layout = {'stacked': f.attrs['layout'] == 'stacked', 'out': out}
+        if not layout['stacked']:
+            layout['offsets'] = f['out_offsets'][()]
+            layout['shapes'] = f['out_shapes'][()]
+        offset = out.id.get_offset()
+        if out.chunks is None and out.compression is None and offset is not None:
+            layout['out'] = np.memmap(fname, dtype=out.dtype, mode='r',
+                                      offset=offset, shape=out.shape)
+            layout['mapped'] = True
+        else:
+            layout['mapped'] = False
+        return layout
+
+    def _read(self, fname, row):
+        '''
+        Read the output stored in row of fname (None for a per-
+        index file).
+        '''
+        if row is None:
+            with h5py.File(fname, 'r') as f:
+                return np.array(f['out'])
+        layout = self._layouts[fname]
+        if layout['stacked']:
+            return layout['out'][row]
+        offsets = layout['offsets']
+        shape = tuple(int(d) for d in layout['shapes'][row] if d >= 0)
+        return layout['out'][offsets[row]:offsets[row+1]].reshape(shape)
+
+    def __call__(self, *params):
+        key = tuple(params)
+        if key not in self._locs:
+            return None
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        fname, row = self._locs[key]
+        out = self._read(fname, row)
+        if (row is not None) and self._layouts[fname]['mapped']:
+            # the OS already caches mapped pages
+            return out
+        out = np.asarray(out)
+        self._cache[key] = out
+        self.cached_bytes += out.nbytes
+        while self.cached_bytes > self.cache_bytes and len(self._cache) > 1:
+            _, old = self._cache.popitem(last=False)
+            self.cached_bytes -= old.nbytes
+        return out
+
+    def batch(self, params_list):
+        '''
+        Get the outputs for many input parameters at once.
+
+        Parameters
+        ----------
+        params_list (array): with one tuple of input parameters
+        per row
+
+        Returns
+        -------
+        outs (np.array): the outputs stacked along a first axis
+        '''
+        rows = self.locate(params_list)
+        if np.any(rows < 0):
+            missing = np.asarray(params_list)[rows < 0]
+            raise KeyError('No results for %s.' % missing.tolist())
+        return np.stack(self._fetch(rows))
+
+    def _mask(self, fixed):
+        '''
+        Which rows of the parameter table have the given values of
+        some of the parameters.
+        '''
+        mask = np.ones(len(self.table), dtype=bool)
+        for name, value in fixed.items():
+            if name not in self.names:
+                raise KeyError('There is no parameter called %s.' % name)
+            mask &= (self.table[name] == value)
+        return mask
+
+    def select(self, **fixed):
+        '''
+        Get all the results with the given values of some of the
+        parameters, e.g. select(p0=3) for all with p0 equal to 3.
+
+        Parameters
+        ----------
+        fixed: the values of the parameters to select by
+
+        Returns
+        -------
+        (params, outs) (np.array, np.array): the rows of the
+        parameter table that match and their stacked outputs
+        '''
+        rows = np.flatnonzero(self._mask(fixed))
+        if len(rows) == 0:
+            return self.table[rows], None
+        return self.table[rows], np.stack(self._fetch(rows))
+
+    def grid(self, **fixed):
+        '''
+        Arrange the outputs in a dense array over the grid of the
+        parameters, which only works if these (after fixing some
+        of them, as in select) form a Cartesian product.
+
+        Parameters
+        ----------
+        fixed: the values of the parameters that are held fixed
+
+        Returns
+        -------
+        (axes, outs) (dict, np.array): the values of each free
+        parameter along its axis, and an array of shape (number
+        of values of each free parameter) + (shape of outputs)
+        '''
+        rows = np.flatnonzero(self._mask(fixed))
+        free = [i for i, name in enumerate(self.names) if name not in fixed]
+        axes, codes = {}, []
+        for i in free:
+            values, code = np.unique(self._params[rows, i], return_inverse=True)
+            axes[self.names[i]] = values
+            codes.append(code.ravel())
+        dims = tuple(len(values) for values in axes.values())
+        # the product of python ints, which can't overflow
+        if len(rows) == 0 or len(rows) != int(np.prod(dims, dtype=object)):
+            raise ValueError('The parameters do not form a complete grid.')
+        keys = np.ravel_multi_index(codes, dims)
+        order = np.argsort(keys)
+        if np.any(keys[order] != np.arange(len(keys))):
+            raise ValueError('The parameters do not form a complete grid.')
+        outs = np.stack(self._fetch(rows[order]))
+        return axes, outs.reshape(dims + outs.shape[1:])
+
+    def __contains__(self, params):
+        return tuple(params) in self._locs
+
+    def __len__(self):
+        return len(self._locs)
+
+    def close(self):
+        '''
+        Close the files kept open and drop the cached outputs.
+        '''
+        self._layouts = {}
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+        self._cache = OrderedDict()
+        self.cached_bytes = 0
+
+def load_h5_data(fnames, cache_bytes=CACHE_BYTES, names=None):
+    '''
+    This  function takes the filenames from a bunch of .h5 files
+    and  creates  a  function  that  can  be used to explore the
+    return values for the corresponding inputs. Only an index of
+    the inputs is read here, outputs are read on demand (see
+    H5Results).
+
+    Parameters
+    ----------
+    fnames (list): list of paths to the h5 files, these can be
+    per-index files or consolidated ones (see consolidate_h5)
+    cache_bytes (int): how much memory can be used to keep the
+    recently used outputs
+    names (list): names for the input parameters, used to select
+    results by them, by default they are called p0, p1, ...
+
+    Returns
+    -------
+    ccv_fun (H5Results): callable that takes the input parameters
+    and returns the data, it has an attribute called input_params
+    that contains the input parameters that it is defined for,
+    and batch, select and grid methods to get many outputs
+    stacked together.
+    '''
+    return H5Results(fnames, cache_bytes=cache_bytes, names=names)
+
+class SharedResults(H5Results):
+    '''
+    The results of a sweep run by run_shared, held in a single
+    array (in shared memory, or memory-mapped from a file) with
+    one row per job index. It is looked up just like H5Results
+    (calling it with the input parameters, locate, batch, select,
+    grid) but there are no files to read, and calling it gives a
+    view of the array, not a copy.
+
+    Parameters
+    ----------
+    params (np.array): the input parameters of each job index,
+    one row per index
+    outs (np.array): the outputs, one row per job index
+    done (np.array): which job indices have a result
+    names (list): names for the input parameters, by default
+    they are called p0, p1, ...
+    shm (SharedMemory): the shared memory behind outs, if any, it
+    is freed by close
+    '''
+    def __init__(self, params, outs, done, names=None, shm=None):
+        self.cache_bytes = 0
+        self.cached_bytes = 0
+        self._cache = OrderedDict()
+        self._files = {}
+        self._layouts = {}
+        self._shm = shm
+        self.outs = outs
+        params = np.asarray(params)
+        params = params.reshape(len(params), -1)
+        self._locs = {tuple(params[i]): (None, i) for i in np.flatnonzero(done)}
+        self.input_params = list(self._locs.keys())
+        self.missing_indices = np.flatnonzero(~np.asarray(done)).tolist()
+        self._build_index(names)
+
+    def _fetch(self, rows):
+        return [self.outs[self._loc_list[row][1]] for row in rows]
+
+    def __call__(self, *params):
+        loc = self._locs.get(tuple(params))
+        if loc is None:
+            return None
+        return self.outs[loc[1]]
+
+    def close(self):
+        '''
+        Drop the array, freeing the shared memory if there is one.
+        Views of it that were handed out must not be used after.
+        '''
+        self.outs = None
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+# the function and the output array of run_shared, as seen by each
+# worker process
+_shared_fun = None
+_shared_outs = None
+_shared_shm = None
+
+def _attach_shared(fun, shm_name, mmap_fname, shape, dtype):
+    '''
+    Give a worker of run_shared the function and its view of the
+    output array. With forked workers these are inherited, not
+    pickled, so fun may be e.g. a lambda.
+    '''
+    global _shared_fun, _shared_outs, _shared_shm
+    _shared_fun = fun
+    if mmap_fname is not None:
+        _shared_outs = np.memmap(mmap_fname, dtype=dtype, mode='r+', shape=shape)
+    else:
+        from multiprocessing import shared_memory
+        # kept referenced so that the buffer stays mapped
+        _shared_shm = shared_memory.SharedMemory(name=shm_name)
+        _shared_outs = np.ndarray(shape, dtype=dtype, buffer=_shared_shm.buf)
+
+def _run_shared_chunk(indices):
+    '''
+    Run the function over some job indices in a worker of
+    run_shared, writing each output into its row of the output
+    array. Returns the indices that failed, with their errors.
+    '''
+    failed = []
+    for index in indices:
+        try:
+            _shared_outs[index] = _shared_fun(index)
+        except Exception as e:
+            failed.append((index, repr(e)))
+    return failed
+
+def run_shared(fun, numJobs, params_fun, max_workers=None, chunk_size=None, names=None,
+               mmap_fname=None):
+    '''
+    Run a sweep on this machine with a pool of worker processes
+    that write their outputs straight into a preallocated array,
+    with one row per job index, which is in shared memory (or in
+    a memory-mapped file, if mmap_fname is given). There are no
+    files per result and outputs are neither pickled nor copied
+    on their way back. The output of job index 0 is computed
+    first, here, to find the shape and dtype of the array, so
+    all outputs need to have the same shape.
+
+    Unlike the functions sent with run_at_ccv, which save their
+    own results, here fun returns the output of a job index.
+    Workers are forked where possible, so that fun is inherited
+    rather than pickled and functions defined in a notebook (even
+    lambdas) can be used.
+
+    Parameters
+    ----------
+    fun (function): maps a job index to its output
+    numJobs (int): how many job indices there are
+    params_fun (function): maps a job index to its input
+    parameters, these are what results are looked up by
+    max_workers (int): how many worker processes, LOCAL_WORKERS
+    by default
+    chunk_size (int): how many job indices each worker takes at
+    a time, by default so that each worker gets about four
+    chunks
+    names (list): names for the input parameters
+    mmap_fname (str): if given, the outputs are kept in this file,
+    which can be opened again with np.memmap
+
+    Returns
+    -------
+    results (SharedResults): with the same lookup interface as
+    the H5Results of load_h5_data. Its missing_indices and
+    errors attributes have the job indices that failed and what
+    went wrong with them.
+    '''
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    max_workers = LOCAL_WORKERS if max_workers is None else max_workers
+    params = np.array([params_fun(index) for index in range(numJobs)])
+    first = np.asarray(fun(0))
+    shape = (numJobs,) + first.shape
+    nbytes = max(1, int(np.prod(shape)) * first.dtype.itemsize)
+    shm = None
+    if mmap_fname is not None:
+        outs = np.memmap(mmap_fname, dtype=first.dtype, mode='w+', shape=shape)
+        shm_name = None
+    else:
+        from multiprocessing import shared_memory
+        shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        outs = np.ndarray(shape, dtype=first.dtype, buffer=shm.buf)
+        shm_name = shm.name
+    outs[0] = first
+    if chunk_size is None:
+        chunk_size = max(1, math.ceil((numJobs - 1) / (4 * max_workers)))
+    chunks = [range(start, min(start + chunk_size, numJobs))
+              for start in range(1, numJobs, chunk_size)]
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+    else:
+        context = multiprocessing.get_context()
+    errors = {}
+    if len(chunks) > 0:
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=context,
+                                 initializer=_attach_shared,
+                                 initargs=(fun, shm_name, mmap_fname, shape,
+                                           first.dtype)) as executor:
+            for failed in executor.map(_run_shared_chunk, chunks):
+                errors.update(failed)
+    if mmap_fname is not None:
+        outs.flush()
+    done = np.ones(numJobs, dtype=bool)
+    done[list(errors)] = False
+    results = SharedResults(params, outs, done, names=names, shm=shm)
+    results.errors = errors
+    if len(errors) > 0:
+        print('%d job indices failed.' % len(errors))
+    return results
+
+def completed_indices(fnames):
+    '''
+    Find which job indices have results in the given h5 files.
+
+    Parameters
+    ----------
+    fnames (list): paths to per-index or consolidated h5 files
+
+    Returns
+    -------
+    indices (set): the job indices that are done
+    '''
+    indices = set()
+    for fname in fnames:
+        if is_index_file(fname):
+            indices.add(int(os.path.split(fname)[-1][:-3]))
+        else:
+            with h5py.File(fname, 'r') as f:
+                if f.attrs.get('zzb_format') == CONSOLIDATED:
+                    indices.update(int(index) for index in f['index'][()])
+    return indices
+
+def expand_array_spec(spec):
+    '''
+    Expand a Slurm array spec into the ids that it has, e.g.
+    1,3,5-7 into [1, 3, 5, 6, 7]. Steps (0-10:2) and throttles
+    (0-99%10) are understood.
+
+    Parameters
+    ----------
+    spec (str): the array spec
+
+    Returns
+    -------
+    ids (list): the ids of the array tasks
+    '''
+    ids = []
+    spec = spec.strip('[]').split('%')[0]
+    for part in spec.split(','):
+        part, _, step = part.partition(':')
+        start, _, stop = part.partition('-')
+        stop = stop if stop else start
+        ids.extend(range(int(start), int(stop) + 1, int(step) if step else 1))
+    return ids
+
+def compress_array_spec(ids):
+    '''
+    Write a set of ids as a compact Slurm array spec, e.g.
+    [1, 3, 5, 6, 7] as 1,3,5-7.
+
+    Parameters
+    ----------
+    ids (iterable): the ids of the array tasks
+
+    Returns
+    -------
+    spec (str): the array spec
+    '''
+    ids = sorted(set(int(i) for i in ids))
+    parts = []
+    start = 0
+    for i in range(1, len(ids) + 1):
+        if i == len(ids) or ids[i] != ids[i-1] + 1:
+            if start == i - 1:
+                parts.append('%d' % ids[start])
+            else:
+                parts.append('%d-%d' % (ids[start], ids[i-1]))
+            start = i
+    return ','.join(parts)
+
+def job_states(job_id, username='jlizaraz', hostname=HOSTNAME):
+    '''
+    Get the state of every task of an array job at CCV, with a
+    single call to sacct.
+
+    Parameters
+    ----------
+    job_id (str): the id of the array job
+    username (str): username at CCV
+    hostname (str): the host where sacct is run
+
+    Returns
+    -------
+    states (dict): keys are the ids of the array tasks and values
+    their Slurm states (e.g. COMPLETED, RUNNING, OUT_OF_MEMORY),
+    tasks that sacct doesn't know about yet are left out
+    '''
+    cmd = 'sacct -j %s -X -n -P -o JobID,State' % job_id
+    result = run_command(cmd, username=username, hostname=hostname)
+    states = {}
+    for line in result.stdout.splitlines():
+        parts = line.strip().split('|')
+        if len(parts) < 2 or '_' not in parts[0]:
+            continue
+        # states look like CANCELLED by 1234
+        state = parts[1].split()[0] if parts[1].strip() else 'PENDING'
+        for task_id in expand_array_spec(parts[0].split('_', 1)[1]):
+            states[task_id] = state
+    return states
+
+def parse_mem(mem):
+    '''
+    Convert a memory size as given by sacct (e.g. 1234K, 2.5G) to
+    bytes.
+
+    Parameters
+    ----------
+    mem (str): the memory size, without unit it is in bytes
+
+    Returns
+    -------
+    num_bytes (int): None if mem is empty
+    '''
+    mem = mem.strip()
+    if len(mem) == 0:
+        return None
+    units = 'BKMGTP'
+    if mem[-1].upper() in units:
+        return int(float(mem[:-1]) * 1024**units.index(mem[-1].upper()))
+    return int(float(mem))
+
+def task_usage(job_id, username='jlizaraz', hostname=HOSTNAME):
+    '''
+    Get the elapsed time and the peak memory of every task of an
+    array job at CCV, with a single call to sacct. The memory is
+    the largest MaxRSS among the steps of each task.
+
+    Parameters
+    ----------
+    job_id (str): the id of the array job
+    username (str): username at CCV
+    hostname (str): the host where sacct is run
 
     Returns
     -------
+    usage (dict): keys are the ids of the array tasks and values
+    are dicts with keys state, elapsed (in s) and max_rss (in
+    bytes, None if sacct has not measured it)
+    '''
+    cmd = 'sacct -j %s -n -P -o JobID,State,ElapsedRaw,MaxRSS' % job_id
+    result = run_command(cmd, username=username, hostname=hostname)
+    usage = {}
+    for line in result.stdout.splitlines():
+        parts = line.strip().split('|')
+        if len(parts) < 4 or '_' not in parts[0]:
+            continue
+        task, _, step = parts[0].split('_', 1)[1].partition('.')
+        if not task.isdigit():
+            # tasks that have not started yet, e.g. 1234_[5-9]
+            continue
+        entry = usage.setdefault(int(task), {'state': 'PENDING', 'elapsed': 0,
+                                             'max_rss': None})
+        if step == '':
+            entry['state'] = parts[1].split()[0] if parts[1].strip() else 'PENDING'
+            entry['elapsed'] = int(parts[2]) if parts[2].strip() else 0
+        max_rss = parse_mem(parts[3])
+        if max_rss is not None:
+            entry['max_rss'] = max(max_rss, entry['max_rss'] or 0)
+    return usage
+
+def track_completion(job_config, username=None, hostname=None):
+    '''
+    Find the state of every job index of a job sent with
+    run_at_ccv, as told by Slurm (or by the backend that ran it,
+    see get_backend).
+
+    Parameters
+    ----------
+    job_config (dict): as returned by run_at_ccv (or by
+    resubmit_missing)
+    username (str): username at CCV, that of the job_config if
     None
+    hostname (str): the host where sacct is run, that of the
+    job_config if None
+
+    Returns
+    -------
+    tracking (dict): with keys finished, running, pending and
+    failed, each with a sorted list of job indices
     '''
-    qu = execute_at_ccv('myq')
-    qu = re.sub(r'\n\s*\n', '\n', qu)
-    return qu
+    overrides = {key: value for key, value in [('username', username), ('hostname', hostname)]
+                 if value is not None}
+    states = get_backend(dict(job_config, **overrides)).states(job_config['job_id'])
+    tracking = {'finished': [], 'running': [], 'pending': [], 'failed': []}
+    task_ids = range(job_config.get('num_tasks', job_config['numJobs']))
+    index_list = job_config.get('index_list')
+    num_points = job_config['numJobs'] if index_list is None else len(index_list)
+    for task_id in task_ids:
+        state = states.get(task_id, 'PENDING')
+        if state in FINISHED_STATES:
+            group = 'finished'
+        elif state in RUNNING_STATES:
+            group = 'running'
+        elif state in PENDING_STATES:
+            group = 'pending'
+        else:
+            group = 'failed'
+        indices = task_indices(task_id, job_config.get('chunk_size', 1),
+                               num_points, job_config.get('strided', False))
+        if index_list is not None:
+            indices = [index_list[i] for i in indices]
+        tracking[group].extend(indices)
+    for group in tracking.values():
+        group.sort()
+    return tracking
 
-def pull_from_ccv_to_mac(ccv_folder, mac_folder):
+def completion_check(job_config=None, username=None, timeout=None):
     '''
-    All the files from ccv_folder will be synced to mac_folder.
-    None  of  the changes at the mac_folder will be reflected at
-    the ccv_folder.
+    Make a function that tells whether it makes sense to keep
+    waiting for results. It says to stop once the timeout is
+    over, or once Slurm reports that none of the tasks of the
+    job is running or pending anymore and this has been seen
+    already once before (so that results written right before
+    the end get pulled).
 
     Parameters
     ----------
-    ccv_folder (str): path to a folder at CCV
-    mac_foler  (str): path to a folder at the mac
+    job_config (dict): as returned by run_at_ccv, if None (or
+    if it has no job_id) only the timeout is checked
+    username (str): username at CCV, that of the job_config if
+    None
+    timeout (float): seconds after which to stop waiting
 
     Returns
     -------
-    rsync_out (str): the stdout of the rsync command
+    check (function): takes the set of indices that are done and
+    returns True if waiting should stop. It has an attribute
+    tracking with the last result of track_completion.
     '''
-    if not os.path.exists(mac_folder):
-        print("Mac folder does not exist, creating ...")
-        os.mkdir(mac_folder)
-    if mac_folder[-1] != '/':
-        mac_folder += '/'
-    if ccv_folder[-1] != '/':
-        ccv_folder += '/'
-    rsync_cmd = 'rsync -avz jlizaraz@sshcampus.ccv.brown.edu:{ccv_folder} {mac_folder}'.format(ccv_folder=ccv_folder, mac_folder=mac_folder)
-    rsync_out = execute_command(rsync_cmd)
-    return rsync_out
+    start = time.time()
+    def check(done):
+        if timeout is not None and time.time() - start > timeout:
+            return True
+        if job_config is None or job_config.get('job_id') is None:
+            return False
+        if check.settled:
+            return True
+        check.tracking = track_completion(job_config, username=username)
+        check.settled = (len(check.tracking['running']) == 0
+                         and len(check.tracking['pending']) == 0)
+        return False
+    check.settled = False
+    check.tracking = None
+    return check
 
-def load_h5_data(fnames):
+def iter_ccv_values(mac_folder, ccv_folder, numJobs, username='jlizaraz',
+                    hostname=HOSTNAME, poll_time=5, max_poll_time=60,
+                    num_workers=4, until=None):
     '''
-    This  function takes the filenames from a bunch of .h5 files
-    and  creates  a  function  that  can  be used to explore the
-    return values for the corresponding inputs.
+    Incrementally pull results from CCV as they are produced and
+    yield them as they arrive, so that they can be looked at while
+    the sweep is still running. Each poll lists the remote folder
+    once over SFTP and downloads only the .h5 files that are new
+    (or that changed, like a consolidated file), which are kept in
+    mac_folder. What has been ingested is recorded in a manifest
+    in mac_folder, so a later call picks up where the last one
+    left off without yielding the same index twice.
 
     Parameters
     ----------
-    fnames (list): list of paths to the h5 files
+    mac_folder (str): path to the folder where the data will be
+    downloaded
+    ccv_folder (str): path to the folder where the data is at CCV
+    numJobs (int): how many jobs are expected
+    username (str): username at CCV
+    hostname (str): the host where the data is
+    poll_time (float): seconds between polls of the remote folder,
+    this doubles every time a poll brings nothing new, up to
+    max_poll_time, and goes back to poll_time when it does
+    max_poll_time (float): the longest time between polls
+    num_workers (int): how many files are downloaded at a time
+    until (function): if given, it is called after every poll
+    with the set of ingested indices and if it returns True the
+    iteration stops even if there are missing indices
 
     Returns
     -------
-    ccv_fun (function): function that takes the input parameters
-    and  returns the data, this function has an attribute called
-    keys  that  contains the input parameters that it is defined
-    for.
+    values (generator): of (index, params, out) tuples, with the
+    job index, the input parameters and the output
     '''
-    outs = {}
-    for fname in fnames:
-        with h5py.File(fname, 'r') as f:
-            the_index = int(fname.split('/')[-1].split('.')[0])
-            the_params = tuple(np.array(f['in']))
-            outs[the_params] = np.array(f['out'])
-    out_fun = lambda *params: outs.get(tuple(params), None)
-    out_fun.input_params = list(outs.keys())
-    return out_fun
+    os.makedirs(mac_folder, exist_ok=True)
+    manifest_fname = os.path.join(mac_folder, MANIFEST)
+    manifest = {'files': {}, 'indices': []}
+    if os.path.exists(manifest_fname):
+        with open(manifest_fname, 'r') as f:
+            manifest = json.load(f)
+    ingested = set(manifest['indices'])
+    session = get_session(username, hostname)
+    wait_time = poll_time
+    while len(ingested) < numJobs:
+        num_ingested = len(ingested)
+        new_files = []
+        for attr in session.listdir_attr(ccv_folder):
+            stamp = [attr.st_size, attr.st_mtime]
+            if attr.filename.endswith('.h5') and manifest['files'].get(attr.filename) != stamp:
+                new_files.append((attr.filename, stamp))
+        def fetch(pair):
+            session.get('%s/%s' % (ccv_folder, pair[0]), os.path.join(mac_folder, pair[0]))
+            return pair
+        with ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+            fetched = list(executor.map(fetch, new_files))
+        for root_name, stamp in fetched:
+            fname = os.path.join(mac_folder, root_name)
+            try:
+                entries = [entry for entry in iter_h5_entries(fname) if entry[0] not in ingested]
+            except (OSError, KeyError):
+                # most likely the file was still being written, it
+                # will be fetched again on the next poll
+                os.remove(fname)
+                continue
+            except ValueError:
+                # not a file with results
+                entries = []
+            manifest['files'][root_name] = stamp
+            for index, params, out in entries:
+                ingested.add(index)
+                yield index, params, out
+        manifest['indices'] = sorted(ingested)
+        with open(manifest_fname, 'w') as f:
+            json.dump(manifest, f)
+        if len(ingested) >= numJobs or (until is not None and until(ingested)):
+            break
+        if len(ingested) > num_ingested:
+            wait_time = poll_time
+        else:
+            wait_time = min(2 * wait_time, max_poll_time)
+        time.sleep(wait_time)
 
-def get_ccv_values(mac_folder, ccv_folder, numJobs):
+def get_ccv_values(mac_folder, ccv_folder, numJobs, incremental=False, username=None,
+                   job_config=None, timeout=None, max_wait=60, progress=None):
     '''
     This  function  uses  rsync to pull the data from CCV to the
     Mac, it does this periodically until all the expected output
@@ -449,6 +3265,11 @@ def get_ccv_values(mac_folder, ccv_folder, numJobs):
     was evaluated.
     If  an  input  is  given  for  which  the  function  was not
     evaluated, then the function returns None.
+    The time between checks doubles whenever a check brings no
+    new results (up to max_wait). If the job_config is given then
+    Slurm is asked (with one sacct call per check) about the
+    state of the tasks, and if none of them is running or pending
+    anymore it stops waiting, even if some results are missing.
 
     Parameters
     ----------
@@ -457,30 +3278,938 @@ def get_ccv_values(mac_folder, ccv_folder, numJobs):
     ccv_folder  (str):  path  to the folder where the data is at
     CCV
     numJobs (int): how many jobs are expected
+    incremental (bool): if True, instead of rsyncing the whole
+    folder on every check only the new files are pulled (see
+    iter_ccv_values)
+    username (str): username at CCV, if None that of the
+    job_config (or jlizaraz if there is no job_config)
+    job_config (dict): as returned by run_at_ccv, if the job was
+    sent with memoize then the new results are added to the
+    result cache
+    timeout (float): if given, stop waiting after these seconds
+    max_wait (float): longest time in seconds between checks
+    progress (function): if given, it is called with the number
+    of indices that are done and numJobs whenever this changes,
+    instead of drawing a progress bar
     
     Returns
     -------
-    out_fun (function): function that takes the input parameters
-    and returns the data.
-    '''
-    out_fnames = []
-    wait_time = 1
-    num_done = 0
-    while len(out_fnames) < numJobs:
-        pull_from_ccv_to_mac(ccv_folder, mac_folder)
-        out_fnames = os.listdir(mac_folder)
-        out_fnames = list(filter(lambda x: x.endswith('.h5'), out_fnames))
-        # escalate the waiting time if subsequent checks show no progress
-        if num_done == len(out_fnames):
-            wait_time += 2
-        num_done = len(out_fnames)
-        # print('Waiting for %d jobs to finish' % (numJobs - num_done))
-        progress_bar(num_done, numJobs, prefix = 'Progress:', suffix = 'Complete', length = 30)
-        time.sleep(1)
-    out_fnames = [os.path.join(mac_folder, fname) for fname in out_fnames]
+    out_fun (H5Results): callable that takes the input parameters
+    and returns the data. It also has the attributes
+    missing_indices, with the job indices that have no results,
+    and failed_indices, with those of them that Slurm reported as
+    failed (e.g. because of a timeout or running out of memory).
+    '''
+    check = completion_check(job_config, username=username, timeout=timeout)
+    if job_config is None:
+        backend = SlurmBackend('jlizaraz' if username is None else username)
+    elif username is None:
+        backend = get_backend(job_config)
+    else:
+        backend = get_backend(dict(job_config, username=username))
+    # incremental pulls go over SFTP
+    incremental = incremental and backend.name == 'slurm'
+    if progress is None:
+        def progress(num_done, total):
+            progress_bar(min(num_done, total), total, prefix = 'Progress:',
+                         suffix = 'Complete', length = 30)
+        bar = True
+    else:
+        bar = False
+    done = set()
+    progress(0, numJobs)
+    if incremental:
+        values = iter_ccv_values(mac_folder, ccv_folder, numJobs, username=backend.username,
+                                 hostname=backend.hostname, poll_time=1,
+                                 max_poll_time=max_wait, until=check)
+        for index, _, _ in values:
+            done.add(index)
+            progress(len(done), numJobs)
+    else:
+        wait_time = 1
+        while True:
+            backend.fetch(ccv_folder, mac_folder)
+            out_fnames = [os.path.join(mac_folder, fname) for fname in os.listdir(mac_folder)
+                          if fname.endswith('.h5')]
+            num_done = len(done)
+            done = completed_indices(out_fnames)
+            if len(done) > num_done:
+                progress(len(done), numJobs)
+            if len(done) >= numJobs or check(done):
+                break
+            # escalate the waiting time if subsequent checks show no progress
+            if len(done) > num_done:
+                wait_time = 1
+            else:
+                wait_time = min(2 * wait_time, max_wait)
+            time.sleep(wait_time)
+    out_fnames = [os.path.join(mac_folder, fname) for fname in os.listdir(mac_folder)
+                  if fname.endswith('.h5')]
+    done = completed_indices(out_fnames)
+    if bar and len(done) < numJobs:
+        print()
+    if job_config is not None and job_config.get('fun_hash') is not None:
+        cache_results(job_config['fun_hash'], out_fnames)
     out_fun = load_h5_data(out_fnames)
+    out_fun.missing_indices = sorted(set(range(numJobs)) - done)
+    out_fun.failed_indices = []
+    if check.tracking is not None:
+        failed = set(check.tracking['failed'])
+        out_fun.failed_indices = [index for index in out_fun.missing_indices if index in failed]
+    if len(out_fun.missing_indices) > 0:
+        print('%d job indices have no results, %d of them failed.'
+              % (len(out_fun.missing_indices), len(out_fun.failed_indices)))
     return out_fun
 
+def remote_completed_indices(job_config):
+    '''
+    Find which job indices already have results at CCV. Per-index
+    files are found with a single listing of the scratch folder,
+    and if there are consolidated files their indices are read
+    with one remote python call.
+
+    Parameters
+    ----------
+    job_config (dict): as returned by run_at_ccv
+
+    Returns
+    -------
+    indices (set): the job indices that are done
+    '''
+    scratch_dir = job_config['scratch_dir_at_CCV']
+    backend = get_backend(job_config)
+    indices = set()
+    others = []
+    for fname in backend.listdir(scratch_dir):
+        if is_index_file(fname):
+            indices.add(int(fname[:-3]))
+        elif fname.endswith('.h5'):
+            others.append('%s/%s' % (scratch_dir, fname))
+    if len(others) > 0:
+        code = ("import h5py, sys\n"
+                "for fname in sys.argv[1:]:\n"
+                "    with h5py.File(fname, 'r') as f:\n"
+                "        if f.attrs.get('zzb_format') == %r:\n"
+                "            print(' '.join(map(str, f['index'][()])))" % CONSOLIDATED)
+        cmd = '%s -c %s %s' % (backend.python, shlex.quote(code),
+                               ' '.join(map(shlex.quote, others)))
+        result = backend.run(cmd)
+        indices.update(int(index) for index in result.stdout.split())
+    return indices
+
+def resubmit_missing(job_config, memInGB=None, walltime=None, verbose=False):
+    '''
+    Send again only the job indices of a job sent with run_at_ccv
+    that have no results, neither at CCV nor in the local scratch
+    folder nor in the result cache (the cached_indices of a job
+    sent with memoize), as a new array job. The missing indices
+    are written to an index file and packed into array tasks as
+    in the original job (see plan_chunks), so that the task ids
+    stay small however large the sweep is. The script that was
+    already uploaded is reused, only a new sbatch script and the
+    index file are sent, and the retry can be given more memory
+    or a longer walltime. If the job was consolidated then a new
+    consolidation job is sent after the retry.
+
+    Parameters
+    ----------
+    job_config (dict): as returned by run_at_ccv
+    memInGB (int): memory for each retried task, if None the same
+    as for the original job
+    walltime (str): time limit for each retried task, if None the
+    same as for the original job
+    verbose (bool): if True some debug mesages are printed
+
+    Returns
+    -------
+    retry_config (dict): a copy of job_config describing the
+    retry, with the keys job_id, array_spec, chunk_size,
+    num_tasks and index_list (the retried job indices) updated,
+    so that it can be given to get_ccv_values or
+    track_completion. It is None if nothing was missing. A
+    summary of the retry, with the retried indices written
+    compactly (e.g. 3,17,40-55), is also appended to
+    job_config['retries'].
+    '''
+    job_name = job_config['job_name']
+    data_dir = job_config['data_dir_at_CCV']
+    numJobs = job_config['numJobs']
+    done = remote_completed_indices(job_config) | set(job_config.get('cached_indices', []))
+    local_dir = job_config.get('scratch_dir_at_mac')
+    if local_dir is not None and os.path.isdir(local_dir):
+        done |= completed_indices([os.path.join(local_dir, fname) for fname in os.listdir(local_dir)
+                                   if fname.endswith('.h5')])
+    missing = sorted(set(range(numJobs)) - done)
+    if len(missing) == 0:
+        print("All %d job indices have results, nothing to resubmit." % numJobs)
+        return None
+    backend = get_backend(job_config)
+    if job_name + '.py' not in backend.listdir(data_dir):
+        raise FileNotFoundError('%s.py is not at %s, it needs to be sent with run_at_ccv.'
+                                % (job_name, data_dir))
+    retry_config = dict(job_config)
+    retry_config.pop('ccv_sbatch_cmd_outputs', None)
+    if memInGB is not None:
+        retry_config['memInGB'] = memInGB
+    if walltime is not None:
+        retry_config['walltime'] = walltime
+    # the task ids of the retry are positions in its index file
+    chunk_size, num_tasks = plan_chunks(retry_config, len(missing))
+    retry_config['chunk_size'] = chunk_size
+    retry_config['num_tasks'] = num_tasks
+    retry_config['index_list'] = missing
+    array_spec = '0-%d' % (num_tasks - 1)
+    retry_config['array_spec'] = array_spec
+    retried = compress_array_spec(missing)
+    attempt = len(job_config.get('retries', [])) + 1
+    index_fname = write_index_file('%s-retry%d-indices.txt' % (job_name, attempt), missing)
+    script_args = runner_args(retry_config, len(missing), '%s/%s' % (data_dir, index_fname),
+                              backend.name)
+    sbatch = compose_sbatch(retry_config, array_spec, script_args, python=backend.python)
+    retry_config['sbatch'] = sbatch
+    sbatch_fname = '%s-retry-batch.sh' % job_name
+    with open(sbatch_fname, 'w') as f:
+        f.write(sbatch)
+    print("Resubmitting %d job indices in %d tasks: %s" % (len(missing), num_tasks, retried))
+    backend.upload([sbatch_fname, index_fname], data_dir, verbose=verbose)
+    _, result, job_id = backend.submit(sbatch_fname, data_dir)
+    if verbose:
+        print(result.stdout)
+        print(result.stderr)
+    if result.exit_status != 0:
+        print("sbatch failed:\n%s" % result.stderr)
+    retry_config['job_id'] = job_id
+    if job_id is not None and job_config.get('consolidate', False):
+        _, result, consolidate_id = backend.submit('%s-consolidate.sh' % job_name, data_dir,
+                                                   dependency='afterany:%s' % job_id)
+        retry_config['consolidate_job_id'] = consolidate_id
+    job_config.setdefault('retries', []).append({'job_id': job_id,
+                                                 'indices': retried,
+                                                 'memInGB': retry_config['memInGB'],
+                                                 'walltime': retry_config.get('walltime', WALLTIME)})
+    return retry_config
+
+def run_pipeline(job_config, stages, verbose=False):
+    '''
+    Send a map stage (a grid job, as with run_at_ccv) followed by
+    stages that reduce its results at CCV, each one a job that
+    depends on the one before, so that only what the last stage
+    makes needs to be pulled (see pipeline_results).
+
+    Each stage runs a function fun(inputs, out_fname) which is
+    given a list of paths and saves what it makes to out_fname.
+    There are two kinds of stages:
+        reduce: a single task, which starts once all the tasks of
+        the previous stage are done (--dependency=afterok) and
+        gets all their outputs.
+        per_chunk: one task for each task of the previous stage,
+        each of which starts as soon as its counterpart is done
+        (--dependency=aftercorr) and gets only its outputs.
+    The outputs of the map stage are the per-index files that the
+    map function saves, scratch_dir/{index}.h5. Those of a stage
+    are saved in scratch_dir/{stage name}/{task id}{ext}.
+
+    Parameters
+    ----------
+    job_config (dict): as for run_at_ccv, memoize, pilot and
+    consolidate are not used since the reduce stages need all
+    the per-index files at CCV
+    stages (list): of dicts, one per stage after the map, with
+    keys
+        > fun_name (str): the function of the stage, it has to be
+        in theglobals of the job_config.
+        > kind (str): reduce (default) or per_chunk.
+        > name (str): the name of the stage, by default
+        stage1, stage2, ...
+        > ext (str): the extension of the outputs, .h5 by default.
+        > dependency (str): the kind of Slurm dependency on the
+        previous stage, afterok or aftercorr by default (e.g.
+        afterany to reduce even if some tasks fail).
+        > memInGB, walltime, numCores: the resources of each task
+        of the stage, by default those of the job_config, and 1
+        core.
+    verbose (bool): if True some debug mesages are printed
+
+    Returns
+    -------
+    job_config (dict): as returned by run_at_ccv, plus the key
+    stages, with a list of dicts (one per stage after the map)
+    with the keys of the stage and job_id, num_tasks, out_dir
+    (the folder of its outputs at CCV), script_hash, inputs
+    (the inputs of each task) and backend
+    '''
+    theglobals = job_config['theglobals']
+    job_config['memoize'] = False
+    job_config['pilot'] = None
+    job_config['consolidate'] = False
+    names = [stage.get('name', 'stage%d' % (i + 1)) for i, stage in enumerate(stages)]
+    if len(set(names)) < len(names):
+        raise ValueError('The stages need different names.')
+    kinds = [stage.get('kind', 'reduce') for stage in stages]
+    for i, kind in enumerate(kinds):
+        if kind not in ['reduce', 'per_chunk']:
+            raise ValueError('Unknown kind of stage %s.' % kind)
+        if kind == 'per_chunk' and i > 0 and kinds[i-1] == 'reduce':
+            raise ValueError('A per_chunk stage can not follow a reduce stage.')
+    job_config = run_at_ccv(job_config, verbose=verbose)
+    if job_config.get('job_id') is None:
+        print("The map stage was not sent, neither are the other stages.")
+        return job_config
+    backend = get_backend(job_config)
+    job_name = job_config['job_name']
+    data_dir = job_config['data_dir_at_CCV']
+    scratch_dir = job_config['scratch_dir_at_CCV']
+    zzvars = "data_dir = '%s'\nscratch_dir = '%s'" % (data_dir, scratch_dir)
+    # the outputs of each task of the map stage
+    previous = {}
+    for task_id in range(job_config['num_tasks']):
+        indices = task_indices(task_id, job_config['chunk_size'], job_config['numJobs'],
+                               job_config.get('strided', False))
+        previous[str(task_id)] = ['%s/%d.h5' % (scratch_dir, index) for index in indices]
+    previous_id = job_config['job_id']
+    job_config['stages'] = []
+    for stage, name, kind in zip(stages, names, kinds):
+        fun_name = stage['fun_name']
+        ext = stage.get('ext', '.h5')
+        out_dir = '%s/%s' % (scratch_dir, name)
+        if kind == 'reduce':
+            inputs = {'0': [fname for task_id in sorted(previous, key=int)
+                            for fname in previous[task_id]]}
+        else:
+            inputs = previous
+        funs, consts, unresolved = get_needed_fun(theglobals, fun_name,
+                                                  import_block=job_config['import_block'],
+                                                  provided=['data_dir', 'scratch_dir'])
+        if len(unresolved) > 0:
+            print('Warning, unresolved names in %s:\n%s'
+                  % (fun_name, '\n'.join('  %s: %s' % (k, v) for k, v in unresolved.items())))
+        runner = STAGE_RUNNER.strip() % {'fun_name': fun_name, 'ext': ext}
+        script_text = '\n\n'.join([job_config['import_block'], zzvars] + consts + funs + [runner])
+        script_hash, _ = cache_script(script_text)
+        stage_name = '%s-%s' % (job_name, name)
+        with open(stage_name + '.py', 'w') as f:
+            f.write(script_text)
+        inputs_fname = '%s-inputs.json' % stage_name
+        with open(inputs_fname, 'w') as f:
+            json.dump(inputs, f)
+        stage_config = dict(job_config, job_name=stage_name, pool=False,
+                            numCores=stage.get('numCores', 1),
+                            memInGB=stage.get('memInGB', job_config['memInGB']),
+                            walltime=stage.get('walltime', job_config.get('walltime', WALLTIME)))
+        num_tasks = len(inputs)
+        script_args = '--inputs_file=%s/%s --out_dir=%s' % (data_dir, inputs_fname, out_dir)
+        sbatch = compose_sbatch(stage_config, '0-%d' % (num_tasks - 1), script_args,
+                                python=backend.python)
+        sbatch_fname = '%s-batch.sh' % stage_name
+        with open(sbatch_fname, 'w') as f:
+            f.write(sbatch)
+        backend.upload([stage_name + '.py', inputs_fname, sbatch_fname], data_dir,
+                       verbose=verbose)
+        dependency = stage.get('dependency', 'afterok' if kind == 'reduce' else 'aftercorr')
+        print("Sending stage %s (%s, %d tasks) ..." % (name, kind, num_tasks))
+        _, result, job_id = backend.submit(sbatch_fname, data_dir,
+                                           dependency='%s:%s' % (dependency, previous_id))
+        if verbose:
+            print(result.stdout)
+            print(result.stderr)
+        job_config['stages'].append(dict(stage, name=name, kind=kind, job_id=job_id,
+                                         num_tasks=num_tasks, out_dir=out_dir,
+                                         script_hash=script_hash, inputs=inputs,
+                                         backend=backend.name))
+        if result.exit_status != 0 or job_id is None:
+            print("sbatch failed:\n%s" % result.stderr)
+            break
+        previous = {str(task_id): ['%s/%d%s' % (out_dir, task_id, ext)]
+                    for task_id in range(num_tasks)}
+        previous_id = job_id
+    return job_config
+
+def pipeline_results(job_config, mac_folder=None, poll_time=10, max_poll_time=60,
+                     timeout=None):
+    '''
+    Wait for the stages of a pipeline sent with run_pipeline and
+    pull the outputs of its last stage, and nothing else. Waiting
+    stops early if a stage has failed tasks and nothing is
+    running anymore, since the stages that depend on it would
+    never start.
+
+    Parameters
+    ----------
+    job_config (dict): as returned by run_pipeline
+    mac_folder (str): where the outputs are pulled to, by default
+    the folder of the last stage in scratch_dir_at_mac
+    poll_time (float): shortest time in seconds between checks
+    max_poll_time (float): longest time in seconds between checks
+    timeout (float): if given, stop waiting after these seconds
+
+    Returns
+    -------
+    fnames (list): paths of the pulled outputs of the last stage,
+    sorted by task id. Those of tasks that did not complete are
+    left out.
+    '''
+    username = job_config['username']
+    stage_configs = [job_config] + [dict(job_config, job_id=stage['job_id'],
+                                         num_tasks=stage['num_tasks'], chunk_size=1,
+                                         numJobs=stage['num_tasks'], strided=False)
+                                    for stage in job_config['stages']]
+    last = job_config['stages'][-1]
+    start = time.time()
+    wait_time = poll_time
+    while True:
+        trackings = [track_completion(stage_config, username=username)
+                     for stage_config in stage_configs]
+        busy = any(len(tracking['running']) > 0 for tracking in trackings)
+        failed = any(len(tracking['failed']) > 0 for tracking in trackings)
+        last_tracking = trackings[-1]
+        if len(last_tracking['running']) == 0 and len(last_tracking['pending']) == 0:
+            break
+        if failed and not busy:
+            print("Some tasks failed, the stages after them will not run.")
+            break
+        if timeout is not None and time.time() - start > timeout:
+            print("The pipeline did not finish in time.")
+            break
+        time.sleep(wait_time)
+        wait_time = min(2 * wait_time, max_poll_time)
+    if mac_folder is None:
+        mac_folder = os.path.join(job_config['scratch_dir_at_mac'], last['name'])
+    get_backend(job_config).fetch(last['out_dir'], mac_folder)
+    ext = last.get('ext', '.h5')
+    fnames = [os.path.join(mac_folder, '%d%s' % (task_id, ext))
+              for task_id in last_tracking['finished']]
+    return [fname for fname in fnames if os.path.exists(fname)]
+
+def format_walltime(seconds):
+    '''
+    Write a number of seconds as a Slurm walltime, H:MM:SS.
+
+    Parameters
+    ----------
+    seconds (float): the time, rounded up to whole seconds
+
+    Returns
+    -------
+    walltime (str): e.g. 1:30:00
+    '''
+    seconds = int(math.ceil(seconds))
+    return '%d:%02d:%02d' % (seconds // 3600, (seconds % 3600) // 60, seconds % 60)
+
+def parse_walltime(walltime):
+    '''
+    Convert a Slurm walltime (M, M:S, H:M:S, D-H, D-H:M or D-H:M:S)
+    to seconds.
+
+    Parameters
+    ----------
+    walltime (str): the time limit
+
+    Returns
+    -------
+    seconds (int)
+    '''
+    days, _, rest = walltime.rpartition('-')
+    parts = [int(p) for p in rest.split(':')]
+    if days:
+        # with days the first field is hours
+        parts += [0] * (3 - len(parts))
+        hours, minutes, seconds = parts
+    elif len(parts) == 3:
+        hours, minutes, seconds = parts
+    else:
+        parts += [0] * (2 - len(parts))
+        hours = 0
+        minutes, seconds = parts
+    return ((int(days or 0) * 24 + hours) * 60 + minutes) * 60 + seconds
+
+def estimate_resources(usage, indices_per_task=1):
+    '''
+    Estimate the runtime and the memory that a single job index
+    needs from what the tasks of a job used. Only completed tasks
+    are counted, and the slowest and largest of them are taken.
+
+    Parameters
+    ----------
+    usage (dict): as returned by task_usage
+    indices_per_task (int): how many job indices each task ran,
+    one after the other
+
+    Returns
+    -------
+    estimate (dict): with keys task_seconds (runtime of one job
+    index), peak_bytes (memory of one task), num_samples, and
+    the raw elapsed and max_rss of each task. None if no task
+    has completed.
+    '''
+    done = {task_id: entry for task_id, entry in usage.items()
+            if entry['state'] in FINISHED_STATES}
+    if len(done) == 0:
+        return None
+    elapsed = [done[task_id]['elapsed'] for task_id in sorted(done)]
+    max_rss = [done[task_id]['max_rss'] or 0 for task_id in sorted(done)]
+    return {'task_seconds': max(elapsed) / indices_per_task,
+            'peak_bytes': max(max_rss),
+            'num_samples': len(done),
+            'elapsed': elapsed,
+            'max_rss': max_rss,
+            'measured': time.time()}
+
+def size_resources(job_config, estimate, margin=SIZE_MARGIN):
+    '''
+    Set the walltime, memory and chunk size of a job from an
+    estimate of what each job index needs, with some room to
+    spare. An explicit chunk_size in the job_config is kept,
+    otherwise each array task gets as many job indices as fit in
+    target_walltime (the walltime given in the job_config, or
+    WALLTIME, if not given).
+
+    Parameters
+    ----------
+    job_config (dict): as given to run_at_ccv, it is updated
+    estimate (dict): as returned by estimate_resources
+    margin (float): factor applied over the measured runtime and
+    memory
+
+    Returns
+    -------
+    job_config (dict): with task_seconds, walltime and memInGB
+    set, and chunk_size if it was not given
+    '''
+    pool = job_config.get('pool', False)
+    workers = job_config['numCores'] // job_config.get('blas_threads', 1) if pool else 1
+    job_config.setdefault('target_walltime',
+                          parse_walltime(job_config.get('walltime', WALLTIME)))
+    job_config['task_seconds'] = max(1., estimate['task_seconds'] * margin)
+    chunk_size = job_config.get('chunk_size')
+    if chunk_size is None:
+        # workers run side by side, so a task fits workers times more
+        chunk_size = max(1, int(job_config['target_walltime']
+                                // job_config['task_seconds']) * workers)
+        job_config['chunk_size'] = chunk_size
+    rounds = math.ceil(chunk_size / workers)
+    # never less than five minutes, to leave time to start python
+    job_config['walltime'] = format_walltime(max(300, rounds * job_config['task_seconds']))
+    mem_bytes = estimate['peak_bytes'] * margin * workers
+    job_config['memInGB'] = max(1, int(math.ceil(mem_bytes / 1024**3)))
+    return job_config
+
+def resource_profile_path(script_hash, profile_dir=RESOURCE_PROFILES):
+    '''
+    Where the resource estimate of a script is kept.
+
+    Parameters
+    ----------
+    script_hash (str): sha256 of the text of the script
+    profile_dir (str): the folder of the profiles
+
+    Returns
+    -------
+    path (str): path of the .json file with the estimate
+    '''
+    return os.path.join(profile_dir, script_hash + '.json')
+
+def load_resource_profile(script_hash, profile_dir=RESOURCE_PROFILES):
+    '''
+    Get the resource estimate of a script measured in an earlier
+    run, see estimate_resources.
+
+    Parameters
+    ----------
+    script_hash (str): sha256 of the text of the script
+    profile_dir (str): the folder of the profiles
+
+    Returns
+    -------
+    estimate (dict): None if the script has not been measured
+    '''
+    path = resource_profile_path(script_hash, profile_dir)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def save_resource_profile(script_hash, estimate, profile_dir=RESOURCE_PROFILES):
+    '''
+    Keep the resource estimate of a script for later runs of it.
+
+    Parameters
+    ----------
+    script_hash (str): sha256 of the text of the script
+    estimate (dict): as returned by estimate_resources
+    profile_dir (str): the folder of the profiles
+
+    Returns
+    -------
+    path (str): where the estimate was saved
+    '''
+    os.makedirs(profile_dir, exist_ok=True)
+    path = resource_profile_path(script_hash, profile_dir)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(estimate, f)
+    os.replace(path + '.tmp', path)
+    return path
+
+def measure_resources(job_config, username=None):
+    '''
+    Measure what the tasks of a finished job sent with run_at_ccv
+    used, and keep it as the resource profile of its script, so
+    that later runs of the same script with pilot set are sized
+    from it.
+
+    Parameters
+    ----------
+    job_config (dict): as returned by run_at_ccv
+    username (str): username at CCV, that of the job_config if
+    None
+
+    Returns
+    -------
+    estimate (dict): as returned by estimate_resources, it is
+    also saved in job_config['resource_estimate']
+    '''
+    username = job_config['username'] if username is None else username
+    usage = task_usage(job_config['job_id'], username=username,
+                       hostname=job_config.get('hostname', HOSTNAME))
+    indices_per_task = job_config.get('chunk_size', 1)
+    if job_config.get('pool', False):
+        workers = job_config['numCores'] // job_config.get('blas_threads', 1)
+        indices_per_task = math.ceil(indices_per_task / workers)
+    estimate = estimate_resources(usage, indices_per_task)
+    if estimate is not None:
+        if job_config.get('pool', False):
+            # the memory of a task is shared by its workers
+            estimate['peak_bytes'] = estimate['peak_bytes'] / workers
+        estimate['script_hash'] = job_config['script_hash']
+        save_resource_profile(job_config['script_hash'], estimate)
+        job_config['resource_estimate'] = estimate
+    return estimate
+
+def run_pilot(job_config, points, bundle, poll_time=10, timeout=None, verbose=False):
+    '''
+    Run a few job indices of a job as a pilot, to measure how
+    long each one takes and how much memory it needs. The pilot
+    indices are spread evenly over points and written to an index
+    file, and each one runs as its own array task (task ids
+    0..pilot-1), with the memInGB and walltime of the job_config.
+
+    Parameters
+    ----------
+    job_config (dict): as in run_at_ccv, with data_dir_at_CCV
+    set, and pilot (int), the number of indices to run
+    points (list): the job indices that the pilot picks from
+    bundle (list): the files that the job needs at CCV (the
+    script and the extra_py files)
+    poll_time (float): seconds between checks on the pilot
+    timeout (float): if given, stop waiting after these seconds
+    verbose (bool): if True some debug mesages are printed
+
+    Returns
+    -------
+    (estimate, pilot_config) (dict, dict): the estimate is as
+    returned by estimate_resources (None if no pilot task
+    completed), and pilot_config has the job_id and index_list
+    (the pilot indices) of the pilot job, and its tracking (by
+    job index).
+    '''
+    username = job_config['username']
+    job_name = job_config['job_name']
+    data_dir = job_config['data_dir_at_CCV']
+    num_samples = min(int(job_config['pilot']), len(points))
+    sample = sorted(set(points[(i * len(points)) // num_samples]
+                        for i in range(num_samples)))
+    pilot_config = dict(job_config)
+    pilot_config['pool'] = False
+    pilot_config['chunk_size'] = 1
+    pilot_config['strided'] = False
+    pilot_config['index_list'] = sample
+    pilot_config['num_tasks'] = len(sample)
+    backend = get_backend(job_config)
+    index_fname = write_index_file('%s-pilot-indices.txt' % job_name, sample)
+    script_args = runner_args(pilot_config, len(sample), '%s/%s' % (data_dir, index_fname),
+                              backend.name)
+    sbatch = compose_sbatch(pilot_config, '0-%d' % (len(sample) - 1), script_args,
+                            python=backend.python)
+    sbatch_fname = '%s-pilot-batch.sh' % job_name
+    with open(sbatch_fname, 'w') as f:
+        f.write(sbatch)
+    print("Sending a pilot with %d job indices: %s" % (len(sample), compress_array_spec(sample)))
+    backend.upload(bundle + [sbatch_fname, index_fname], data_dir, verbose=verbose)
+    _, result, job_id = backend.submit(sbatch_fname, data_dir)
+    pilot_config['job_id'] = job_id
+    if result.exit_status != 0 or job_id is None:
+        print("sbatch failed:\n%s" % result.stderr)
+        return None, pilot_config
+    start = time.time()
+    while True:
+        tracking = track_completion(pilot_config, username=username)
+        pilot_config['tracking'] = tracking
+        if len(tracking['running']) == 0 and len(tracking['pending']) == 0:
+            break
+        if timeout is not None and time.time() - start > timeout:
+            print("The pilot did not finish in time.")
+            break
+        time.sleep(poll_time)
+    estimate = estimate_resources(task_usage(job_id, username=username,
+                                             hostname=backend.hostname))
+    if estimate is None:
+        print("No pilot task completed, the job is not resized.")
+    return estimate, pilot_config
+
+def task_stats(job_config, username=None):
+    '''
+    Get what the instrumented script recorded about every job
+    index of a job sent with run_at_ccv (see compose_runner),
+    with a single command at CCV. If an index was run more than
+    once (e.g. by a pilot and again by a retry) only its latest
+    record is kept.
+
+    Parameters
+    ----------
+    job_config (dict): as returned by run_at_ccv
+    username (str): username at CCV, that of the job_config if
+    None
+
+    Returns
+    -------
+    records (list): dicts with keys index, host, pid, job_id,
+    array_job_id, array_task_id, start, wall_seconds,
+    cpu_seconds, peak_rss (in bytes), import_seconds, workers,
+    and error (the traceback) for indices that failed, sorted by
+    index
+    '''
+    username = job_config['username'] if username is None else username
+    stats_dir = '%s/zzb_stats' % job_config['scratch_dir_at_CCV']
+    backend = get_backend(dict(job_config, username=username))
+    result = backend.run('cat %s/*.jsonl 2>/dev/null' % stats_dir)
+    latest = {}
+    for line in result.stdout.splitlines():
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            # a line that was being written when the task was killed
+            continue
+        index = record['index']
+        if index not in latest or latest[index]['start'] <= record['start']:
+            latest[index] = record
+    return [latest[index] for index in sorted(latest)]
+
+def task_report(records, straggler_factor=3., num_stragglers=10, verbose=True):
+    '''
+    Summarize the records of task_stats: percentiles of the wall
+    time, cpu time, peak memory and import time of the job
+    indices, and which indices were much slower than the rest
+    (the stragglers) or failed. The peak memory of an index is
+    that of the process that ran it, up to the end of the index,
+    so when a process runs many indices (serially, or as a worker
+    of a pool) it can come from an earlier index, the max over
+    the indices is the one to size jobs by.
+
+    Parameters
+    ----------
+    records (list): as returned by task_stats
+    straggler_factor (float): an index is a straggler if its
+    wall time is more than this times the median
+    num_stragglers (int): at most this many stragglers are given
+    verbose (bool): if True the report is printed
+
+    Returns
+    -------
+    report (dict): with keys count, wall_seconds, cpu_seconds,
+    peak_rss and import_seconds (each a dict with p50, p90, p99,
+    max and mean), cpu_efficiency (total cpu time over total
+    wall time), hosts (for each host a tuple with its number of
+    indices and their median wall time), stragglers (a list of
+    (index, wall_seconds, host), slowest first) and failed (the
+    indices that failed)
+    '''
+    failed = [record['index'] for record in records if 'error' in record]
+    records = [record for record in records if 'error' not in record]
+    report = {'count': len(records), 'failed': failed}
+    if len(records) == 0:
+        if verbose:
+            print("No records, %d failed job indices." % len(failed))
+        return report
+    for key in ['wall_seconds', 'cpu_seconds', 'peak_rss', 'import_seconds']:
+        values = np.array([record[key] for record in records], dtype=float)
+        p50, p90, p99 = np.percentile(values, [50, 90, 99])
+        report[key] = {'p50': p50, 'p90': p90, 'p99': p99,
+                       'max': values.max(), 'mean': values.mean()}
+    walls = np.array([record['wall_seconds'] for record in records])
+    report['cpu_efficiency'] = (sum(record['cpu_seconds'] for record in records)
+                                / max(walls.sum(), 1e-9))
+    hosts = {}
+    for record in records:
+        hosts.setdefault(record['host'], []).append(record['wall_seconds'])
+    report['hosts'] = {host: (len(walls_), float(np.median(walls_)))
+                       for host, walls_ in sorted(hosts.items())}
+    threshold = straggler_factor * report['wall_seconds']['p50']
+    slow = sorted((record for record in records if record['wall_seconds'] > threshold),
+                  key=lambda record: -record['wall_seconds'])
+    report['stragglers'] = [(record['index'], record['wall_seconds'], record['host'])
+                            for record in slow[:num_stragglers]]
+    if verbose:
+        print("%d job indices, %d failed" % (len(records), len(failed)))
+        print("%-16s %10s %10s %10s %10s" % ('', 'p50', 'p90', 'p99', 'max'))
+        for key, scale in [('wall_seconds', 1), ('cpu_seconds', 1),
+                           ('import_seconds', 1), ('peak_rss', 1024**2)]:
+            label = 'peak_rss (MB)' if key == 'peak_rss' else key
+            print("%-16s %10.2f %10.2f %10.2f %10.2f" % ((label,)
+                  + tuple(report[key][p] / scale for p in ['p50', 'p90', 'p99', 'max'])))
+        print("cpu efficiency: %.2f" % report['cpu_efficiency'])
+        if len(report['stragglers']) > 0:
+            print("stragglers (over %.2f s):" % threshold)
+            for index, wall, host in report['stragglers']:
+                print("  %d: %.2f s at %s" % (index, wall, host))
+        if len(failed) > 0:
+            print("failed: %s" % compress_array_spec(failed))
+    return report
+
+# the thread pool of the async functions, see _async_executor
+_executor = None
+
+def _async_executor():
+    '''
+    The thread pool where the async functions run their blocking
+    calls, it is created on first use.
+    '''
+    global _executor
+    with _sessions_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=ASYNC_WORKERS,
+                                           thread_name_prefix='zzb')
+        return _executor
+
+async def _in_thread(fun, *args, **kwargs):
+    '''
+    Run a blocking call in the thread pool of the async functions
+    without blocking the event loop.
+    '''
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_async_executor(),
+                                      functools.partial(fun, *args, **kwargs))
+
+def _threadsafe(callback):
+    '''
+    Wrap a callback so that, when called from a worker thread, it
+    runs in the thread of the running event loop. If it is a
+    coroutine function it is scheduled as a task.
+    '''
+    if callback is None:
+        return None
+    loop = asyncio.get_running_loop()
+    def call(*args):
+        if asyncio.iscoroutinefunction(callback):
+            loop.call_soon_threadsafe(lambda: loop.create_task(callback(*args)))
+        else:
+            loop.call_soon_threadsafe(callback, *args)
+    return call
+
+async def submit(job_config, verbose=False):
+    '''
+    Send a grid job to CCV without blocking the event loop, this
+    is run_at_ccv run in a worker thread. All the jobs of a user
+    go over the same pooled SSH connection (see get_session), so
+    that many of them can be sent at once, e.g. in a notebook
+        job_configs = await asyncio.gather(*[submit(job_config)
+                                            for job_config in job_configs])
+
+    Parameters
+    ----------
+    job_config (dict): as for run_at_ccv, each job needs its own
+    job_name
+    verbose (bool): if True some debug mesages are printed
+
+    Returns
+    -------
+    job_config (dict): as returned by run_at_ccv
+    '''
+    return await _in_thread(run_at_ccv, job_config, verbose=verbose)
+
+async def wait(job_config, callback=None, poll_time=10, max_poll_time=60, timeout=None):
+    '''
+    Wait until no task of a job sent with run_at_ccv (or submit)
+    is running or pending anymore, asking Slurm with one sacct
+    call per check. The time between checks doubles whenever
+    nothing changes, up to max_poll_time.
+
+    Parameters
+    ----------
+    job_config (dict): as returned by run_at_ccv
+    callback (function): if given, it is called with the result of
+    track_completion whenever this changes, it may be a
+    coroutine function
+    poll_time (float): shortest time in seconds between checks
+    max_poll_time (float): longest time in seconds between checks
+    timeout (float): if given, stop waiting after these seconds
+
+    Returns
+    -------
+    tracking (dict): the last result of track_completion, None if
+    there was no job to wait for
+    '''
+    if job_config.get('job_id') is None:
+        return None
+    username = job_config['username']
+    start = time.time()
+    wait_time = poll_time
+    last = None
+    while True:
+        tracking = await _in_thread(track_completion, job_config, username=username)
+        if tracking != last:
+            wait_time = poll_time
+            if callback is not None:
+                result = callback(tracking)
+                if asyncio.iscoroutine(result):
+                    await result
+        else:
+            wait_time = min(2 * wait_time, max_poll_time)
+        last = tracking
+        if len(tracking['running']) == 0 and len(tracking['pending']) == 0:
+            return tracking
+        if timeout is not None and time.time() - start > timeout:
+            return tracking
+        await asyncio.sleep(wait_time)
+
+async def gather_results(job_config, callback=None, mac_folder=None, ccv_folder=None,
+                         timeout=None, max_wait=60):
+    '''
+    Pull the results of a job sent with run_at_ccv (or submit) as
+    they are produced, without blocking the event loop. This is
+    get_ccv_values with incremental pulls over the pooled SSH
+    connection, run in a worker thread.
+
+    Parameters
+    ----------
+    job_config (dict): as returned by run_at_ccv
+    callback (function): if given, it is called with the number of
+    job indices that are done and numJobs whenever this changes,
+    instead of drawing a progress bar. It may be a coroutine
+    function.
+    mac_folder (str): where the results are downloaded, the
+    scratch_dir_at_mac of the job_config by default
+    ccv_folder (str): where the results are at CCV, the
+    scratch_dir_at_CCV of the job_config by default
+    timeout (float): if given, stop waiting after these seconds
+    max_wait (float): longest time in seconds between checks
+
+    Returns
+    -------
+    out_fun (H5Results): as returned by get_ccv_values
+    '''
+    mac_folder = job_config['scratch_dir_at_mac'] if mac_folder is None else mac_folder
+    ccv_folder = job_config['scratch_dir_at_CCV'] if ccv_folder is None else ccv_folder
+    progress = _threadsafe(callback)
+    if progress is None:
+        # a progress bar from a worker thread would garble the
+        # output of the notebook
+        progress = lambda num_done, total: None
+    return await _in_thread(get_ccv_values, mac_folder, ccv_folder, job_config['numJobs'],
+                            incremental=True, username=job_config['username'],
+                            job_config=job_config, timeout=timeout, max_wait=max_wait,
+                            progress=progress)
+
 def progress_bar(iteration, total, prefix = '', suffix = '', decimals = 1, length = 50, fill = '█'):
     '''
     A convenient progress bar.
@@ -513,4 +4242,4 @@ def progress_bar(iteration, total, prefix = '', suffix = '', decimals = 1, lengt
     sys.stdout.flush()  # add this line
     # Print New Line on Complete
     if iteration == total: 
-        print()
\ No newline at end of file
+        print()